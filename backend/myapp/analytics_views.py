@@ -2,9 +2,10 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from django.utils import timezone
-from django.db.models import Sum, Count, Avg, Q
+from django.db.models import Sum, Count, Avg, Q, F, Case, When, Value, FloatField
+from django.db.models.functions import Cast, Greatest
 from datetime import timedelta
-from .models import FlashSale, FlashSaleProduct, Tag, Product, Coupon, Order, OrderItem, UserCoupon
+from .models import FlashSale, FlashSaleProduct, Tag, Product, Coupon, OrderItem, CouponDailyStat
 from decimal import Decimal
 
 # ==========================================
@@ -164,25 +165,41 @@ def coupon_analytics_api(request):
     if request.user.role not in ['admin', 'super_admin', 'seller']:
         return Response({"error": "Unauthorized"}, status=403)
     
-    # Get all coupons
-    coupons = Coupon.objects.all().order_by('-used_count')
-    
+    # ⚡ Fixed number of queries however many coupons exist:
+    # one summary aggregate, the top 20 rows, one grouped rollup read
+    limit_expr = Greatest(F('total_supply'), F('usage_limit'))
+    summary = Coupon.objects.aggregate(
+        total_coupons=Count('id'),
+        active_coupons=Count('id', filter=Q(active=True)),
+        total_redemptions=Sum('used_count'),
+        avg_redemption_rate=Avg(Case(
+            When(Q(total_supply__gt=0) | Q(usage_limit__gt=0),
+                 then=Cast('used_count', FloatField()) * 100 / limit_expr),
+            default=Value(0.0),
+            output_field=FloatField()
+        ))
+    )
+
+    top_coupons = list(Coupon.objects.order_by('-used_count', 'id')[:20])  # Top 20 by usage
+
+    # Revenue impact (paid orders that used the coupon) from the daily rollup
+    totals = {
+        row['coupon_id']: row
+        for row in CouponDailyStat.objects.filter(coupon__in=top_coupons).values('coupon_id').annotate(
+            total_revenue=Sum('revenue'),
+            total_discount=Sum('discount')
+        )
+    }
+
     coupons_data = []
-    for coupon in coupons:
+    for coupon in top_coupons:
         # Usage limit
-        limit = max(coupon.total_supply, coupon.usage_limit) if hasattr(coupon, 'total_supply') else coupon.usage_limit
+        limit = max(coupon.total_supply, coupon.usage_limit)
         
         # Redemption rate
         redemption_rate = (coupon.used_count / limit * 100) if limit > 0 else 0
         
-        # Revenue impact (orders that used this coupon)
-        orders = Order.objects.filter(coupon=coupon, status__in=['Paid', 'Processing', 'Shipped', 'Completed'])
-        total_revenue = orders.aggregate(total=Sum('total_price'))['total'] or 0
-        total_discount = orders.aggregate(total=Sum('discount_amount'))['total'] or 0
-        
-        # Collection count (how many users collected)
-        collection_count = UserCoupon.objects.filter(coupon=coupon).count()
-        
+        stats = totals.get(coupon.id, {})
         coupons_data.append({
             'id': coupon.id,
             'code': coupon.code,
@@ -191,33 +208,22 @@ def coupon_analytics_api(request):
             'used_count': coupon.used_count,
             'usage_limit': limit,
             'redemption_rate': round(redemption_rate, 2),
-            'total_revenue': float(total_revenue),
-            'total_discount': float(total_discount),
-            'collection_count': collection_count,
+            'total_revenue': float(stats.get('total_revenue') or 0),
+            'total_discount': float(stats.get('total_discount') or 0),
+            'collection_count': coupon.collected_count,  # maintained by CouponService.claim
             'is_active': coupon.active,
             'start_date': coupon.start_date,
             'end_date': coupon.end_date
         })
     
-    # Overall stats
-    total_coupons = coupons.count()
-    active_coupons = coupons.filter(active=True).count()
-    total_redemptions = coupons.aggregate(total=Sum('used_count'))['total'] or 0
-    
-    # Calculate average redemption rate for summary
-    avg_redemption = 0
-    if total_coupons > 0:
-        total_rate = sum(c['redemption_rate'] for c in coupons_data)
-        avg_redemption = total_rate / len(coupons_data) if coupons_data else 0
-    
     return Response({
         'summary': {
-            'total_coupons': total_coupons,
-            'active_coupons': active_coupons,
-            'total_redemptions': total_redemptions,
-            'avg_redemption_rate': round(avg_redemption, 2)
+            'total_coupons': summary['total_coupons'],
+            'active_coupons': summary['active_coupons'],
+            'total_redemptions': summary['total_redemptions'] or 0,
+            'avg_redemption_rate': round(summary['avg_redemption_rate'] or 0, 2)
         },
-        'coupons': coupons_data[:20]  # Top 20 by usage
+        'coupons': coupons_data
     })
 
 
@@ -233,22 +239,21 @@ def coupon_detail_analytics_api(request, coupon_id):
     try:
         coupon = Coupon.objects.get(id=coupon_id)
         
-        # Orders using this coupon
-        orders = Order.objects.filter(
-            coupon=coupon,
-            status__in=['Paid', 'Processing', 'Shipped', 'Completed']
-        ).order_by('-created_at')
-        
-        # Day-by-day usage
+        # Day-by-day usage (last 7 days) and lifetime paid orders from the rollup
+        today = timezone.localdate()
+        week_start = today - timedelta(days=6)
+        daily = dict(
+            CouponDailyStat.objects.filter(coupon=coupon, day__gte=week_start, day__lte=today)
+            .values_list('day', 'uses')
+        )
         usage_by_day = []
-        now = timezone.now()
         for i in range(7):
-            date = (now - timedelta(days=i)).date()
-            daily_usage = orders.filter(created_at__date=date).count()
+            date = week_start + timedelta(days=i)
             usage_by_day.append({
                 'date': date.strftime('%Y-%m-%d'),
-                'usage': daily_usage
+                'usage': daily.get(date, 0)
             })
+        total_uses = CouponDailyStat.objects.filter(coupon=coupon).aggregate(total=Sum('uses'))['total'] or 0
         
         return Response({
             'coupon': {
@@ -257,8 +262,8 @@ def coupon_detail_analytics_api(request, coupon_id):
                 'discount_type': coupon.discount_type,
                 'discount_value': float(coupon.discount_value)
             },
-            'daily_usage': list(reversed(usage_by_day)),
-            'recent_orders_count': orders.count()
+            'daily_usage': usage_by_day,
+            'recent_orders_count': total_uses
         })
     except Coupon.DoesNotExist:
         return Response({"error": "Coupon not found"}, status=404)
@@ -185,7 +185,7 @@ def admin_campaign_api(request, campaign_id=None):
                 elif status_filter == 'ended':
                     campaigns = campaigns.filter(campaign_end__lt=now)
             
-            serializer = FlashSaleCampaignSerializer(campaigns, many=True)
+            serializer = FlashSaleCampaignSerializer(campaigns, many=True, context={'fields': request.query_params.get('fields')})
             return Response(serializer.data)
     
     # POST: Create new campaign
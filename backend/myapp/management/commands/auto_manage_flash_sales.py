@@ -3,15 +3,13 @@ Django Management Command: Auto-Activate/Deactivate Flash Sales
 Usage: python manage.py auto_manage_flash_sales
 
 This command automatically activates and deactivates Flash Sales based on their schedule.
-Should be scheduled to run every minute with cron or celery beat.
+One-shot version of the flash_sales job of run_scheduler (which switches
+sales exactly at start/end); kept for cron setups and manual runs.
 """
 
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from myapp.models import FlashSale, AdminLog
-from django.contrib.auth import get_user_model
-
-User = get_user_model()
+from myapp.services import PromotionSchedulerService
 
 
 class Command(BaseCommand):
@@ -35,23 +33,9 @@ class Command(BaseCommand):
         
         now = timezone.now()
         
-        # Find Flash Sales that should be activated
-        to_activate = FlashSale.objects.filter(
-            is_active=False,
-            start_time__lte=now,
-            end_time__gte=now
-        )
-        
-        # Find Flash Sales that should be deactivated
-        to_deactivate = FlashSale.objects.filter(
-            is_active=True,
-            end_time__lt=now
-        )
-        
-        activate_count = to_activate.count()
-        deactivate_count = to_deactivate.count()
+        to_activate, to_deactivate = PromotionSchedulerService.flash_sale_changes(now)
         
-        if activate_count == 0 and deactivate_count == 0:
+        if not to_activate and not to_deactivate:
             if verbose:
                 self.stdout.write(
                     self.style.SUCCESS('✅ No Flash Sales need status changes.')
@@ -60,82 +44,54 @@ class Command(BaseCommand):
         
         # Show what will be changed
         if verbose or dry_run:
-            if activate_count > 0:
+            if to_activate:
                 self.stdout.write(
-                    self.style.WARNING(f'\n📈 Flash Sales to ACTIVATE ({activate_count}):')
+                    self.style.WARNING(f'\n📈 Flash Sales to ACTIVATE ({len(to_activate)}):')
                 )
-                for fs in to_activate:
-                    self.stdout.write(
-                        f'  - [{fs.id}] {fs.name} '
-                        f'(Started: {fs.start_time.strftime("%Y-%m-%d %H:%M")})'
-                    )
+                for fs_id, name in to_activate:
+                    self.stdout.write(f'  - [{fs_id}] {name}')
             
-            if deactivate_count > 0:
+            if to_deactivate:
                 self.stdout.write(
-                    self.style.WARNING(f'\n📉 Flash Sales to DEACTIVATE ({deactivate_count}):')
+                    self.style.WARNING(f'\n📉 Flash Sales to DEACTIVATE ({len(to_deactivate)}):')
                 )
-                for fs in to_deactivate:
-                    self.stdout.write(
-                        f'  - [{fs.id}] {fs.name} '
-                        f'(Ended: {fs.end_time.strftime("%Y-%m-%d %H:%M")})'
-                    )
+                for fs_id, name in to_deactivate:
+                    self.stdout.write(f'  - [{fs_id}] {name}')
         
         if dry_run:
             self.stdout.write(
                 self.style.WARNING(
-                    f'\n⚠️  DRY RUN: Would change {activate_count + deactivate_count} Flash Sale(s). '
+                    f'\n⚠️  DRY RUN: Would change {len(to_activate) + len(to_deactivate)} Flash Sale(s). '
                     'Run without --dry-run to apply changes.'
                 )
             )
-        else:
-            # Get or create system user for logging
-            system_user = User.objects.filter(username='system').first() or \
-                         User.objects.filter(is_superuser=True).first()
-            
-            # Activate Flash Sales
-            if activate_count > 0:
-                to_activate.update(is_active=True)
-                if system_user:
-                    for fs in to_activate:
-                        AdminLog.objects.create(
-                            admin=system_user,
-                            action=f"Auto-activated Flash Sale: {fs.name} (ID: {fs.id})"
-                        )
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f'✅ Activated {activate_count} Flash Sale(s)'
-                    )
-                )
-            
-            # Deactivate Flash Sales
-            if deactivate_count > 0:
-                # Only deactivate if auto_disable_on_end is True (if field exists)
-                for fs in to_deactivate:
-                    if hasattr(fs, 'auto_disable_on_end') and not fs.auto_disable_on_end:
-                        continue  # Skip if auto-disable is turned off
-                    
-                    fs.is_active = False
-                    fs.save()
-                    
-                    if system_user:
-                        AdminLog.objects.create(
-                            admin=system_user,
-                            action=f"Auto-deactivated Flash Sale: {fs.name} (ID: {fs.id})"
-                        )
-                
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f'✅ Deactivated {deactivate_count} Flash Sale(s)'
-                    )
-                )
-            
-            if verbose:
-                self.stdout.write(
-                    f'\n📊 Summary:'
-                )
-                self.stdout.write(
-                    f'   Activated: {activate_count}'
+            return
+        
+        # Set-based UPDATEs + one AdminLog bulk insert
+        result = PromotionSchedulerService.run(('flash_sales',), now=now)
+        activate_count = len(result['activated'])
+        deactivate_count = len(result['deactivated'])
+        
+        if activate_count > 0:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'✅ Activated {activate_count} Flash Sale(s)'
                 )
-                self.stdout.write(
-                    f'   Deactivated: {deactivate_count}'
+            )
+        if deactivate_count > 0:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'✅ Deactivated {deactivate_count} Flash Sale(s)'
                 )
+            )
+        
+        if verbose:
+            self.stdout.write(
+                f'\n📊 Summary:'
+            )
+            self.stdout.write(
+                f'   Activated: {activate_count}'
+            )
+            self.stdout.write(
+                f'   Deactivated: {deactivate_count}'
+            )
@@ -0,0 +1,87 @@
+"""
+Django Management Command: Backfill Promo Usage Counters
+Usage: python manage.py backfill_promo_usage_counters [--since 2026-01-01] [--dry-run]
+
+Rebuilds PromoUsageCounter rows from the raw PromoUsageLog with one grouped
+query. Only days still covered by the log are rebuilt (default: from the
+oldest remaining log day), so counters of days whose logs were already
+pruned are kept.
+"""
+
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Min
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from myapp.models import PromoUsageLog, PromoUsageCounter
+
+
+class Command(BaseCommand):
+    help = 'Rebuild per-user promo usage counters from PromoUsageLog'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            type=str,
+            default=None,
+            help='First day to rebuild (YYYY-MM-DD, default: oldest log day)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Counters inserted per INSERT',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show what would be written without writing',
+        )
+
+    def handle(self, *args, **options):
+        tz = timezone.get_current_timezone()
+        since = options.get('since')
+        if since:
+            try:
+                since = date.fromisoformat(since)
+            except ValueError:
+                raise CommandError('--since must be YYYY-MM-DD')
+        else:
+            oldest = PromoUsageLog.objects.aggregate(first=Min('timestamp'))['first']
+            if oldest is None:
+                self.stdout.write(self.style.SUCCESS('No promo usage logs found.'))
+                return
+            since = timezone.localdate(oldest)
+
+        # Group the log by (user, promo, local day) in the database
+        rows = (
+            PromoUsageLog.objects.annotate(day=TruncDate('timestamp', tzinfo=tz))
+            .filter(day__gte=since)
+            .values('user_id', 'promo_type', 'promo_id', 'day')
+            .annotate(total=Count('id'))
+            .order_by()
+        )
+        counters = [
+            PromoUsageCounter(
+                user_id=r['user_id'],
+                promo_type=r['promo_type'],
+                promo_id=r['promo_id'],
+                day=r['day'],
+                count=r['total']
+            )
+            for r in rows
+        ]
+
+        if options.get('dry_run'):
+            self.stdout.write(f'🔍 Would rebuild {len(counters)} counter(s) from {since}')
+            return
+
+        with transaction.atomic():
+            deleted, _ = PromoUsageCounter.objects.filter(day__gte=since).delete()
+            PromoUsageCounter.objects.bulk_create(counters, batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ Rebuilt {len(counters)} counter(s) from {since} (replaced {deleted})'
+        ))
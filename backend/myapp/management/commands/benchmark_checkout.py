@@ -0,0 +1,261 @@
+"""
+Django Management Command: Checkout Concurrency Benchmark
+Usage: python manage.py benchmark_checkout [--users 50] [--requests 200]
+                                           [--concurrency 16] [--pool thread|process]
+                                           [--engine batched] [--output result.json]
+
+Seeds N buyers and one hot Flash Sale product, then drives create_order
+(POST /api/checkout/) from a thread or process pool. Reports throughput,
+p50/p95/p99 latency, deadlock/retry counts and whether stock / sold_count
+stayed consistent (no oversell). Results are written as JSON so runs with
+different engines or settings can be compared.
+
+⚠️ Writes real rows (users, product, flash sale, orders). Run it against a
+scratch database; --cleanup removes the seeded data afterwards.
+"""
+
+import json
+import multiprocessing
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Sum
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from myapp.models import User, Product, FlashSale, FlashSaleProduct, Order, OrderItem
+
+# Error texts of lock conflicts that are worth retrying (MySQL / SQLite)
+RETRYABLE_ERRORS = ('deadlock', 'lock wait timeout', 'database is locked')
+
+
+def _checkout_once(user_id, product_id, quantity, max_retries, close_connection=True):
+    """One buyer checkout through the real view, retried on lock conflicts."""
+    user = User.objects.get(id=user_id)
+    client = APIClient()
+    client.force_authenticate(user=user)
+    payload = {
+        "items": [{"id": product_id, "quantity": quantity}],
+        "customer": {
+            "name": user.username,
+            "phone": "0812345678",
+            "address": "Benchmark Rd",
+            "province": "Bangkok"
+        }
+    }
+
+    retries = 0
+    deadlocks = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            response = client.post('/api/checkout/', payload, format='json')
+            error = str(response.data.get('error', '')).lower() if response.status_code != 201 else ''
+            if any(e in error for e in RETRYABLE_ERRORS):
+                deadlocks += 1
+                if retries < max_retries:
+                    retries += 1
+                    time.sleep(0.01 * retries) # Linear backoff before retrying
+                    continue
+            return {
+                "status": response.status_code,
+                "latency_ms": (time.perf_counter() - started) * 1000,
+                "retries": retries,
+                "deadlocks": deadlocks,
+                "error": error
+            }
+    finally:
+        if close_connection:
+            connections.close_all()
+
+
+def _close_connections():
+    # Process pool initializer: never reuse the parent's DB sockets
+    connections.close_all()
+
+
+def _percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0
+    rank = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark create_order under concurrent load and verify there is no oversell'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Buyers to seed')
+        parser.add_argument('--requests', type=int, default=200, help='Checkout requests to send')
+        parser.add_argument('--concurrency', type=int, default=16, help='Parallel workers (1 = serial, in-process)')
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread', help='Worker pool type')
+        parser.add_argument('--stock', type=int, default=1000, help='Product stock of the hot SKU')
+        parser.add_argument('--quota', type=int, default=100, help='Flash Sale quantity_limit of the hot SKU')
+        parser.add_argument('--quantity', type=int, default=1, help='Units per checkout')
+        parser.add_argument('--retries', type=int, default=3, help='Max retries on deadlock / lock timeout')
+        parser.add_argument('--engine', choices=['row_lock', 'batched', 'conditional'], default=None,
+                            help='Override CHECKOUT_STOCK_ENGINE for this run')
+        parser.add_argument('--output', type=str, default=None, help='Write results to this JSON file')
+        parser.add_argument('--cleanup', action='store_true', help='Delete seeded data after the run')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--users, --requests and --concurrency must be positive')
+
+        engine = options['engine'] or settings.CHECKOUT_STOCK_ENGINE
+        with override_settings(CHECKOUT_STOCK_ENGINE=engine):
+            run_id = uuid.uuid4().hex[:8]
+            user_ids, product, fs_product = self._seed(run_id, options)
+            self.stdout.write(
+                f"🚀 Benchmark {run_id}: {options['requests']} checkouts, {len(user_ids)} users, "
+                f"concurrency {options['concurrency']} ({options['pool']}), engine '{engine}'"
+            )
+
+            results, elapsed = self._drive(user_ids, product.id, options)
+            report = self._report(run_id, engine, options, results, elapsed, product, fs_product)
+
+            if options['cleanup']:
+                self._cleanup(user_ids, product)
+
+        self._print(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f"✅ Results written to {options['output']}"))
+
+    def _seed(self, run_id, options):
+        now = timezone.now()
+        User.objects.bulk_create([
+            User(username=f'bench_{run_id}_{i}', email=f'bench_{run_id}_{i}@bench.local', role='customer')
+            for i in range(options['users'])
+        ])
+        user_ids = list(
+            User.objects.filter(username__startswith=f'bench_{run_id}_').order_by('id').values_list('id', flat=True)
+        )
+        product = Product.objects.create(
+            title=f'Benchmark Hot SKU {run_id}',
+            price=Decimal('1000.00'),
+            stock=options['stock']
+        )
+        flash_sale = FlashSale.objects.create(
+            name=f'Benchmark Sale {run_id}',
+            start_time=now - timedelta(minutes=1),
+            end_time=now + timedelta(hours=1),
+            is_active=True
+        )
+        fs_product = FlashSaleProduct.objects.create(
+            flash_sale=flash_sale,
+            product=product,
+            sale_price=Decimal('1.00'),
+            quantity_limit=options['quota']
+        )
+        return user_ids, product, fs_product
+
+    def _drive(self, user_ids, product_id, options):
+        jobs = [
+            (user_ids[i % len(user_ids)], product_id, options['quantity'], options['retries'])
+            for i in range(options['requests'])
+        ]
+
+        started = time.perf_counter()
+        if options['concurrency'] == 1:
+            results = [_checkout_once(*job, close_connection=False) for job in jobs]
+        else:
+            if options['pool'] == 'process':
+                connections.close_all()
+                # fork: children inherit the configured Django app (and the engine override)
+                pool = ProcessPoolExecutor(
+                    max_workers=options['concurrency'],
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_close_connections
+                )
+            else:
+                pool = ThreadPoolExecutor(max_workers=options['concurrency'])
+            with pool:
+                results = list(pool.map(_checkout_once, *zip(*jobs)))
+        return results, time.perf_counter() - started
+
+    def _report(self, run_id, engine, options, results, elapsed, product, fs_product):
+        latencies = sorted(r['latency_ms'] for r in results)
+        succeeded = [r for r in results if r['status'] == 201]
+        errors = {}
+        for r in results:
+            if r['status'] != 201:
+                errors[r['error'] or str(r['status'])] = errors.get(r['error'] or str(r['status']), 0) + 1
+
+        product.refresh_from_db()
+        fs_product.refresh_from_db()
+        ordered = OrderItem.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0
+        flash_ordered = OrderItem.objects.filter(
+            product=product, promotion_source='flash_sale'
+        ).aggregate(total=Sum('quantity'))['total'] or 0
+
+        consistency = {
+            "initial_stock": options['stock'],
+            "final_stock": product.stock,
+            "units_ordered": ordered,
+            "stock_matches_orders": options['stock'] - product.stock == ordered,
+            "quota": fs_product.quantity_limit,
+            "sold_count": fs_product.sold_count,
+            "sold_count_matches_orders": fs_product.sold_count == flash_ordered,
+            "oversold": product.stock < 0 or fs_product.sold_count > fs_product.quantity_limit,
+        }
+        consistency["ok"] = (
+            consistency["stock_matches_orders"]
+            and consistency["sold_count_matches_orders"]
+            and not consistency["oversold"]
+        )
+
+        return {
+            "run_id": run_id,
+            "engine": engine,
+            "pool": options['pool'],
+            "concurrency": options['concurrency'],
+            "users": options['users'],
+            "requests": len(results),
+            "succeeded": len(succeeded),
+            "rejected": len(results) - len(succeeded),
+            "errors": errors,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_rps": round(len(results) / elapsed, 2) if elapsed else 0,
+            "orders_per_second": round(len(succeeded) / elapsed, 2) if elapsed else 0,
+            "latency_ms": {
+                "p50": round(_percentile(latencies, 50), 2),
+                "p95": round(_percentile(latencies, 95), 2),
+                "p99": round(_percentile(latencies, 99), 2),
+                "max": round(latencies[-1], 2) if latencies else 0,
+            },
+            "deadlocks": sum(r['deadlocks'] for r in results),
+            "retries": sum(r['retries'] for r in results),
+            "consistency": consistency,
+        }
+
+    def _cleanup(self, user_ids, product):
+        Order.objects.filter(user_id__in=user_ids).delete()
+        FlashSale.objects.filter(products__product=product).delete()
+        product.delete()
+        User.objects.filter(id__in=user_ids).delete()
+
+    def _print(self, report):
+        self.stdout.write(f"   Requests:   {report['requests']} ({report['succeeded']} ok, {report['rejected']} rejected)")
+        self.stdout.write(f"   Throughput: {report['throughput_rps']} req/s, {report['orders_per_second']} orders/s")
+        lat = report['latency_ms']
+        self.stdout.write(f"   Latency:    p50 {lat['p50']}ms | p95 {lat['p95']}ms | p99 {lat['p99']}ms")
+        self.stdout.write(f"   Deadlocks:  {report['deadlocks']} (retries {report['retries']})")
+        c = report['consistency']
+        self.stdout.write(
+            f"   Stock:      {c['initial_stock']} -> {c['final_stock']} ({c['units_ordered']} ordered), "
+            f"sold_count {c['sold_count']}/{c['quota']}"
+        )
+        if c['ok']:
+            self.stdout.write(self.style.SUCCESS('✅ Consistent: no oversell'))
+        else:
+            self.stdout.write(self.style.ERROR('❌ Inconsistent stock / sold_count'))
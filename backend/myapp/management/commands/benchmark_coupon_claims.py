@@ -0,0 +1,212 @@
+"""
+Django Management Command: Coupon Claim-Storm Benchmark
+Usage: python manage.py benchmark_coupon_claims [--users 200] [--supply 50]
+                                                [--concurrency 16] [--pool thread|process]
+                                                [--output result.json]
+
+Seeds N customers and one coupon with a small total_supply, then has every
+user (plus --repeat extra attempts each) hit collect_coupon_api
+(POST /api/coupons/<id>/collect/) at once. Reports claims/s, p50/p95/p99
+latency and whether the supply held: UserCoupon rows == collected_count
+<= supply and nobody holds the coupon twice (zero over-issue).
+
+⚠️ Writes real rows (users, coupon, wallet entries). Run it against a
+scratch database; --cleanup removes the seeded data afterwards.
+"""
+
+import json
+import multiprocessing
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from myapp.models import User, Coupon, UserCoupon
+from myapp.management.commands.benchmark_checkout import _percentile, _close_connections
+
+
+def _claim_once(user_id, coupon_id, max_retries, close_connection=True):
+    """One collect request through the real view, retried on server errors (lock conflicts)."""
+    client = APIClient()
+    client.force_authenticate(user=User.objects.get(id=user_id))
+
+    retries = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            response = client.post(f'/api/coupons/{coupon_id}/collect/')
+            # collect_coupon_api hides DB errors behind a 500; under a storm these are lock timeouts
+            if response.status_code >= 500 and retries < max_retries:
+                retries += 1
+                time.sleep(0.01 * retries) # Linear backoff before retrying
+                continue
+            return {
+                "status": response.status_code,
+                "latency_ms": (time.perf_counter() - started) * 1000,
+                "retries": retries,
+                "message": str(response.data.get('message', '')) if response.status_code != 200 else ''
+            }
+    finally:
+        if close_connection:
+            connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark collect_coupon_api under a claim storm and verify there is no over-issue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200, help='Customers to seed')
+        parser.add_argument('--supply', type=int, default=50, help='Coupon total_supply')
+        parser.add_argument('--repeat', type=int, default=1, help='Extra claim attempts per user (duplicates)')
+        parser.add_argument('--concurrency', type=int, default=16, help='Parallel workers (1 = serial, in-process)')
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread', help='Worker pool type')
+        parser.add_argument('--retries', type=int, default=3, help='Max retries on server errors')
+        parser.add_argument('--output', type=str, default=None, help='Write results to this JSON file')
+        parser.add_argument('--cleanup', action='store_true', help='Delete seeded data after the run')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['supply'] < 1 or options['concurrency'] < 1 or options['repeat'] < 0:
+            raise CommandError('--users, --supply and --concurrency must be positive')
+
+        run_id = uuid.uuid4().hex[:8]
+        user_ids, coupon = self._seed(run_id, options)
+        attempts = len(user_ids) * (1 + options['repeat'])
+        self.stdout.write(
+            f"🚀 Claim storm {run_id}: {attempts} claims, {len(user_ids)} users, supply {options['supply']}, "
+            f"concurrency {options['concurrency']} ({options['pool']})"
+        )
+
+        results, elapsed = self._drive(user_ids, coupon.id, options)
+        report = self._report(run_id, options, results, elapsed, coupon)
+
+        if options['cleanup']:
+            coupon.delete()
+            User.objects.filter(id__in=user_ids).delete()
+
+        self._print(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f"✅ Results written to {options['output']}"))
+
+    def _seed(self, run_id, options):
+        now = timezone.now()
+        User.objects.bulk_create([
+            User(username=f'claim_{run_id}_{i}', email=f'claim_{run_id}_{i}@bench.local', role='customer')
+            for i in range(options['users'])
+        ])
+        user_ids = list(
+            User.objects.filter(username__startswith=f'claim_{run_id}_').order_by('id').values_list('id', flat=True)
+        )
+        coupon = Coupon.objects.create(
+            code=f'STORM{run_id}'.upper(),
+            discount_type='fixed',
+            discount_value=Decimal('10.00'),
+            start_date=now - timedelta(minutes=1),
+            end_date=now + timedelta(hours=1),
+            usage_limit=options['supply'],
+            total_supply=options['supply'],
+            limit_per_user=1,
+            active=True
+        )
+        return user_ids, coupon
+
+    def _drive(self, user_ids, coupon_id, options):
+        jobs = [
+            (user_id, coupon_id, options['retries'])
+            for _ in range(1 + options['repeat'])
+            for user_id in user_ids
+        ]
+
+        started = time.perf_counter()
+        if options['concurrency'] == 1:
+            results = [_claim_once(*job, close_connection=False) for job in jobs]
+        else:
+            if options['pool'] == 'process':
+                connections.close_all()
+                pool = ProcessPoolExecutor(
+                    max_workers=options['concurrency'],
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_close_connections
+                )
+            else:
+                pool = ThreadPoolExecutor(max_workers=options['concurrency'])
+            with pool:
+                results = list(pool.map(_claim_once, *zip(*jobs)))
+        return results, time.perf_counter() - started
+
+    def _report(self, run_id, options, results, elapsed, coupon):
+        latencies = sorted(r['latency_ms'] for r in results)
+        claimed = [r for r in results if r['status'] == 200]
+        errors = {}
+        for r in results:
+            if r['status'] != 200:
+                key = r['message'] or str(r['status'])
+                errors[key] = errors.get(key, 0) + 1
+
+        coupon.refresh_from_db()
+        supply = max(coupon.total_supply, coupon.usage_limit)
+        wallet_rows = UserCoupon.objects.filter(coupon=coupon).count()
+        duplicate_holders = UserCoupon.objects.filter(coupon=coupon).values('user').annotate(
+            n=Count('id')
+        ).filter(n__gt=1).count()
+
+        consistency = {
+            "supply": supply,
+            "collected_count": coupon.collected_count,
+            "wallet_rows": wallet_rows,
+            "successful_claims": len(claimed),
+            "counter_matches_wallet": coupon.collected_count == wallet_rows == len(claimed),
+            "duplicate_holders": duplicate_holders,
+            "over_issued": max(wallet_rows - supply, 0),
+        }
+        consistency["ok"] = (
+            consistency["counter_matches_wallet"]
+            and not consistency["duplicate_holders"]
+            and not consistency["over_issued"]
+        )
+
+        return {
+            "run_id": run_id,
+            "pool": options['pool'],
+            "concurrency": options['concurrency'],
+            "users": options['users'],
+            "requests": len(results),
+            "claimed": len(claimed),
+            "rejected": len(results) - len(claimed),
+            "errors": errors,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_rps": round(len(results) / elapsed, 2) if elapsed else 0,
+            "claims_per_second": round(len(claimed) / elapsed, 2) if elapsed else 0,
+            "latency_ms": {
+                "p50": round(_percentile(latencies, 50), 2),
+                "p95": round(_percentile(latencies, 95), 2),
+                "p99": round(_percentile(latencies, 99), 2),
+                "max": round(latencies[-1], 2) if latencies else 0,
+            },
+            "retries": sum(r['retries'] for r in results),
+            "consistency": consistency,
+        }
+
+    def _print(self, report):
+        self.stdout.write(f"   Requests:   {report['requests']} ({report['claimed']} claimed, {report['rejected']} rejected)")
+        self.stdout.write(f"   Throughput: {report['throughput_rps']} req/s, {report['claims_per_second']} claims/s")
+        lat = report['latency_ms']
+        self.stdout.write(f"   Latency:    p50 {lat['p50']}ms | p95 {lat['p95']}ms | p99 {lat['p99']}ms")
+        self.stdout.write(f"   Retries:    {report['retries']}")
+        c = report['consistency']
+        self.stdout.write(
+            f"   Supply:     {c['collected_count']}/{c['supply']} collected, {c['wallet_rows']} wallet rows, "
+            f"{c['duplicate_holders']} duplicate holder(s)"
+        )
+        if c['ok']:
+            self.stdout.write(self.style.SUCCESS('✅ Consistent: zero over-issue'))
+        else:
+            self.stdout.write(self.style.ERROR(f"❌ Over-issued by {c['over_issued']} / counter drift"))
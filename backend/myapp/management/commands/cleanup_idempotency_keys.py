@@ -0,0 +1,19 @@
+"""
+Django Management Command: Cleanup Checkout Idempotency Keys
+Usage: python manage.py cleanup_idempotency_keys
+
+Deletes Idempotency-Key records older than CHECKOUT_IDEMPOTENCY_TTL_HOURS.
+Expired keys are already ignored by checkout; this only keeps the table small.
+Can be scheduled with cron or celery beat.
+"""
+
+from django.core.management.base import BaseCommand
+from myapp.services import IdempotencyService
+
+
+class Command(BaseCommand):
+    help = 'Delete expired checkout Idempotency-Key records'
+
+    def handle(self, *args, **options):
+        deleted = IdempotencyService.purge_expired()
+        self.stdout.write(self.style.SUCCESS(f'✅ Deleted {deleted} expired idempotency key(s)'))
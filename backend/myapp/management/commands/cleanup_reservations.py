@@ -1,37 +1,63 @@
+"""
+Django Management Command: Cleanup Expired Stock Reservations
+Usage: python manage.py cleanup_reservations [--daemon] [--batch-size 500]
+
+Gives expired holds back (product stock + Flash Sale reserved_stock) with one
+aggregated UPDATE per table and one DELETE per batch. With --daemon the
+command keeps running and sleeps exactly until the next expires_at, so quota
+comes back seconds after a hold lapses instead of waiting for cron.
+run_scheduler runs the same sweep next to the flash sale and tag jobs.
+"""
+
+import time
+
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from django.db.models import F
-from myapp.models import StockReservation, FlashSaleProduct
+from myapp.services import ReservationService
 
 class Command(BaseCommand):
     help = 'Cleans up expired stock reservations and returns usage to pool.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--daemon',
+            action='store_true',
+            help='Keep running and sweep every time a reservation expires',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Reservations released per transaction (default: RESERVATION_SWEEP_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--max-sleep',
+            type=float,
+            default=60,
+            help='Upper bound in seconds between sweeps in daemon mode',
+        )
+
     def handle(self, *args, **options):
-        now = timezone.now()
-        expired_reservations = StockReservation.objects.filter(expires_at__lte=now)
-        
-        count = expired_reservations.count()
-        if count == 0:
-            self.stdout.write(self.style.SUCCESS('No expired reservations found.'))
+        batch_size = options.get('batch_size')
+
+        if not options.get('daemon'):
+            released = ReservationService.release_expired(batch_size=batch_size)
+            if released == 0:
+                self.stdout.write(self.style.SUCCESS('No expired reservations found.'))
+                return
+            self.stdout.write(self.style.SUCCESS(f'Successfully cleaned up {released} expired reservations.'))
             return
 
-        self.stdout.write(f"Found {count} expired reservations. Cleaning up...")
-
-        # Process Flash Sale Reservations specifically
-        # We need to decrement reserved_stock on the FS product
-        fs_reservations = expired_reservations.filter(flash_sale_product__isnull=False)
-        
-        for res in fs_reservations:
-            fs_prod = res.flash_sale_product
-            qty = res.quantity
-            
-            # Decrement reserved stock safely
-            # Note: Checking if > 0 is good but F() might go negative if db inconsistent. 
-            # We assume it's correct.
-            fs_prod.reserved_stock = F('reserved_stock') - qty
-            fs_prod.save()
-            
-        # Bulk Delete all expired (Normal & Flash Sale)
-        deleted_count, _ = expired_reservations.delete()
-
-        self.stdout.write(self.style.SUCCESS(f'Successfully cleaned up {deleted_count} expired reservations.'))
+        max_sleep = options.get('max_sleep')
+        self.stdout.write('⏳ Reservation sweeper started')
+        try:
+            while True:
+                released = ReservationService.release_expired(batch_size=batch_size)
+                if released:
+                    self.stdout.write(self.style.SUCCESS(f'✅ Released {released} expired reservations'))
+
+                now = timezone.now()
+                wait = (ReservationService.next_wakeup(now) - now).total_seconds()
+                time.sleep(min(max(wait, 0.05), max_sleep))
+        except KeyboardInterrupt:
+            self.stdout.write('Sweeper stopped')
@@ -0,0 +1,40 @@
+"""
+Django Management Command: Compile Flash Sale Rounds
+Usage: python manage.py compile_flash_sale_rounds [--all]
+
+Rebuilds the flash_sale_rounds table (absolute round intervals in the shop
+timezone) from FlashSale.rounds. Saving a sale compiles its rounds
+automatically and migration 0044 backfills existing sales; run this after
+editing rounds with raw SQL / queryset .update().
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from myapp.models import FlashSale
+from myapp.services import FlashSaleService, PromotionIndex
+
+
+class Command(BaseCommand):
+    help = 'Compile FlashSale.rounds into absolute FlashSaleRound intervals'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Include sales that have already ended',
+        )
+
+    def handle(self, *args, **options):
+        sales = FlashSale.objects.all()
+        if not options.get('all'):
+            sales = sales.filter(end_time__gte=timezone.now())
+
+        compiled = 0
+        with transaction.atomic():
+            for sale in sales.only('id', 'rounds', 'start_time', 'end_time'):
+                FlashSaleService.compile_rounds(sale)
+                compiled += 1
+        PromotionIndex.invalidate()
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Compiled rounds of {compiled} Flash Sale(s)'))
@@ -0,0 +1,62 @@
+"""
+Django Management Command: Prune Promo Usage Logs
+Usage: python manage.py prune_promo_usage_logs [--days 180] [--dry-run]
+
+Retention policy for the raw PromoUsageLog. Limit checks read
+PromoUsageCounter, so whole days older than the retention window can be
+deleted (in batches) without changing any user's remaining quota.
+Can be scheduled with cron or celery beat.
+"""
+
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from myapp.models import PromoUsageLog
+
+
+class Command(BaseCommand):
+    help = 'Delete PromoUsageLog rows older than the retention window'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=None,
+            help='Days of raw log to keep (default: PROMO_USAGE_LOG_RETENTION_DAYS)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows deleted per statement',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show what would be deleted without deleting',
+        )
+
+    def handle(self, *args, **options):
+        days = options.get('days') or settings.PROMO_USAGE_LOG_RETENTION_DAYS
+        batch_size = options['batch_size']
+
+        # Cut at local midnight so a day is either fully kept or fully pruned
+        cutoff_day = timezone.localdate() - timedelta(days=days)
+        cutoff = timezone.make_aware(datetime.combine(cutoff_day, time.min))
+        expired = PromoUsageLog.objects.filter(timestamp__lt=cutoff)
+
+        if options.get('dry_run'):
+            self.stdout.write(f'🔍 Would delete {expired.count()} log row(s) before {cutoff_day}')
+            return
+
+        total = 0
+        while True:
+            ids = list(expired.order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            deleted, _ = PromoUsageLog.objects.filter(id__in=ids).delete()
+            total += deleted
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Deleted {total} promo usage log row(s) before {cutoff_day}'))
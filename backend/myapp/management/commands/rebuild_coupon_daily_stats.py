@@ -0,0 +1,29 @@
+"""
+Django Management Command: Rebuild Coupon Daily Stats
+Usage: python manage.py rebuild_coupon_daily_stats [--coupon 12 --coupon 15]
+
+Recomputes the coupon_daily_stats rollup (uses, revenue, discount and
+collections per coupon per day) from one grouped query over orders and one
+over wallet rows. Run once after migrating, or to repair drift caused by
+raw SQL / queryset .update() calls that bypass the incremental signals.
+"""
+
+from django.core.management.base import BaseCommand
+from myapp.services import CouponStatsService
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the coupon_daily_stats rollup from orders and wallet rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--coupon',
+            type=int,
+            action='append',
+            default=None,
+            help='Only rebuild this coupon id (repeatable, default: all coupons)',
+        )
+
+    def handle(self, *args, **options):
+        written = CouponStatsService.rebuild(options.get('coupon'))
+        self.stdout.write(self.style.SUCCESS(f'✅ Rebuilt {written} coupon daily stat row(s)'))
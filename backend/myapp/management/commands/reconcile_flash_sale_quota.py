@@ -0,0 +1,45 @@
+"""
+Django Management Command: Reconcile Flash Sale Admission Quota
+Usage: python manage.py reconcile_flash_sale_quota [--interval 5]
+
+Re-syncs the quota token counters used by FlashSaleAdmissionService with
+sold_count/reserved_stock of every live FlashSaleProduct (one query + one
+batched cache write). Only useful when CACHES points at a shared store
+(Redis/Memcached); with LocMemCache each web process reconciles itself.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from myapp.services import FlashSaleAdmissionService
+
+
+class Command(BaseCommand):
+    help = 'Reconcile Flash Sale admission quota tokens with the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=0,
+            help='Keep running and reconcile every N seconds (0 = run once)',
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            help='Show detailed output',
+        )
+
+    def handle(self, *args, **options):
+        interval = options.get('interval', 0)
+        verbose = options.get('verbose', False)
+
+        while True:
+            live_map = FlashSaleAdmissionService.reconcile()
+            if verbose or not interval:
+                self.stdout.write(
+                    self.style.SUCCESS(f'✅ Reconciled {len(live_map)} live Flash Sale product(s)')
+                )
+            if not interval:
+                return
+            time.sleep(interval)
@@ -3,12 +3,13 @@ Django Management Command: Remove Expired Tags
 Usage: python manage.py remove_expired_tags
 
 This command automatically removes tags that have passed their expiration_date.
-Can be scheduled with cron or celery beat.
+One-shot version of the tags job of run_scheduler (which removes them at
+local midnight after expiration_date); kept for cron setups and manual runs.
 """
 
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from myapp.models import Tag
+from myapp.services import PromotionSchedulerService
 
 
 class Command(BaseCommand):
@@ -33,10 +34,7 @@ class Command(BaseCommand):
         now = timezone.now()
         
         # Find expired tags
-        expired_tags = Tag.objects.filter(
-            expiration_date__isnull=False,
-            expiration_date__lt=now
-        )
+        expired_tags = PromotionSchedulerService.expired_tags(now)
         
         count = expired_tags.count()
         
@@ -53,7 +51,7 @@ class Command(BaseCommand):
             for tag in expired_tags:
                 self.stdout.write(
                     f'  - {tag.name} ({tag.get_group_name_display()}) '
-                    f'expired on {tag.expiration_date.strftime("%Y-%m-%d %H:%M")}'
+                    f'expired on {tag.expiration_date.strftime("%Y-%m-%d")}'
                 )
         
         if dry_run:
@@ -64,15 +62,10 @@ class Command(BaseCommand):
                 )
             )
         else:
-            # Delete expired tags
-            deleted = expired_tags.delete()
+            # Delete expired tags (one DELETE + one AdminLog bulk insert)
+            removed = PromotionSchedulerService.run(('tags',), now=now)['tags']
             self.stdout.write(
                 self.style.SUCCESS(
-                    f'✅ Successfully removed {count} expired tag(s)'
+                    f'✅ Successfully removed {len(removed)} expired tag(s)'
                 )
             )
-            
-            if verbose:
-                self.stdout.write(
-                    f'   Deleted objects: {deleted}'
-                )
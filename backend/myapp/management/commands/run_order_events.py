@@ -0,0 +1,57 @@
+"""
+Django Management Command: Run Order Events Worker
+Usage: python manage.py run_order_events [--batch-size 200] [--once]
+
+Drains the order outbox written by checkout (OrderEvent) and applies the
+side effects that used to run inside the checkout transaction: profile
+auto-save, new_user -> customer, PromoUsageLog, StockHistory and the
+order notification. Each batch is one short transaction.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from myapp.services import OrderEventService
+
+
+class Command(BaseCommand):
+    help = 'Process pending order events (checkout outbox)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Events per transaction (default: ORDER_EVENTS_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--idle-sleep',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the queue is empty',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the queue once and exit',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size')
+        idle_sleep = options.get('idle_sleep')
+        once = options.get('once', False)
+
+        total = 0
+        try:
+            while True:
+                processed = OrderEventService.process_batch(batch_size=batch_size)
+                total += processed
+                if processed:
+                    continue
+                if once:
+                    break
+                time.sleep(idle_sleep)
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Processed {total} order event(s)'))
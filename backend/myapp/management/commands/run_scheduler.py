@@ -0,0 +1,156 @@
+"""
+Django Management Command: Promotion Scheduler Daemon
+Usage: python manage.py run_scheduler [--jobs flash_sales,tags,reservations]
+                                      [--max-sleep 60] [--once]
+
+One long-running process for the cron jobs auto_manage_flash_sales,
+remove_expired_tags and cleanup_reservations. It keeps a timer wheel of the
+next boundary of every job (flash sale start/end, tag expiration_date,
+reservation expires_at) and sleeps exactly until the earliest one, so sales
+flip on time to the second and the database is not polled every minute.
+
+Promotion writes bump the PromotionIndex version in the Django cache; the
+daemon checks it while sleeping and re-plans the flash sale job, so a sale
+created a few seconds before its start is still switched on time. A
+per-process cache (LocMemCache, CACHE_IS_SHARED=False) never carries the web
+workers' bumps, so the daemon then reads the next sale boundary from the
+database on every --poll tick instead (two indexed LIMIT 1 queries). Every
+other boundary is re-read at least every --max-sleep seconds.
+"""
+
+import heapq
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils import timezone
+from myapp.services import PromotionSchedulerService, PromotionIndex
+
+
+class Command(BaseCommand):
+    help = 'Run flash sale / tag / reservation housekeeping exactly at their boundaries'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--jobs',
+            type=str,
+            default=','.join(PromotionSchedulerService.JOBS),
+            help='Comma-separated jobs to run (default: all)',
+        )
+        parser.add_argument(
+            '--max-sleep',
+            type=float,
+            default=60,
+            help='Re-read every boundary from the database at least this often (seconds)',
+        )
+        parser.add_argument(
+            '--poll',
+            type=float,
+            default=1.0,
+            help='How often to check for flash sale changes while sleeping (seconds)',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Apply whatever is due now and exit',
+        )
+
+    def handle(self, *args, **options):
+        jobs = tuple(j.strip() for j in options['jobs'].split(',') if j.strip())
+        unknown = set(jobs) - set(PromotionSchedulerService.JOBS)
+        if not jobs or unknown:
+            raise CommandError(f"Unknown job(s): {', '.join(sorted(unknown)) or '-'}")
+
+        self._run(jobs)
+        if options['once']:
+            return
+
+        max_sleep = options['max_sleep']
+        poll = options['poll']
+        self.stdout.write(f"⏰ Scheduler started ({', '.join(jobs)})")
+        try:
+            self._loop(jobs, max_sleep, poll)
+        except KeyboardInterrupt:
+            self.stdout.write('Scheduler stopped')
+
+    def _loop(self, jobs, max_sleep, poll):
+        wheel = [] # heap of (when, job); stale entries are skipped via `due`
+        due = {}
+
+        def schedule(job, when):
+            if job in due and due[job] == when:
+                return # Already on the wheel
+            due[job] = when
+            if when is not None:
+                heapq.heappush(wheel, (when, job))
+
+        def plan(planned_jobs):
+            boundaries = PromotionSchedulerService.next_boundaries()
+            for job in planned_jobs:
+                schedule(job, boundaries[job])
+
+        plan(jobs)
+        refreshed_at = time.monotonic()
+        version = cache.get(PromotionIndex.VERSION_KEY)
+
+        while True:
+            while wheel and due.get(wheel[0][1]) != wheel[0][0]:
+                heapq.heappop(wheel)
+
+            now = timezone.now()
+            wait = max_sleep - (time.monotonic() - refreshed_at)
+            if wheel:
+                wait = min(wait, (wheel[0][0] - now).total_seconds())
+
+            if wait > 0:
+                time.sleep(min(wait, poll))
+                if 'flash_sales' not in jobs:
+                    continue
+                if settings.CACHE_IS_SHARED:
+                    current = cache.get(PromotionIndex.VERSION_KEY)
+                    if current != version:
+                        version = current
+                        close_old_connections()
+                        plan(('flash_sales',))
+                else:
+                    # The web workers' version bumps never reach this process: ask the database.
+                    # Only ever move the wake-up earlier: a boundary that has just passed is no
+                    # longer "next" but still has to fire (an early wake-up only costs a re-plan)
+                    close_old_connections()
+                    when = PromotionSchedulerService.next_flash_sale_boundary()
+                    if when is not None and (due.get('flash_sales') is None or when < due['flash_sales']):
+                        schedule('flash_sales', when)
+                continue
+
+            close_old_connections()
+            now = timezone.now()
+            fired = set()
+            while wheel and wheel[0][0] <= now:
+                _, job = heapq.heappop(wheel)
+                if due.get(job) is not None and due[job] <= now:
+                    fired.add(job)
+                    due[job] = None
+            if fired:
+                self._run(tuple(j for j in jobs if j in fired), now)
+
+            if time.monotonic() - refreshed_at >= max_sleep:
+                plan(jobs)
+                refreshed_at = time.monotonic()
+            elif fired:
+                plan(tuple(fired))
+            version = cache.get(PromotionIndex.VERSION_KEY)
+
+    def _run(self, jobs, now=None):
+        result = PromotionSchedulerService.run(jobs, now=now)
+        stamp = timezone.localtime().strftime('%Y-%m-%d %H:%M:%S')
+        if result['activated']:
+            self.stdout.write(self.style.SUCCESS(f"[{stamp}] ✅ Activated {len(result['activated'])} Flash Sale(s)"))
+        if result['deactivated']:
+            self.stdout.write(self.style.SUCCESS(f"[{stamp}] ✅ Deactivated {len(result['deactivated'])} Flash Sale(s)"))
+        if result['tags']:
+            self.stdout.write(self.style.SUCCESS(f"[{stamp}] ✅ Removed {len(result['tags'])} expired tag(s)"))
+        if result['reservations']:
+            self.stdout.write(self.style.SUCCESS(f"[{stamp}] ✅ Released {result['reservations']} expired reservations"))
+        return result
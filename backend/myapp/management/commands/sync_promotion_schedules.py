@@ -0,0 +1,68 @@
+"""
+Django Management Command: Rebuild the Promotion Calendar
+Usage: python manage.py sync_promotion_schedules [--conflicts]
+
+Rewrites promotion_schedules from the current flash sales and active coupons
+(one row each; saves keep it in sync afterwards). Run once after deploying
+the conflict engine, or whenever rows were written around the ORM signals.
+--conflicts prints the overlaps that have no winner by priority.
+"""
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from myapp.models import Coupon, FlashSale, FlashSaleProduct, PromotionSchedule
+from myapp.services import PromotionConflictService, PromotionIndex
+
+
+class Command(BaseCommand):
+    help = 'Rebuild PromotionSchedule rows from flash sales and coupons'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--conflicts',
+            action='store_true',
+            help='List unresolved conflicts (same priority) after the rebuild',
+        )
+
+    def handle(self, *args, **options):
+        products = defaultdict(list)
+        for sale_id, product_id in FlashSaleProduct.objects.values_list('flash_sale_id', 'product_id'):
+            products[sale_id].append(product_id)
+
+        rows = [
+            PromotionSchedule(
+                promo_type='flash_sale', promo_id=sale['id'],
+                start_time=sale['start_time'], end_time=sale['end_time'], priority=sale['priority'],
+                impact_scope=PromotionConflictService.flash_sale_scope(products[sale['id']])
+            )
+            for sale in FlashSale.objects.values('id', 'start_time', 'end_time', 'priority')
+        ]
+        rows += [
+            PromotionSchedule(
+                promo_type='coupon', promo_id=c['id'],
+                start_time=c['start_date'], end_time=c['end_date'], priority=c['priority'],
+                impact_scope={'type': 'global'}
+            )
+            for c in Coupon.objects.filter(active=True).values('id', 'start_date', 'end_date', 'priority')
+        ]
+
+        with transaction.atomic():
+            PromotionSchedule.objects.all().delete()
+            PromotionSchedule.objects.bulk_create(rows, batch_size=1000)
+        PromotionIndex.invalidate()
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Calendar rebuilt: {len(rows)} promotion(s)'))
+
+        if options['conflicts']:
+            unresolved = [c for c in PromotionConflictService.detect() if c['winner'] is None]
+            for c in unresolved:
+                a, b = c['promotions']
+                self.stdout.write(
+                    f"  ⚠️ {a['promo_type']} #{a['promo_id']} / {b['promo_type']} #{b['promo_id']} "
+                    f"(priority {a['priority']}) {timezone.localtime(c['overlap_start']):%Y-%m-%d %H:%M} - "
+                    f"{timezone.localtime(c['overlap_end']):%Y-%m-%d %H:%M}"
+                )
+            self.stdout.write(f'   Unresolved conflicts: {len(unresolved)}')
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:37
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0037_shippingaddress_accuracy_shippingaddress_verified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckoutIdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('request_hash', models.CharField(help_text='SHA-256 of the request body', max_length=64)),
+                ('response_status', models.PositiveSmallIntegerField(default=201)),
+                ('response_body', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='myapp.order')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkout_keys', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'checkout_idempotency_keys',
+                'unique_together': {('user', 'key')},
+            },
+        ),
+    ]
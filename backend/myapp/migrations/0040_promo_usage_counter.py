@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0039_order_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PromoUsageCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('promo_type', models.CharField(max_length=20)),
+                ('promo_id', models.IntegerField()),
+                ('day', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'promo_usage_counters',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='promousagelog',
+            index=models.Index(fields=['timestamp'], name='promo_usage_timesta_8f3c6c_idx'),
+        ),
+        migrations.AddField(
+            model_name='promousagecounter',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='promo_counters', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='promousagecounter',
+            unique_together={('user', 'promo_type', 'promo_id', 'day')},
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:54
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_collected_count(apps, schema_editor):
+    """collected_count = current number of wallet rows, in one UPDATE."""
+    Coupon = apps.get_model('myapp', 'Coupon')
+    UserCoupon = apps.get_model('myapp', 'UserCoupon')
+    collected = (
+        UserCoupon.objects.filter(coupon=OuterRef('pk'))
+        .order_by().values('coupon').annotate(n=Count('id')).values('n')
+    )
+    Coupon.objects.update(
+        collected_count=Coalesce(Subquery(collected, output_field=IntegerField()), Value(0))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0040_promo_usage_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='collected_count',
+            field=models.IntegerField(default=0, help_text='เก็บเข้ากระเป๋าแล้ว (Atomic claim counter)'),
+        ),
+        migrations.RunPython(backfill_collected_count, migrations.RunPython.noop),
+    ]
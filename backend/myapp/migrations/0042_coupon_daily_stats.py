@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0041_coupon_collected_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponDailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('uses', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('discount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('collections', models.IntegerField(default=0)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='myapp.coupon')),
+            ],
+            options={
+                'db_table': 'coupon_daily_stats',
+                'unique_together': {('coupon', 'day')},
+            },
+        ),
+    ]
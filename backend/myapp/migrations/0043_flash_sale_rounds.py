@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0042_coupon_daily_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlashSaleRound',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_at', models.DateTimeField()),
+                ('end_at', models.DateTimeField(help_text="Exclusive (the round's end minute is still live)")),
+                ('flash_sale', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='round_intervals', to='myapp.flashsale')),
+            ],
+            options={
+                'db_table': 'flash_sale_rounds',
+                'indexes': [models.Index(fields=['start_at', 'end_at'], name='flash_sale__start_a_5b5a51_idx')],
+            },
+        ),
+    ]
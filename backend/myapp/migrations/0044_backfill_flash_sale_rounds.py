@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def round_intervals(rounds, start_time, end_time):
+    """
+    Frozen copy of FlashSaleService.round_intervals as of this migration:
+    daily 'HH:MM' rounds -> (start_at, end_at) in the shop timezone, clipped
+    to the sale window, end minute inclusive, overnight rounds allowed.
+    """
+    tz = timezone.get_default_timezone()
+    parsed = []
+    for r in rounds or []:
+        try:
+            parsed.append((
+                datetime.strptime(r['start'], '%H:%M').time(),
+                datetime.strptime(r['end'], '%H:%M').time()
+            ))
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    intervals = []
+    day = timezone.localtime(start_time, tz).date() - timedelta(days=1)
+    last = timezone.localtime(end_time, tz).date()
+    while day <= last:
+        for start, end in parsed:
+            start_at = datetime.combine(day, start, tzinfo=tz)
+            end_day = day if end >= start else day + timedelta(days=1)
+            end_at = datetime.combine(end_day, end, tzinfo=tz) + timedelta(minutes=1)
+            start_at, end_at = max(start_at, start_time), min(end_at, end_time)
+            if start_at < end_at:
+                intervals.append((start_at, end_at))
+        day += timedelta(days=1)
+    return sorted(intervals)
+
+
+def backfill_flash_sale_rounds(apps, schema_editor):
+    """Compile rounds of sales that have not ended yet, in one INSERT."""
+    FlashSale = apps.get_model('myapp', 'FlashSale')
+    FlashSaleRound = apps.get_model('myapp', 'FlashSaleRound')
+    sales = FlashSale.objects.filter(end_time__gte=timezone.now()).only('id', 'rounds', 'start_time', 'end_time')
+    FlashSaleRound.objects.filter(flash_sale__in=sales).delete()
+    FlashSaleRound.objects.bulk_create([
+        FlashSaleRound(flash_sale_id=sale.id, start_at=start_at, end_at=end_at)
+        for sale in sales if sale.rounds
+        for start_at, end_at in round_intervals(sale.rounds, sale.start_time, sale.end_time)
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0043_flash_sale_rounds'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_flash_sale_rounds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+PAID_STATUSES = ('Paid', 'Processing', 'Shipped', 'Completed')
+
+
+def backfill_coupon_daily_stats(apps, schema_editor):
+    """Fill the rollup from one grouped query over orders and one over wallet rows."""
+    Order = apps.get_model('myapp', 'Order')
+    UserCoupon = apps.get_model('myapp', 'UserCoupon')
+    CouponDailyStat = apps.get_model('myapp', 'CouponDailyStat')
+
+    rows = defaultdict(lambda: [0, Decimal(0), Decimal(0), 0])
+    orders = Order.objects.filter(coupon__isnull=False, status__in=PAID_STATUSES)
+    for r in orders.annotate(day=TruncDate('created_at')).values('coupon_id', 'day').annotate(
+        uses=Count('id'), revenue=Sum('total_price'), discount=Sum('discount_amount')
+    ).order_by():
+        row = rows[(r['coupon_id'], r['day'])]
+        row[0], row[1], row[2] = r['uses'], r['revenue'] or 0, r['discount'] or 0
+    for r in UserCoupon.objects.annotate(day=TruncDate('collected_at')).values('coupon_id', 'day').annotate(
+        n=Count('id')
+    ).order_by():
+        rows[(r['coupon_id'], r['day'])][3] = r['n']
+
+    CouponDailyStat.objects.all().delete()
+    CouponDailyStat.objects.bulk_create([
+        CouponDailyStat(
+            coupon_id=coupon_id, day=day,
+            uses=uses, revenue=revenue, discount=discount, collections=collections
+        )
+        for (coupon_id, day), (uses, revenue, discount, collections) in rows.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0044_backfill_flash_sale_rounds'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_coupon_daily_stats, migrations.RunPython.noop),
+    ]
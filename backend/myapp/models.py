@@ -3,6 +3,7 @@ from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, Permis
 from django.utils import timezone
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.core.serializers.json import DjangoJSONEncoder
 
 # ==========================================
 # 👤 Custom User Model
@@ -223,10 +224,26 @@ class StockHistory(models.Model):
     def __str__(self):
         return f"{self.product.title} - {self.change_quantity} ({self.action})"
 
+# ==========================================
+# 🧷 Loaded values (change checks on save)
+# ==========================================
+class LoadedValuesMixin:
+    """
+    Keeps the column values a row was read with in `_loaded_values`
+    ({attname: value}, deferred fields absent), so post_save receivers can
+    tell config edits from counter-only saves without a snapshot per load.
+    """
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+
 # ==========================================
 # 🎟️ Coupon System (V2 MAXIMUM)
 # ==========================================
-class Coupon(models.Model):
+class Coupon(LoadedValuesMixin, models.Model):
     DISCOUNT_TYPES = [
         ('percent', 'Percentage (%)'),
         ('fixed', 'Fixed Amount (THB)'),
@@ -253,6 +270,7 @@ class Coupon(models.Model):
     # --- Quotas ---
     total_supply = models.IntegerField(default=1000000, help_text="จำนวนสิทธิ์ทั้งหมด (Global Limit)") # ✅ New (V2) Renamed from usage_limit logical overlap
     used_count = models.IntegerField(default=0, help_text="ใช้ไปแล้ว (Atomic)") # Renamed/Repurposed
+    collected_count = models.IntegerField(default=0, help_text="เก็บเข้ากระเป๋าแล้ว (Atomic claim counter)") # ✅ New
     
     # Deprecated/Mapped to total_supply in logic if needed, but keeping for legacy compatibility or renaming if safe
     usage_limit = models.IntegerField(default=100, help_text="จำนวนสิทธิ์ทั้งหมด (Legacy field)") 
@@ -572,7 +590,23 @@ class FlashSale(models.Model):
             return '#3b82f6'  # Blue
 
 
-class FlashSaleProduct(models.Model):
+class FlashSaleRound(models.Model):
+    """
+    ⏱️ Compiled Flash Sale round: one absolute interval per round per day
+    Rebuilt from FlashSale.rounds ('HH:MM', shop timezone) whenever the sale
+    is saved, so live/upcoming round checks are index range scans.
+    """
+    flash_sale = models.ForeignKey(FlashSale, on_delete=models.CASCADE, related_name='round_intervals')
+    start_at = models.DateTimeField()
+    end_at = models.DateTimeField(help_text="Exclusive (the round's end minute is still live)")
+
+    class Meta:
+        db_table = 'flash_sale_rounds'
+        indexes = [
+            models.Index(fields=['start_at', 'end_at']),
+        ]
+
+class FlashSaleProduct(LoadedValuesMixin, models.Model):
     """
     Dedicated Stock for Flash Sale
     """
@@ -659,6 +693,42 @@ class PromoUsageLog(models.Model):
     
     class Meta:
         db_table = 'promo_usage_logs'
+        indexes = [
+            models.Index(fields=['timestamp']), # Retention pruning
+        ]
+
+class PromoUsageCounter(models.Model):
+    """
+    Materialized usage per (user, promo, local day), kept in step with
+    PromoUsageLog. Limit checks read this instead of counting raw logs.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='promo_counters')
+    promo_type = models.CharField(max_length=20) # 'coupon' | 'flash'
+    promo_id = models.IntegerField()
+    day = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'promo_usage_counters'
+        unique_together = ('user', 'promo_type', 'promo_id', 'day')
+
+class CouponDailyStat(models.Model):
+    """
+    📈 Coupon dashboard rollup per (coupon, local day)
+    uses/revenue/discount come from orders in a paid status (by order date),
+    collections from wallet claims. Kept up to date incrementally by
+    CouponStatsService; rebuild_coupon_daily_stats recomputes it.
+    """
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='daily_stats')
+    day = models.DateField()
+    uses = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    discount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    collections = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'coupon_daily_stats'
+        unique_together = ('coupon', 'day')
 
 # ==========================================
 # 📦 Order System (V2)
@@ -758,6 +828,60 @@ class OrderItem(models.Model):
     def get_total_price(self):
         return self.price_at_purchase * self.quantity
 
+class CheckoutIdempotencyKey(models.Model):
+    """
+    🔁 Idempotency-Key of POST /api/checkout (retries replay the stored response)
+    Written in the same transaction as the order, so a key exists only for
+    orders that were actually committed.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='checkout_keys')
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64, help_text="SHA-256 of the request body")
+    order = models.ForeignKey(Order, null=True, blank=True, on_delete=models.SET_NULL)
+
+    response_status = models.PositiveSmallIntegerField(default=201)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = 'checkout_idempotency_keys'
+        unique_together = ('user', 'key')
+
+class OrderEvent(models.Model):
+    """
+    📮 Outbox row written in the checkout transaction
+    Side effects (profile save, role upgrade, PromoUsageLog, StockHistory,
+    notification) are applied later by `manage.py run_order_events`.
+    """
+    EVENT_CHOICES = [
+        ('order_placed', 'Order Placed'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    event_type = models.CharField(max_length=30, choices=EVENT_CHOICES, default='order_placed')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='events')
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'order_events'
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+
 class Review(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reviews')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -1,7 +1,9 @@
 from rest_framework import serializers
 from .models import Product, ProductImage, Order, OrderItem, User, Coupon, FlashSale, FlashSaleProduct, FlashSaleCampaign, Tag, Category, Wishlist, Notification
-from django.utils import timezone
 from django.db import models
+from django.db.models import Count, F, Prefetch, Window, prefetch_related_objects
+from django.db.models.functions import RowNumber
+from .services import PromotionIndex
 
 
 # ... (Existing ProductImageSerializer)
@@ -46,13 +48,60 @@ class TagSerializer(serializers.ModelSerializer):
     
     def get_product_count(self, obj):
         """นับจำนวนสินค้าที่มี Tag นี้"""
+        # ⚡ Preloaded for the whole page by ProductListSerializer
+        counts = self.context.get('tag_product_counts')
+        if counts is not None:
+            return counts.get(obj.id, 0)
         return obj.products.count() 
 
     def get_product_thumbnails(self, obj):
         """ดึงรูปของสินค้า 3 อันแรกที่ติด Tag นี้"""
+        thumbnails = self.context.get('tag_product_thumbnails')
+        if thumbnails is not None:
+            return thumbnails.get(obj.id, [])
         products = obj.products.all()[:3]
         return [p.thumbnail.url if p.thumbnail else None for p in products]
 
+def tag_product_stats(tag_ids):
+    """
+    TagSerializer context maps for many tags at once: product counts and the
+    first 3 thumbnails of every tag, one query each.
+    """
+    if not tag_ids:
+        return {}, {}
+    through = Product.tags.through
+    counts = dict(
+        through.objects.filter(tag_id__in=tag_ids).values('tag_id')
+        .annotate(n=Count('id')).order_by().values_list('tag_id', 'n')
+    )
+    thumbnails = {}
+    rows = through.objects.filter(tag_id__in=tag_ids).annotate(
+        rank=Window(RowNumber(), partition_by=F('tag_id'), order_by=F('product_id').asc())
+    ).filter(rank__lte=3).order_by('tag_id', 'product_id').values_list('tag_id', 'product__thumbnail')
+    storage = Product._meta.get_field('thumbnail').storage
+    for tag_id, thumbnail in rows:
+        thumbnails.setdefault(tag_id, []).append(storage.url(thumbnail) if thumbnail else None)
+    return counts, thumbnails
+
+class ProductListSerializer(serializers.ListSerializer):
+    """
+    Serializes a page of products with a fixed number of queries:
+    category, images and tags are prefetched, tag stats are loaded with one
+    query each and flash_sale_info comes from the promotion index in one pass.
+    """
+
+    def to_representation(self, data):
+        products = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        prefetch_related_objects(products, 'category', 'images', 'tags')
+
+        counts, thumbnails = tag_product_stats({tag.id for p in products for tag in p.tags.all()})
+
+        context = self.child.context
+        context['tag_product_counts'] = counts
+        context['tag_product_thumbnails'] = thumbnails
+        context['flash_sale_info'] = PromotionIndex.flash_sale_info_many([p.id for p in products])
+        return [self.child.to_representation(p) for p in products]
+
 class ProductSerializer(serializers.ModelSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
     flash_sale_info = serializers.SerializerMethodField()
@@ -62,27 +111,14 @@ class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = ['id', 'title', 'price', 'description', 'stock', 'thumbnail', 'brand', 'rating', 'images', 'flash_sale_info', 'category', 'tags', 'created_at'] # ✅ เพิ่ม tags, created_at
+        list_serializer_class = ProductListSerializer # ✅ many=True -> batched lookups
 
     def get_flash_sale_info(self, obj):
-        now = timezone.now()
-        # Find active flash sale containing this product
-        active_fs = FlashSaleProduct.objects.filter(
-            product=obj,
-            flash_sale__start_time__lte=now,
-            flash_sale__end_time__gte=now,
-            flash_sale__is_active=True,
-            sold_count__lt=models.F('quantity_limit') # Available stock
-        ).first()
-        
-        if active_fs:
-             return {
-                'id': active_fs.flash_sale.id,
-                'sale_price': active_fs.sale_price,
-                'end_time': active_fs.flash_sale.end_time,
-                'quantity_limit': active_fs.quantity_limit,
-                'sold_count': active_fs.sold_count
-             }
-        return None
+        # Active flash sale containing this product (with stock left), from the in-process index
+        page = self.context.get('flash_sale_info')
+        if page is not None:
+            return page.get(obj.id)
+        return PromotionIndex.flash_sale_info(obj.id)
 
 class CouponSerializer(serializers.ModelSerializer):
     class Meta:
@@ -108,6 +144,36 @@ class FlashSaleProductSerializer(serializers.ModelSerializer):
 # ==========================================
 # 🎯 Flash Sale Campaign Serializer
 # ==========================================
+def prefetch_campaign_sales(campaigns, with_products=True):
+    """
+    Loads the sales of many campaigns (start_time order) with one prefetch
+    query, plus products and their tags when `with_products`. Returns the
+    TagSerializer context maps for those tags (one query each).
+    """
+    sales = FlashSale.objects.order_by('start_time')
+    if with_products:
+        sales = sales.prefetch_related('products__product__tags')
+    prefetch_related_objects(campaigns, Prefetch('flash_sales', queryset=sales))
+    if not with_products:
+        return {}
+    counts, thumbnails = tag_product_stats({
+        tag.id for c in campaigns for sale in c.flash_sales.all()
+        for fsp in sale.products.all() for tag in fsp.product.tags.all()
+    })
+    return {'tag_product_counts': counts, 'tag_product_thumbnails': thumbnails}
+
+class FlashSaleCampaignListSerializer(serializers.ListSerializer):
+    """
+    Serializes many campaigns with a fixed number of queries: sales, sale
+    products, products and tags are prefetched for the whole list.
+    """
+
+    def to_representation(self, data):
+        campaigns = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        if campaigns:
+            self.child.prefetch(campaigns)
+        return [self.child.to_representation(c) for c in campaigns]
+
 class FlashSaleCampaignSerializer(serializers.ModelSerializer):
     """
     Serializer สำหรับ Flash Sale Campaign
@@ -115,19 +181,48 @@ class FlashSaleCampaignSerializer(serializers.ModelSerializer):
     ใช้สำหรับ:
     - Campaign Batch View (แสดงรายการแคมเปญ)
     - Campaign Form (สร้าง/แก้ไข)
+
+    context['fields']: 'summary' = sales without their products (timeline),
+    or a comma-separated list of campaign fields to return.
     """
     # ✅ เพิ่ม computed fields
-    flash_sale_count = serializers.IntegerField(read_only=True, source='flash_sales.count')
+    flash_sale_count = serializers.SerializerMethodField()
     status = serializers.CharField(read_only=True)
     
     # ✅ เพิ่ม nested Flash Sales data (สำหรับ Campaign Detail View)
     flash_sales = serializers.SerializerMethodField()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = self.context.get('fields') or ''
+        self.summary = requested == 'summary'
+        if requested and not self.summary:
+            keep = {name.strip() for name in requested.split(',')}
+            for name in list(self.fields):
+                if name not in keep:
+                    self.fields.pop(name)
+
+    def prefetch(self, campaigns):
+        if 'flash_sales' in self.fields or 'flash_sale_count' in self.fields:
+            with_products = 'flash_sales' in self.fields and not self.summary
+            self.context.update(prefetch_campaign_sales(campaigns, with_products))
+
+    def to_representation(self, instance):
+        if 'flash_sales' not in getattr(instance, '_prefetched_objects_cache', {}):
+            self.prefetch([instance]) # Single campaign (detail / after save)
+        return super().to_representation(instance)
+
+    def get_flash_sale_count(self, obj):
+        prefetched = getattr(obj, '_prefetched_objects_cache', {})
+        if 'flash_sales' in prefetched:
+            return len(prefetched['flash_sales'])
+        return obj.flash_sales.count()
     
     def get_flash_sales(self, obj):
         """ดึงข้อมูล Flash Sales ทั้งหมดที่เข้าร่วม Campaign พร้อม Products"""
-        from .models import FlashSale
-        sales = FlashSale.objects.filter(campaign=obj).order_by('start_time')
-        return FlashSaleSerializer(sales, many=True).data
+        # ⚡ Prefetched in start_time order (see prefetch_campaign_sales)
+        context = {**self.context, 'flash_sale_summary': self.summary}
+        return FlashSaleSerializer(obj.flash_sales.all(), many=True, context=context).data
     
     class Meta:
         model = FlashSaleCampaign
@@ -141,6 +236,7 @@ class FlashSaleCampaignSerializer(serializers.ModelSerializer):
             'created_at', 'updated_at'
         ]
         read_only_fields = ['created_at', 'updated_at']
+        list_serializer_class = FlashSaleCampaignListSerializer # ✅ many=True -> prefetched
 
 
 class FlashSaleSerializer(serializers.ModelSerializer):
@@ -180,6 +276,11 @@ class FlashSaleSerializer(serializers.ModelSerializer):
             'limit_per_user_enabled', 'show_countdown_timer'
         ]
     
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.context.get('flash_sale_summary'):
+            self.fields.pop('products') # Campaign timeline: no nested products
+
     def get_timeline_color(self, obj):
         """ดึงสีจาก helper method ใน Model"""
         return obj.get_timeline_color()
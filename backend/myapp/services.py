@@ -1,48 +1,147 @@
 from django.utils import timezone
-from django.db.models import F, Sum
+from django.conf import settings
+from django.db import transaction, IntegrityError, connection
+from django.db.models.functions import Greatest, TruncDate
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q, Sum, Count, Case, When, Value, IntegerField, DecimalField, QuerySet, Exists, OuterRef
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
 from decimal import Decimal
-from .models import Coupon, UserCoupon, FlashSale, FlashSaleProduct, Order, Product, PromotionSchedule, PromoUsageLog
+from statistics import NormalDist
+import hashlib
+import json
+import math
+import queue
+import re
+import secrets
+import threading
+import time
+import numpy as np
+from .models import (
+    Coupon, UserCoupon, FlashSale, FlashSaleProduct, FlashSaleCampaign, Order, Product, PromotionSchedule, PromoUsageLog,
+    StockReservation, CheckoutIdempotencyKey, OrderEvent, User, StockHistory, Notification,
+    PromoUsageCounter, CouponDailyStat, FlashSaleRound, Tag, AdminLog
+)
 
 class FlashSaleService:
+    @staticmethod
+    def in_round(sale, now):
+        """Rounds V2: a sale with rounds is only live inside one of its compiled intervals."""
+        if isinstance(sale, LiveWindow):
+            return sale.rounds is None or any(start <= now < end for start, end in sale.rounds)
+        if not sale.rounds:
+            return True
+        return sale.round_intervals.filter(start_at__lte=now, end_at__gt=now).exists()
+
+    @staticmethod
+    def round_intervals(rounds, start_time, end_time):
+        """
+        Daily 'HH:MM' rounds -> absolute (start_at, end_at) intervals in the shop
+        timezone (settings.TIME_ZONE), clipped to the sale window. end_at is
+        exclusive: a round's end minute is still live. A round that ends
+        before it starts runs past midnight. Malformed rounds are skipped.
+        """
+        tz = timezone.get_default_timezone()
+        parsed = []
+        for r in rounds or []:
+            try:
+                parsed.append((
+                    datetime.strptime(r['start'], '%H:%M').time(),
+                    datetime.strptime(r['end'], '%H:%M').time()
+                ))
+            except (KeyError, TypeError, ValueError):
+                continue
+
+        intervals = []
+        # From the day before: an overnight round may already be running at start_time
+        day = timezone.localtime(start_time, tz).date() - timedelta(days=1)
+        last = timezone.localtime(end_time, tz).date()
+        while day <= last:
+            for start, end in parsed:
+                start_at = datetime.combine(day, start, tzinfo=tz)
+                end_day = day if end >= start else day + timedelta(days=1)
+                end_at = datetime.combine(end_day, end, tzinfo=tz) + timedelta(minutes=1)
+                start_at, end_at = max(start_at, start_time), min(end_at, end_time)
+                if start_at < end_at:
+                    intervals.append((start_at, end_at))
+            day += timedelta(days=1)
+        return sorted(intervals)
+
+    @staticmethod
+    def compile_rounds(sale):
+        """Replace the sale's FlashSaleRound rows (one DELETE + one INSERT)."""
+        FlashSaleRound.objects.filter(flash_sale=sale).delete()
+        if not sale.rounds:
+            return
+        start_time, end_time = sale.start_time, sale.end_time
+        if isinstance(start_time, str) or isinstance(end_time, str):
+            # Admin views assign the raw request strings: use the stored values
+            start_time, end_time = FlashSale.objects.filter(pk=sale.pk).values_list('start_time', 'end_time').get()
+        FlashSaleRound.objects.bulk_create([
+            FlashSaleRound(flash_sale=sale, start_at=start_at, end_at=end_at)
+            for start_at, end_at in FlashSaleService.round_intervals(sale.rounds, start_time, end_time)
+        ])
+
+    @staticmethod
+    def rounds_between(start, end):
+        """Rounds of active sales overlapping [start, end), e.g. live in the next hour (index range scan)."""
+        return FlashSaleRound.objects.filter(
+            start_at__lt=end,
+            end_at__gt=start,
+            flash_sale__is_active=True
+        ).select_related('flash_sale').order_by('start_at')
+
+    @staticmethod
+    def live_rows(product_ids, now=None, lock=False):
+        """
+        In-round Flash Sale rows of the given products, best first (priority,
+        then earliest end), read from the DB in one query: the sale is active
+        and running, and inside one of its compiled rounds if it has any.
+        With lock=True only the flash_sale_products rows are SELECT ... FOR
+        UPDATE, in id order.
+        """
+        product_ids = list(product_ids)
+        if not product_ids:
+            return []
+        now = now or timezone.now()
+        qs = FlashSaleProduct.objects.filter(
+            product_id__in=product_ids,
+            flash_sale__is_active=True,
+            flash_sale__start_time__lte=now,
+            flash_sale__end_time__gte=now
+        ).annotate(in_live_round=Exists(FlashSaleRound.objects.filter(
+            flash_sale=OuterRef('flash_sale'), start_at__lte=now, end_at__gt=now
+        ))).select_related('flash_sale').order_by('id')
+        if lock:
+            qs = qs.select_for_update(of=('self',))
+        # Rows are read (and locked) in id order; priority is applied in memory
+        rows = [fs for fs in qs if fs.in_live_round or not fs.flash_sale.rounds]
+        return sorted(rows, key=lambda fs: (-fs.flash_sale.priority, fs.flash_sale.end_time, fs.id))
+
+    @staticmethod
+    def pick_live(product_ids, now=None, lock=False):
+        """
+        Live Flash Sale row per product for a whole cart in one query.
+        Checkout prices from these rows (never from PromotionIndex, which is
+        for display and may lag a boundary); sold-out rows fall through to the
+        next sale. Returns {product_id: FlashSaleProduct}.
+        """
+        picked = {}
+        for fs in FlashSaleService.live_rows(product_ids, now, lock):
+            if fs.product_id not in picked and fs.sold_count + fs.reserved_stock < fs.quantity_limit:
+                picked[fs.product_id] = fs
+        return picked
+
     @staticmethod
     def get_active_flash_sale(product):
         """
         Get the currently active Flash Sale for a product.
         Returns FlashSaleProduct or None.
         """
-        now = timezone.now()
-        
-        # Find active campaign logic V2 (Using PromotionSchedule for faster lookup could be future opt)
-        flash_sales = FlashSale.objects.filter(
-            is_active=True,
-            start_time__lte=now,
-            end_time__gte=now
-        ).order_by('-priority', 'end_time') # Higher priority first
-        
-        if not flash_sales.exists():
-            return None
-            
-        # Check if product is in this flash sale
-        for sale in flash_sales:
-            # Check Rounds V2
-            if sale.rounds:
-                current_time_str = now.strftime('%H:%M')
-                is_in_round = False
-                for r in sale.rounds:
-                    if r['start'] <= current_time_str <= r['end']:
-                        is_in_round = True
-                        break
-                if not is_in_round:
-                    continue
-
-            try:
-                fs_product = FlashSaleProduct.objects.get(flash_sale=sale, product=product)
-                if fs_product.is_available():
-                    return fs_product
-            except FlashSaleProduct.DoesNotExist:
-                continue
-                
-        return None
+        return FlashSaleService.pick_live([product.id]).get(product.id)
 
     @staticmethod
     def validate_user_limit(flash_sale, user):
@@ -52,97 +151,908 @@ class FlashSaleService:
         if not user or not user.is_authenticated:
             return True # Guest? Maybe block or allow based on policy. Let's allow view, but buy needs auth.
 
-        # Count total items bought in this flash sale
-        # This requires querying OrderItems linked to this Flash Sale
-        # Simplified: Check usage log
-        usage_count = PromoUsageLog.objects.filter(
-            user=user, 
-            promo_type='flash', 
-            promo_id=flash_sale.id
-        ).count()
+        # Orders placed in this flash sale (materialized usage counters)
+        _, usage_count = PromoUsageService.usage(user, 'flash', flash_sale.id)
         
         return usage_count < flash_sale.limit_per_user_total
 
+
+# Flash Sale row as held by PromotionIndex (counts are as of the last rebuild;
+# rounds = None for a sale without rounds, else its compiled (start_at, end_at) intervals)
+LiveWindow = namedtuple('LiveWindow', [
+    'id', 'flash_sale_id', 'product_id', 'start_time', 'end_time', 'rounds', 'priority',
+    'sale_price', 'quantity_limit', 'sold_count', 'reserved_stock', 'limit_per_user'
+])
+
+
+class PromotionIndex:
+    """
+    🗂️ In-process interval index of Flash Sale windows per product
+    Every active, not yet ended FlashSaleProduct is loaded with one query and
+    kept as {product_id: [LiveWindow, ...]} (priority order). Time and round
+    checks then run in memory. The index is rebuilt when a promotion is
+    written (version bump in the Django cache), when the next start/end
+    boundary passes, and at least every PROMOTION_INDEX_MAX_AGE seconds,
+    which is also how stale the sold/reserved counts used for display can be.
+    The index is for display only: checkout prices from the rows it reads
+    (and locks) itself (FlashSaleService.pick_live).
+
+    A per-process cache (CACHE_IS_SHARED=False) never carries other workers'
+    version bumps. There is no cheaper change marker than the one indexed
+    read of the active rows, so the index is then simply re-read once it is
+    PROMOTION_INDEX_LOCAL_MAX_AGE seconds old.
+    """
+    VERSION_KEY = 'promotions:index:version'
+
+    _lock = threading.Lock()
+    _windows = None
+    _valid_until = None
+    _version = None
+    _built_at = 0.0
+
+    @staticmethod
+    def rebuild(now=None):
+        now = now or timezone.now()
+        version = cache.get(PromotionIndex.VERSION_KEY)
+        rows = FlashSaleProduct.objects.filter(
+            flash_sale__is_active=True,
+            flash_sale__end_time__gte=now
+        ).values_list(
+            'id', 'flash_sale_id', 'product_id', 'flash_sale__start_time', 'flash_sale__end_time',
+            'flash_sale__rounds', 'flash_sale__priority',
+            'sale_price', 'quantity_limit', 'sold_count', 'reserved_stock', 'limit_per_user'
+        )
+
+        rows = list(rows)
+        intervals = defaultdict(list)
+        round_sales = {row[1] for row in rows if row[5]}
+        if round_sales:
+            for sale_id, start_at, end_at in FlashSaleRound.objects.filter(
+                flash_sale_id__in=round_sales, end_at__gt=now
+            ).order_by('start_at').values_list('flash_sale_id', 'start_at', 'end_at'):
+                intervals[sale_id].append((start_at, end_at))
+
+        windows = defaultdict(list)
+        valid_until = None
+        for row in rows:
+            w = LiveWindow(*row)
+            w = w._replace(rounds=tuple(intervals[w.flash_sale_id]) if w.rounds else None)
+            windows[w.product_id].append(w)
+            boundary = w.start_time if w.start_time > now else w.end_time
+            valid_until = boundary if valid_until is None else min(valid_until, boundary)
+        for product_windows in windows.values():
+            product_windows.sort(key=lambda w: (-w.priority, w.end_time, w.id))
+
+        with PromotionIndex._lock:
+            PromotionIndex._windows = dict(windows)
+            PromotionIndex._valid_until = valid_until
+            PromotionIndex._version = version
+            PromotionIndex._built_at = time.monotonic()
+
+    @staticmethod
+    def _current(now):
+        max_age = settings.PROMOTION_INDEX_MAX_AGE if settings.CACHE_IS_SHARED else settings.PROMOTION_INDEX_LOCAL_MAX_AGE
+        stale = (
+            PromotionIndex._windows is None
+            or (PromotionIndex._valid_until is not None and now >= PromotionIndex._valid_until)
+            or time.monotonic() - PromotionIndex._built_at > max_age
+            or cache.get(PromotionIndex.VERSION_KEY) != PromotionIndex._version
+        )
+        if stale:
+            PromotionIndex.rebuild(now)
+        return PromotionIndex._windows
+
+    @staticmethod
+    def invalidate():
+        try:
+            cache.incr(PromotionIndex.VERSION_KEY)
+        except ValueError:
+            cache.add(PromotionIndex.VERSION_KEY, int(time.time() * 1000), timeout=None)
+
+    @staticmethod
+    def candidates(product_ids, now=None):
+        """{product_id: [LiveWindow, ...]} of windows (and rounds) open at `now`, ignoring counts."""
+        now = now or timezone.now()
+        index = PromotionIndex._current(now)
+        found = {}
+        for pid in product_ids:
+            live = [
+                w for w in index.get(pid, ())
+                if w.start_time <= now <= w.end_time and FlashSaleService.in_round(w, now)
+            ]
+            if live:
+                found[pid] = live
+        return found
+
+    @staticmethod
+    def live_many(product_ids, now=None):
+        """{product_id: LiveWindow} each product sells under right now (sold-out rows fall through)."""
+        picked = {}
+        for pid, windows in PromotionIndex.candidates(product_ids, now).items():
+            for w in windows:
+                if w.sold_count + w.reserved_stock < w.quantity_limit:
+                    picked[pid] = w
+                    break
+        return picked
+
+    @staticmethod
+    def flash_sale_info_many(product_ids, now=None):
+        """{product_id: `flash_sale_info` payload} for a page of products, from memory."""
+        return {
+            pid: {
+                'id': w.flash_sale_id,
+                'flash_sale_product_id': w.id,
+                'sale_price': w.sale_price,
+                'end_time': w.end_time,
+                'quantity_limit': w.quantity_limit,
+                'sold_count': w.sold_count
+            }
+            for pid, w in PromotionIndex.live_many(product_ids, now).items()
+        }
+
+    @staticmethod
+    def flash_sale_info(product_id, now=None):
+        """`flash_sale_info` payload of product endpoints (None = no live sale)."""
+        return PromotionIndex.flash_sale_info_many([product_id], now).get(product_id)
+
+
+# Flash Sale product fields that change what the index holds (counter-only saves are ignored)
+_INDEXED_FLASH_SALE_PRODUCT_FIELDS = ('flash_sale_id', 'product_id', 'sale_price', 'quantity_limit', 'limit_per_user')
+
+
+def _changed_since_load(instance, fields):
+    """
+    True when any of `fields` differs from what the row was read with
+    (LoadedValuesMixin) or last saved with here. Unknown rows count as changed.
+    """
+    loaded = getattr(instance, '_loaded_values', None)
+    if loaded is None:
+        return True
+    # __dict__ so deferred fields are not loaded just for this
+    return any(
+        instance.__dict__.get(f) != loaded[f] if f in loaded else f in instance.__dict__
+        for f in fields
+    )
+
+
+def _remember_saved_values(instance, fields):
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    loaded.update({f: instance.__dict__[f] for f in fields if f in instance.__dict__})
+    instance._loaded_values = loaded
+
+
+@receiver(post_save, sender=FlashSale)
+@receiver(post_save, sender=FlashSaleProduct)
+def _reindex_saved_promotion(sender, instance, created, **kwargs):
+    if sender is FlashSale:
+        # Admin edits only (the scheduler flips sales with update()): always recompile
+        FlashSaleService.compile_rounds(instance)
+        PromotionConflictService.sync_flash_sale(instance.id)
+    else:
+        if not created and not _changed_since_load(instance, _INDEXED_FLASH_SALE_PRODUCT_FIELDS):
+            FlashSaleStream.counters_moved()
+            return # e.g. sold_count += qty; save()
+        _remember_saved_values(instance, _INDEXED_FLASH_SALE_PRODUCT_FIELDS)
+        PromotionConflictService.queue_flash_sale_sync(instance.flash_sale_id)
+    _invalidate_promotion_index(sender, instance)
+
+
+@receiver(post_save, sender=PromotionSchedule)
+@receiver(post_delete, sender=FlashSale)
+@receiver(post_delete, sender=FlashSaleProduct)
+@receiver(post_delete, sender=PromotionSchedule)
+def _invalidate_promotion_index(sender, instance, **kwargs):
+    if sender is PromotionSchedule and instance.promo_type == 'coupon':
+        return # The index only holds flash sales
+    # Now for this process, again once other connections can see the write
+    PromotionIndex.invalidate()
+    transaction.on_commit(PromotionIndex.invalidate)
+
+
+class FlashSaleStream:
+    """
+    📡 Live Flash Sale counters for SSE watchers (/api/flash-sales/stream/)
+    Checkout bumps a version key in the Django cache after commit. One
+    fan-out thread per process checks it at most FLASH_SALE_STREAM_MAX_FPS
+    times per second, reads the live (id, sold_count, reserved_stock) rows
+    with one query when it moved, and pushes a single delta frame to every
+    watcher's queue. Bursts of orders are coalesced into one frame per tick,
+    and the query cost does not grow with the number of watchers. Counters
+    are re-read at least every FLASH_SALE_STREAM_RESYNC_SECONDS for writes
+    made by processes that do not share the cache.
+
+    Each watcher parks its worker for as long as it stays connected, so the
+    endpoint is meant to be served from an async worker (gunicorn -k gevent,
+    or ASGI), where that costs a greenlet rather than a thread. A process
+    accepts at most FLASH_SALE_STREAM_MAX_CLIENTS watchers; the rest get 503
+    and the client polls the cached /api/flash-sales/active/ feed instead.
+    """
+    VERSION_KEY = 'flash_sales:stream:version'
+
+    _lock = threading.Lock()
+    _subscribers = set()
+    _thread = None
+    _counts = None # {flash_sale_product_id: (sold_count, reserved_stock)}
+    _seq = 0
+    _version = None
+    _polled_at = 0.0
+
+    @staticmethod
+    def touch():
+        try:
+            cache.incr(FlashSaleStream.VERSION_KEY)
+        except ValueError:
+            cache.add(FlashSaleStream.VERSION_KEY, int(time.time() * 1000), timeout=None)
+
+    @staticmethod
+    def counters_moved():
+        """Call after sold_count / reserved_stock were written (fires once committed)."""
+        transaction.on_commit(FlashSaleStream.touch)
+
+    @staticmethod
+    def live_counts(now=None):
+        now = now or timezone.now()
+        rows = FlashSaleProduct.objects.filter(
+            flash_sale__is_active=True,
+            flash_sale__start_time__lte=now,
+            flash_sale__end_time__gte=now
+        ).values_list('id', 'sold_count', 'reserved_stock')
+        return {fsp_id: (sold, reserved) for fsp_id, sold, reserved in rows}
+
+    @staticmethod
+    def frame(event, seq, counts):
+        items = [
+            {"flash_sale_product_id": fsp_id, "sold_count": sold, "reserved_stock": reserved}
+            for fsp_id, (sold, reserved) in sorted(counts.items())
+        ]
+        data = json.dumps({"items": items}, separators=(',', ':'))
+        return f"id: {seq}\nevent: {event}\ndata: {data}\n\n"
+
+    @staticmethod
+    def snapshot_frame():
+        with FlashSaleStream._lock:
+            return FlashSaleStream.frame('snapshot', FlashSaleStream._seq, FlashSaleStream._counts or {})
+
+    @staticmethod
+    def poll(now=None, force=False):
+        """
+        One tick of the fan-out loop. Re-reads the counters when the version
+        moved (or the resync interval passed) and publishes the rows that
+        changed. Returns the delta frame, or None when nothing changed.
+        """
+        version = cache.get(FlashSaleStream.VERSION_KEY)
+        fresh = time.monotonic() - FlashSaleStream._polled_at < settings.FLASH_SALE_STREAM_RESYNC_SECONDS
+        if not force and FlashSaleStream._counts is not None and version == FlashSaleStream._version and fresh:
+            return None
+
+        counts = FlashSaleStream.live_counts(now)
+        with FlashSaleStream._lock:
+            previous = FlashSaleStream._counts
+            FlashSaleStream._counts = counts
+            FlashSaleStream._version = version
+            FlashSaleStream._polled_at = time.monotonic()
+            if previous is None:
+                return None # First read: watchers start from the snapshot
+            changed = {fsp_id: c for fsp_id, c in counts.items() if previous.get(fsp_id) != c}
+            if not changed:
+                return None
+            FlashSaleStream._seq += 1
+            delta = FlashSaleStream.frame('counts', FlashSaleStream._seq, changed)
+            subscribers = list(FlashSaleStream._subscribers)
+
+        for q in subscribers:
+            FlashSaleStream._offer(q, delta)
+        return delta
+
+    @staticmethod
+    def _offer(q, frame):
+        try:
+            q.put_nowait(frame)
+        except queue.Full:
+            # Slow watcher: drop its backlog and let it resync from a snapshot
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+            q.put_nowait(FlashSaleStream.snapshot_frame())
+
+    @staticmethod
+    def subscribe():
+        """The watcher's queue, or None when FLASH_SALE_STREAM_MAX_CLIENTS are already connected."""
+        q = queue.Queue(maxsize=settings.FLASH_SALE_STREAM_BUFFER)
+        with FlashSaleStream._lock:
+            if len(FlashSaleStream._subscribers) >= settings.FLASH_SALE_STREAM_MAX_CLIENTS:
+                return None
+            FlashSaleStream._subscribers.add(q)
+            if FlashSaleStream._thread is None:
+                FlashSaleStream._thread = threading.Thread(
+                    target=FlashSaleStream._run, name='flash-sale-stream', daemon=True
+                )
+                FlashSaleStream._thread.start()
+        return q
+
+    @staticmethod
+    def unsubscribe(q):
+        with FlashSaleStream._lock:
+            FlashSaleStream._subscribers.discard(q)
+
+    @staticmethod
+    def _run():
+        interval = 1.0 / max(settings.FLASH_SALE_STREAM_MAX_FPS, 0.1)
+        try:
+            while True:
+                with FlashSaleStream._lock:
+                    if not FlashSaleStream._subscribers:
+                        FlashSaleStream._thread = None
+                        return
+                try:
+                    FlashSaleStream.poll()
+                except Exception:
+                    connection.close() # e.g. the DB went away: reconnect on the next tick
+                time.sleep(interval)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def open():
+        """SSE body for a new watcher, or None when the process is at FLASH_SALE_STREAM_MAX_CLIENTS."""
+        q = FlashSaleStream.subscribe()
+        return None if q is None else _StreamBody(q)
+
+    @staticmethod
+    def events(q):
+        """Frames for one subscribed watcher: the current snapshot, then delta frames and keep-alives."""
+        try:
+            if FlashSaleStream._counts is None:
+                FlashSaleStream.poll(force=True)
+            yield f"retry: {settings.FLASH_SALE_STREAM_RETRY_MS}\n\n"
+            yield FlashSaleStream.snapshot_frame()
+            while True:
+                try:
+                    yield q.get(timeout=settings.FLASH_SALE_STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            FlashSaleStream.unsubscribe(q)
+
+
+class _StreamBody:
+    """Iterable SSE body; close() frees the watcher's slot even if it was never iterated."""
+
+    def __init__(self, q):
+        self._q = q
+        self._events = FlashSaleStream.events(q)
+
+    def __iter__(self):
+        return self._events
+
+    def close(self):
+        self._events.close()
+        FlashSaleStream.unsubscribe(self._q)
+
+
+class ActiveFlashSaleFeed:
+    """
+    🛍️ Prebuilt /api/flash-sales/active/ payload
+    FlashSaleSerializer (nested products, tags and tag stats) runs once per
+    change instead of once per request: the rendered JSON bytes are cached
+    under the promotion index version plus the feed's own version (FlashSale
+    and campaign saves). sold_count and stock are left as placeholders and
+    filled in from one primary-key query per request. A payload expires at the
+    next start/end of a sale in it (status flips) and after
+    FLASH_SALE_FEED_CACHE_SECONDS (product titles, prices and tags).
+    """
+    VERSION_KEY = 'flash_sales:feed:version'
+    HOT_FIELDS = ('sold_count', 'stock')
+
+    _build_lock = threading.Lock()
+
+    @staticmethod
+    def version():
+        version = cache.get(ActiveFlashSaleFeed.VERSION_KEY)
+        if version is None:
+            cache.add(ActiveFlashSaleFeed.VERSION_KEY, int(time.time() * 1000), timeout=None)
+            version = cache.get(ActiveFlashSaleFeed.VERSION_KEY)
+        return version
+
+    @staticmethod
+    def invalidate():
+        try:
+            cache.incr(ActiveFlashSaleFeed.VERSION_KEY)
+        except ValueError:
+            ActiveFlashSaleFeed.version()
+
+    @staticmethod
+    def get(now=None):
+        """The cached entry {body, token, fsp_ids, valid_until}, built if missing or expired."""
+        now = now or timezone.now()
+        cache_key = f'flash_sales:feed:v{ActiveFlashSaleFeed.version()}:{cache.get(PromotionIndex.VERSION_KEY)}'
+
+        def expired(entry):
+            return entry is None or (entry['valid_until'] is not None and now >= entry['valid_until'])
+
+        entry = cache.get(cache_key)
+        if expired(entry):
+            # One build per process when a boundary passes under load
+            with ActiveFlashSaleFeed._build_lock:
+                entry = cache.get(cache_key)
+                if expired(entry):
+                    entry = ActiveFlashSaleFeed.build(now)
+                    cache.set(cache_key, entry, settings.FLASH_SALE_FEED_CACHE_SECONDS)
+        return entry
+
+    @staticmethod
+    def build(now):
+        # serializers imports this module
+        from rest_framework.renderers import JSONRenderer
+        from .serializers import FlashSaleSerializer, tag_product_stats
+
+        sales = list(
+            FlashSale.objects.filter(end_time__gte=now, is_active=True)
+            .order_by('-id')
+            .select_related('campaign')
+            .prefetch_related('products__product__tags')
+        )
+        counts, thumbnails = tag_product_stats({
+            tag.id for sale in sales for fsp in sale.products.all() for tag in fsp.product.tags.all()
+        })
+        data = FlashSaleSerializer(sales, many=True, context={
+            'tag_product_counts': counts,
+            'tag_product_thumbnails': thumbnails,
+        }).data
+
+        # Random per build, so product text can never look like a placeholder
+        token = secrets.token_hex(8)
+        fsp_ids = []
+        for sale in data:
+            for item in sale['products']:
+                fsp_ids.append(item['id'])
+                for field in ActiveFlashSaleFeed.HOT_FIELDS:
+                    item[field] = f'{token}:{field}:{item["id"]}'
+
+        boundaries = [
+            t for sale in sales
+            for t in (sale.start_time, sale.end_time + timedelta(microseconds=1)) # end_time is inclusive
+            if t > now
+        ]
+        return {
+            'body': JSONRenderer().render(data),
+            'token': token,
+            'fsp_ids': fsp_ids,
+            'valid_until': min(boundaries) if boundaries else None,
+        }
+
+    @staticmethod
+    def render(now=None):
+        """JSON bytes of the active sales with current sold_count / stock merged in."""
+        entry = ActiveFlashSaleFeed.get(now)
+        if not entry['fsp_ids']:
+            return entry['body']
+
+        hot = {
+            fsp_id: {'sold_count': sold, 'stock': stock}
+            for fsp_id, sold, stock in FlashSaleProduct.objects.filter(
+                id__in=entry['fsp_ids']
+            ).values_list('id', 'sold_count', 'product__stock')
+        }
+        placeholder = re.compile(rb'"' + entry['token'].encode() + rb':(sold_count|stock):(\d+)"')
+        return placeholder.sub(
+            lambda m: str(hot.get(int(m.group(2)), {}).get(m.group(1).decode(), 0)).encode(),
+            entry['body']
+        )
+
+
+@receiver(post_save, sender=FlashSale)
+@receiver(post_delete, sender=FlashSale)
+@receiver(post_save, sender=FlashSaleCampaign)
+@receiver(post_delete, sender=FlashSaleCampaign)
+def _invalidate_flash_sale_feed(sender, **kwargs):
+    # Product-level changes already move the promotion index version
+    ActiveFlashSaleFeed.invalidate()
+    transaction.on_commit(ActiveFlashSaleFeed.invalidate)
+
+
+class PromoUsageService:
+    """
+    📊 Per-user promo usage counters (PromoUsageCounter)
+    Checkout increments the (user, promo, local day) counters of an order in
+    its own transaction (record_order); other PromoUsageLog writes count
+    through the log. Limit checks read the counter's unique index instead of
+    COUNT(*) over the raw log (which can then be pruned): today's row plus
+    the sum of the day rows for lifetime limits.
+    """
+
+    @staticmethod
+    def record(entries):
+        """
+        entries: iterable of (user_id, promo_type, promo_id, day).
+        Two statements for any number of entries: create missing counters,
+        then one UPDATE count = count + n.
+        """
+        deltas = defaultdict(int)
+        for key in entries:
+            deltas[key] += 1
+        if not deltas:
+            return
+
+        PromoUsageCounter.objects.bulk_create(
+            [
+                PromoUsageCounter(user_id=user_id, promo_type=promo_type, promo_id=promo_id, day=day, count=0)
+                for (user_id, promo_type, promo_id, day) in deltas
+            ],
+            ignore_conflicts=True
+        )
+
+        match = Q()
+        whens = []
+        for (user_id, promo_type, promo_id, day), n in deltas.items():
+            key_q = Q(user_id=user_id, promo_type=promo_type, promo_id=promo_id, day=day)
+            match |= key_q
+            whens.append(When(key_q, then=Value(n)))
+        PromoUsageCounter.objects.filter(match).update(
+            count=F('count') + Case(*whens, default=Value(0), output_field=IntegerField())
+        )
+
+    @staticmethod
+    def record_order(user, order, lines, coupon=None):
+        """
+        Count an order's coupon and Flash Sales for its user. Runs inside the
+        checkout transaction, so the next checkout's limit check sees it.
+        """
+        day = timezone.localdate(order.created_at)
+        entries = [(user.id, 'coupon', coupon.id, day)] if coupon else []
+        entries += [
+            (user.id, 'flash', flash_sale_id, day)
+            for flash_sale_id in sorted({l['flash_sale_product'].flash_sale_id for l in lines if l['flash_sale_product']})
+        ]
+        PromoUsageService.record(entries)
+
+    @staticmethod
+    def record_logs(logs):
+        """Counter entries for PromoUsageLog rows that were bulk-inserted (no signals)."""
+        now = timezone.now()
+        PromoUsageService.record(
+            (log.user_id, log.promo_type, log.promo_id, timezone.localdate(log.timestamp or now))
+            for log in logs
+        )
+
+    @staticmethod
+    def usage_many(user, promo_type, promo_ids, today=None):
+        """{promo_id: (used_today, used_lifetime)} for many promos in one query."""
+        today = today or timezone.localdate()
+        if not promo_ids:
+            return {}
+        rows = PromoUsageCounter.objects.filter(
+            user=user,
+            promo_type=promo_type,
+            promo_id__in=list(promo_ids)
+        ).values('promo_id').annotate(
+            lifetime=Sum('count'),
+            today=Sum('count', filter=Q(day=today))
+        ).order_by()
+        return {r['promo_id']: (r['today'] or 0, r['lifetime'] or 0) for r in rows}
+
+    @staticmethod
+    def usage(user, promo_type, promo_id, today=None):
+        """Returns (used_today, used_lifetime) with one indexed query."""
+        today = today or timezone.localdate()
+        usage = PromoUsageCounter.objects.filter(
+            user=user,
+            promo_type=promo_type,
+            promo_id=promo_id
+        ).aggregate(
+            lifetime=Sum('count'),
+            today=Sum('count', filter=Q(day=today))
+        )
+        return usage['today'] or 0, usage['lifetime'] or 0
+
+
+@receiver(post_save, sender=PromoUsageLog)
+def _count_promo_usage(sender, instance, created, **kwargs):
+    if created:
+        PromoUsageService.record_logs([instance])
+
+class CouponRules:
+    """
+    Compiled form of a coupon's JSON rules (roles, conditions, tiers).
+    Built once per coupon and reused until the coupon is saved again.
+    """
+
+    def __init__(self, coupon):
+        self.source = CouponRules.source_of(coupon)
+
+        self.allowed_roles = frozenset(coupon.target_user_roles or coupon.allowed_roles or [])
+        self.new_user_only = 'new_user' in self.allowed_roles
+
+        conditions = coupon.conditions or {}
+        self.has_conditions = bool(conditions)
+        self.exclude_categories = frozenset(conditions.get('exclude_categories', []))
+        self.exclude_products = frozenset(conditions.get('exclude_products', []))
+
+        # Highest tier first: [(min, disc), ...]
+        self.tiers = sorted(
+            ((Decimal(str(r.get('min', 0))), Decimal(str(r.get('disc', 0)))) for r in (coupon.tiered_rules or [])),
+            key=lambda t: t[0],
+            reverse=True
+        )
+
+    @staticmethod
+    def source_of(coupon):
+        return (coupon.conditions, coupon.tiered_rules, coupon.allowed_roles, coupon.target_user_roles)
+
+    def role_error(self, user_role):
+        if not self.allowed_roles or user_role in self.allowed_roles:
+            return None
+        # Friendly Message for New User
+        if self.new_user_only:
+            return "ขออภัยครับ คูปองนี้สำหรับสมาชิกใหม่เท่านั้น"
+        return "ขออภัย คุณไม่ได้รับสิทธิ์ในการใช้คูปองนี้"
+
+    def is_excluded(self, product):
+        return product.category_id in self.exclude_categories or product.id in self.exclude_products
+
+    def tier_discount(self, price):
+        for min_spend, disc in self.tiers:
+            if price >= min_spend:
+                return disc # Apply highest tier only
+        return Decimal(0)
+
+
+class CouponCodeFilter:
+    """
+    🧹 In-process Bloom filter of every coupon code
+    Unknown codes (typos, brute-force guessing) are rejected before any query;
+    a "maybe" still goes to the DB, so false positives only cost the lookup
+    they would have cost anyway. Codes are case-folded because the MySQL
+    collation matches codes case-insensitively.
+
+    Coupon writes add the code locally and bump a version in the Django cache;
+    other processes rebuild when they see a new version. With a per-process
+    cache (LocMemCache, CACHE_IS_SHARED=False) they cannot see it, so a miss
+    is not trusted and the lookup goes to the DB ('unverified').
+    """
+    VERSION_KEY = 'coupons:codes:version'
+    FALSE_POSITIVE_RATE = 0.001
+
+    _lock = threading.Lock()
+    _bits = None
+    _size = 0
+    _hashes = 0
+    _version = None
+    _built_at = 0.0
+    stats = {'rejected': 0, 'passed': 0, 'unverified': 0, 'false_positives': 0, 'rebuilds': 0}
+
+    @staticmethod
+    def _normalize(code):
+        return str(code).strip().casefold().encode()
+
+    @staticmethod
+    def _positions(code, size, hashes):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(CouponCodeFilter._normalize(code), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % size for i in range(hashes)]
+
+    @staticmethod
+    def rebuild():
+        """Load every code with one query and swap in a freshly sized filter."""
+        version = cache.get(CouponCodeFilter.VERSION_KEY)
+        codes = list(Coupon.objects.values_list('code', flat=True))
+
+        n = max(len(codes), 64) # Headroom for coupons added before the next rebuild
+        size = max(int(-n * math.log(CouponCodeFilter.FALSE_POSITIVE_RATE) / (math.log(2) ** 2)), 512)
+        hashes = max(int(round(size / n * math.log(2))), 1)
+        bits = bytearray((size + 7) // 8)
+        for code in codes:
+            for pos in CouponCodeFilter._positions(code, size, hashes):
+                bits[pos >> 3] |= 1 << (pos & 7)
+
+        with CouponCodeFilter._lock:
+            CouponCodeFilter._bits, CouponCodeFilter._size, CouponCodeFilter._hashes = bits, size, hashes
+            CouponCodeFilter._version = version
+            CouponCodeFilter._built_at = time.monotonic()
+            CouponCodeFilter.stats['rebuilds'] += 1
+
+    @staticmethod
+    def _is_stale():
+        if CouponCodeFilter._bits is None:
+            return True
+        if time.monotonic() - CouponCodeFilter._built_at > settings.COUPON_CODE_FILTER_MAX_AGE:
+            return True
+        return cache.get(CouponCodeFilter.VERSION_KEY) != CouponCodeFilter._version
+
+    @staticmethod
+    def add(code):
+        """Make a newly saved code pass right away in this process."""
+        with CouponCodeFilter._lock:
+            if CouponCodeFilter._bits is None:
+                return
+            for pos in CouponCodeFilter._positions(code, CouponCodeFilter._size, CouponCodeFilter._hashes):
+                CouponCodeFilter._bits[pos >> 3] |= 1 << (pos & 7)
+
+    @staticmethod
+    def invalidate():
+        try:
+            version = cache.incr(CouponCodeFilter.VERSION_KEY)
+        except ValueError:
+            cache.add(CouponCodeFilter.VERSION_KEY, int(time.time() * 1000), timeout=None)
+            return
+        with CouponCodeFilter._lock:
+            # This process already applied the change with add(): no rebuild here
+            if CouponCodeFilter._version == version - 1:
+                CouponCodeFilter._version = version
+
+    @staticmethod
+    def might_exist(code):
+        """False = the code is certainly not a coupon (no query needed)."""
+        if not code:
+            return False
+        if CouponCodeFilter._is_stale():
+            CouponCodeFilter.rebuild()
+        bits = CouponCodeFilter._bits
+        found = all(
+            bits[pos >> 3] & (1 << (pos & 7))
+            for pos in CouponCodeFilter._positions(code, CouponCodeFilter._size, CouponCodeFilter._hashes)
+        )
+        if not found and not settings.CACHE_IS_SHARED:
+            # Another worker may have created it since our last rebuild: let the DB decide
+            CouponCodeFilter.stats['unverified'] += 1
+            return True
+        CouponCodeFilter.stats['passed' if found else 'rejected'] += 1
+        return found
+
+    @staticmethod
+    def record_false_positive():
+        CouponCodeFilter.stats['false_positives'] += 1
+
+    @staticmethod
+    def snapshot():
+        """Counters for monitoring; 'queries_saved' = lookups that never reached the DB."""
+        stats = dict(CouponCodeFilter.stats)
+        lookups = stats['rejected'] + stats['passed'] + stats['unverified']
+        stats.update(
+            lookups=lookups,
+            queries_saved=stats['rejected'],
+            reject_rate=round(stats['rejected'] / lookups, 4) if lookups else 0,
+            size_bytes=len(CouponCodeFilter._bits or b''),
+            hash_functions=CouponCodeFilter._hashes,
+        )
+        return stats
+
+
+@receiver(post_save, sender=Coupon)
+def _add_coupon_code(sender, instance, created, **kwargs):
+    # used_count / collected_count saves do not touch the code: no rebuilds
+    if created or _changed_since_load(instance, ('code',)):
+        CouponCodeFilter.add(instance.code)
+        # Again on commit, in case another process rebuilt before the row was visible
+        CouponCodeFilter.invalidate()
+        transaction.on_commit(CouponCodeFilter.invalidate)
+        _remember_saved_values(instance, ('code',))
+
+
+@receiver(post_delete, sender=Coupon)
+def _drop_coupon_code(sender, instance, **kwargs):
+    # Bloom filters cannot remove; the next rebuild (other processes) drops the code
+    transaction.on_commit(CouponCodeFilter.invalidate)
+
+
 class CouponService:
+    # coupon id -> CouponRules (dropped on coupon save/delete; a stale entry
+    # saved by another process is detected by comparing the raw JSON source)
+    _rules_cache = {}
+
+    @staticmethod
+    def get_rules(coupon):
+        rules = CouponService._rules_cache.get(coupon.id)
+        if rules is None or rules.source != CouponRules.source_of(coupon):
+            rules = CouponRules(coupon)
+            CouponService._rules_cache[coupon.id] = rules
+        return rules
+
+    @staticmethod
+    def invalidate_rules(coupon_id):
+        CouponService._rules_cache.pop(coupon_id, None)
+
+    @staticmethod
+    def _resolve_products(cart_items):
+        """Products referenced by id in API payloads, fetched with one in_bulk()."""
+        ids = set()
+        for item in cart_items:
+            if isinstance(item, dict) and not item.get('product') and item.get('id'):
+                try:
+                    ids.add(int(item['id']))
+                except (TypeError, ValueError):
+                    continue
+        return Product.objects.in_bulk(ids) if ids else {}
+
     @staticmethod
     def validate_coupon(user, coupon_code, cart_total, cart_items=None):
         """
         Validate coupon for a specific cart context.
+        At most: coupon row, one usage aggregate, wallet check, one in_bulk.
         Returns (is_valid, message, coupon_obj)
         """
-        now = timezone.now()
-        
+        # 🧹 Unknown codes are rejected without a query
+        if not CouponCodeFilter.might_exist(coupon_code):
+            return False, "ไม่พบรหัสคูปองนี้", None
         try:
             coupon = Coupon.objects.get(code=coupon_code)
         except Coupon.DoesNotExist:
+            CouponCodeFilter.record_false_positive()
             return False, "ไม่พบรหัสคูปองนี้", None
+
+        is_valid, message = CouponService.check_coupon(coupon, user, cart_total, cart_items)
+        return is_valid, message, (coupon if is_valid else None)
+
+    @staticmethod
+    def check_coupon(coupon, user, cart_total, cart_items=None, now=None, usage=None, in_wallet=None):
+        """
+        Rule checks for an already loaded coupon. usage=(used_today, used_lifetime)
+        and in_wallet can be passed in when preloaded for many coupons at once;
+        otherwise they are queried here.
+        Returns (is_valid, message)
+        """
+        now = now or timezone.now()
             
         # 1. Basic Status
         if not coupon.active:
-            return False, "ขออภัย คูปองนี้ถูกยกเลิกหรือหมดอายุการใช้งานแล้วครับ", None
+            return False, "ขออภัย คูปองนี้ถูกยกเลิกหรือหมดอายุการใช้งานแล้วครับ"
         
         if not (coupon.start_date <= now <= coupon.end_date):
-            return False, "คูปองนี้ยังไม่เปิดให้ใช้งาน หรือหมดเขตไปแล้วครับ", None
+            return False, "คูปองนี้ยังไม่เปิดให้ใช้งาน หรือหมดเขตไปแล้วครับ"
             
         # V2: Total Supply Check (respect the tighter limit)
         global_limit = min(coupon.total_supply, coupon.usage_limit)
         if coupon.used_count >= global_limit:
-            return False, "เสียใจด้วยครับ สิทธิ์ของคูปองนี้ถูกใช้จองเต็มหมดแล้ว (Fully Redeemed)", None
+            return False, "เสียใจด้วยครับ สิทธิ์ของคูปองนี้ถูกใช้จองเต็มหมดแล้ว (Fully Redeemed)"
+
+        rules = CouponService.get_rules(coupon)
             
         # 2. User Quota
         if user and user.is_authenticated:
             # Check Role (V2 target_user_roles)
-            allowed_roles = coupon.target_user_roles or coupon.allowed_roles
-            if allowed_roles:
-                user_role = getattr(user, 'role', 'customer')
-                if user_role not in allowed_roles:
-                     # Friendly Message for New User
-                     if 'new_user' in allowed_roles:
-                         return False, "ขออภัยครับ คูปองนี้สำหรับสมาชิกใหม่เท่านั้น", None
-                     return False, "ขออภัย คุณไม่ได้รับสิทธิ์ในการใช้คูปองนี้", None
+            role_error = rules.role_error(getattr(user, 'role', 'customer'))
+            if role_error:
+                return False, role_error
+
+            # Daily + lifetime usage from the materialized counters (one query)
+            if usage is None:
+                usage = PromoUsageService.usage(user, 'coupon', coupon.id, timezone.localdate(now))
+            used_today, used_lifetime = usage
 
             # V2: Daily Limit
             if coupon.limit_per_user_per_day > 0:
-                daily_usage = PromoUsageLog.objects.filter(
-                    user=user, 
-                    promo_type='coupon', 
-                    promo_id=coupon.id,
-                    timestamp__date=now.date()
-                ).count()
-                if daily_usage >= coupon.limit_per_user_per_day:
-                    return False, f"คุณใช้สิทธิ์ครบโควต้าต่อวันแล้ว ({coupon.limit_per_user_per_day} สิทธิ์)", None
+                if used_today >= coupon.limit_per_user_per_day:
+                    return False, f"คุณใช้สิทธิ์ครบโควต้าต่อวันแล้ว ({coupon.limit_per_user_per_day} สิทธิ์)"
 
             # V2: Campaign Limit (Check Wallet first)
-            wallet_exists = UserCoupon.objects.filter(user=user, coupon=coupon).exists()
-            if not wallet_exists:
+            if in_wallet is None:
+                in_wallet = UserCoupon.objects.filter(user=user, coupon=coupon).exists()
+            if not in_wallet:
                  # Logic for "Public Coupon" that user types in without collecting
                  # Check usage history
-                 lifetime_usage = PromoUsageLog.objects.filter(user=user, promo_type='coupon', promo_id=coupon.id).count()
-                 if lifetime_usage >= coupon.limit_per_user:
-                     return False, "คุณใช้สิทธิ์ครบตามจำนวนที่กำหนดแล้ว", None
+                 if used_lifetime >= coupon.limit_per_user:
+                     return False, "คุณใช้สิทธิ์ครบตามจำนวนที่กำหนดแล้ว"
 
         # 3. Min Spend
         if cart_total < coupon.min_spend:
-            return False, f"ยอดซื้อไม่ถึงขั้นต่ำ ({coupon.min_spend:,.2f} บาท)", None
+            return False, f"ยอดซื้อไม่ถึงขั้นต่ำ ({coupon.min_spend:,.2f} บาท)"
             
         # 4. JSON Conditions (Exclude Categories/Products)
-        if cart_items and coupon.conditions:
-            exclude_cats = coupon.conditions.get('exclude_categories', [])
-            exclude_products = coupon.conditions.get('exclude_products', [])
-            
+        if cart_items and rules.has_conditions:
+            # ✅ Resolve every product referenced by id (API Payload uses 'id') in one query
+            products = CouponService._resolve_products(cart_items)
+
             valid_items_total = 0
             for item in cart_items:
                 product = item.get('product') if isinstance(item, dict) else item.product
-                
-                # ✅ V2 Fix: Resolve Product from ID if missing (API Payload uses 'id')
                 if not product and isinstance(item, dict):
-                    p_id = item.get('id')
-                    if not p_id: 
-                        continue # Add check to avoid id=None query
-                        
                     try:
-                        product = Product.objects.get(id=p_id)
-                    except (Product.DoesNotExist, ValueError): # Catch ValueError too
+                        product = products.get(int(item.get('id')))
+                    except (TypeError, ValueError):
                         continue # Skip invalid item
 
                 if not product: continue # Safety check
@@ -150,16 +1060,104 @@ class CouponService:
                 price = item.get('price', product.price) # Handle dict or obj
                 qty = item.get('quantity', 1)
                 
-                if product.category_id in exclude_cats or product.id in exclude_products:
-                    continue # Skip this item for min_spend calc? Or fail? 
-                    # Usually we just don't count it towards min_spend
+                if rules.is_excluded(product):
+                    continue # Usually we just don't count it towards min_spend
                 
                 valid_items_total += price * qty
             
             if valid_items_total < coupon.min_spend:
-                 return False, f"ยอดซื้อสินค้าที่ร่วมรายการไม่ถึงขั้นต่ำ ({coupon.min_spend:,.2f} บาท)", None
+                 return False, f"ยอดซื้อสินค้าที่ร่วมรายการไม่ถึงขั้นต่ำ ({coupon.min_spend:,.2f} บาท)"
+
+        return True, "คูปองใช้ได้"
+
+    @staticmethod
+    def claim(user, coupon, now=None):
+        """
+        Collect a coupon into the user's wallet without counting UserCoupon.
+        The wallet row goes in first (unique user+coupon rejects repeats),
+        then supply is taken with one guarded UPDATE on collected_count, so the
+        hot coupon row is locked only until commit. Raises ValueError.
+        """
+        now = now or timezone.now()
+        if coupon.limit_per_user < 1:
+            raise ValueError("คุณเก็บคูปองนี้ครบจำนวนสิทธิ์แล้ว")
+
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    user_coupon = UserCoupon.objects.create(user=user, coupon=coupon, status='active')
+            except IntegrityError:
+                raise ValueError("คุณเก็บคูปองนี้ครบจำนวนสิทธิ์แล้ว")
+
+            claimed = Coupon.objects.filter(
+                pk=coupon.pk,
+                active=True,
+                start_date__lte=now,
+                end_date__gte=now,
+                collected_count__lt=Greatest(F('total_supply'), F('usage_limit'))
+            ).update(collected_count=F('collected_count') + 1)
+
+            if not claimed:
+                # Undo the wallet row; tell the user why
+                if not coupon.active or not (coupon.start_date <= now <= coupon.end_date):
+                    raise ValueError("คูปองหมดอายุหรือยังไม่เปิดให้เก็บ")
+                raise ValueError("คูปองหมดแล้ว!")
+
+        return user_coupon
+
+    @staticmethod
+    def best_coupons(user, items, now=None):
+        """
+        🏆 Evaluate every live auto-apply coupon and every active wallet coupon
+        against one priced cart. Fixed query count: cart pricing (2), wallet,
+        candidate coupons, usage counters.
+        Checkout takes one coupon per order, so the best combination is the
+        cart's Flash Sale pricing plus the single best coupon that may stack.
+        Returns {'pricing', 'best', 'candidates'}; each candidate is
+        {'coupon', 'valid', 'message', 'discount_amount'}, best first.
+        """
+        now = now or timezone.now()
+        pricing = PriceCalculator.price_cart(user, items, now=now)
+        subtotal = pricing['subtotal']
+        shipping_cost = pricing['shipping_cost']
+        # Conditions see the same base prices checkout validates with
+        cart_items = [{"product": line['product'], "quantity": line['quantity']} for line in pricing['lines']]
+
+        wallet = dict(UserCoupon.objects.filter(user=user).values_list('coupon_id', 'status'))
+        coupons = list(
+            Coupon.objects.filter(active=True, start_date__lte=now, end_date__gte=now)
+            .filter(Q(auto_apply=True) | Q(id__in=[cid for cid, st in wallet.items() if st == 'active']))
+        )
+        usage = PromoUsageService.usage_many(user, 'coupon', [c.id for c in coupons], timezone.localdate(now))
 
-        return True, "คูปองใช้ได้", coupon
+        candidates = []
+        for coupon in coupons:
+            valid, message = CouponService.check_coupon(
+                coupon, user, subtotal, cart_items, now=now,
+                usage=usage.get(coupon.id, (0, 0)), in_wallet=coupon.id in wallet
+            )
+            if valid and pricing['has_flash_sale_item'] and not coupon.is_stackable_with_flash_sale:
+                valid, message = False, "คูปองนี้ไม่สามารถใช้ร่วมกับสินค้า Flash Sale ได้"
+
+            discount = Decimal(0)
+            if valid:
+                discount = min(
+                    CouponService.calculate_discount(coupon, subtotal, shipping_cost),
+                    subtotal + shipping_cost
+                )
+            candidates.append({
+                "coupon": coupon,
+                "valid": valid,
+                "message": message,
+                "discount_amount": discount
+            })
+
+        # Biggest discount first, then coupon priority, then the one expiring soonest
+        candidates.sort(key=lambda c: (
+            not c['valid'], -c['discount_amount'], -c['coupon'].priority, c['coupon'].end_date
+        ))
+        best = candidates[0] if candidates and candidates[0]['valid'] and candidates[0]['discount_amount'] > 0 else None
+        return {"pricing": pricing, "best": best, "candidates": candidates}
 
     @staticmethod
     def calculate_discount(coupon, original_price, shipping_cost=0):
@@ -174,14 +1172,8 @@ class CouponService:
         # V2: Tiered Discount Logic
         if coupon.discount_type == 'tiered':
             # Rules example: [{'min': 3000, 'disc': 500}, {'min': 1000, 'disc': 100}]
-            # Sort by min desc
-            rules = sorted(coupon.tiered_rules, key=lambda x: x.get('min', 0), reverse=True)
-            for rule in rules:
-                if price >= Decimal(rule.get('min', 0)):
-                    # Check if disc is fixed or percent? Assume fixed for now basic tiered
-                    # Or check rule structure. Let's assume 'disc' is fixed amount.
-                    discount = Decimal(rule.get('disc', 0))
-                    break # Apply highest tier only
+            # 'disc' is a fixed amount; tiers are pre-sorted in CouponRules
+            discount = CouponService.get_rules(coupon).tier_discount(price)
                     
         elif coupon.discount_type == 'fixed':
             discount = coupon.discount_value
@@ -199,16 +1191,344 @@ class CouponService:
         # Cap at price
         return min(discount, price)
 
-class PriceCalculator:
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def _invalidate_coupon_rules(sender, instance, **kwargs):
+    CouponService.invalidate_rules(instance.id)
+
+
+class PublicCouponCatalog:
     """
-    The Brain: Compares and selects the best deal.
+    🎟️ Precomputed public coupon list (GET /api/coupons-public/)
+    Built with one query and cached under a version number that every Coupon
+    or UserCoupon write bumps, so page loads only reach the DB after something
+    changed. A payload also expires when the first coupon in it ends.
     """
+    VERSION_KEY = 'coupons:public:version'
+
     @staticmethod
-    def calculate_best_item_price(product, user, quantity=1, applied_coupon=None):
-        """
-        Determine the best price for a single item type.
-        Returns: {
-            'final_price': Decimal,
+    def version():
+        version = cache.get(PublicCouponCatalog.VERSION_KEY)
+        if version is None:
+            # Start from the clock so a lost version key never revives an old payload
+            cache.add(PublicCouponCatalog.VERSION_KEY, int(time.time() * 1000), timeout=None)
+            version = cache.get(PublicCouponCatalog.VERSION_KEY)
+        return version
+
+    @staticmethod
+    def invalidate():
+        try:
+            cache.incr(PublicCouponCatalog.VERSION_KEY)
+        except ValueError:
+            PublicCouponCatalog.version()
+
+    @staticmethod
+    def get(now=None):
+        """Returns (etag, payload) of the current public coupon list."""
+        now = now or timezone.now()
+        cache_key = f'coupons:public:v{PublicCouponCatalog.version()}'
+        entry = cache.get(cache_key)
+        if entry is None or (entry['valid_until'] and now > entry['valid_until']):
+            entry = PublicCouponCatalog.build(now)
+            cache.set(cache_key, entry, settings.PUBLIC_COUPONS_CACHE_SECONDS)
+        return entry['etag'], entry['payload']
+
+    @staticmethod
+    def build(now):
+        payload = []
+        valid_until = None
+        for c in Coupon.objects.filter(active=True, end_date__gte=now):
+            # Basic validation only
+            if c.usage_limit > 0 and c.used_count >= c.usage_limit:
+                continue
+            payload.append({
+                "id": c.id,
+                "code": c.code,
+                "discount_type": c.discount_type,
+                "discount_value": c.discount_value,
+                "min_spend": c.min_spend,
+                "end_date": c.end_date,
+                "start_date": c.start_date, # Added for frontend check
+                "allowed_roles": c.allowed_roles,
+                "conditions": c.conditions, # ✅ FIXED: Include conditions (e.g. new_user: true)
+                "remaining": max(max(c.total_supply, c.usage_limit) - c.collected_count, 0),
+                "description": f"ส่วนลด {c.discount_value} {'%' if c.discount_type == 'percent' else 'บาท'}"
+            })
+            valid_until = c.end_date if valid_until is None else min(valid_until, c.end_date)
+
+        body = json.dumps(payload, cls=DjangoJSONEncoder, sort_keys=True)
+        return {
+            'etag': '"%s"' % hashlib.sha1(body.encode()).hexdigest(),
+            'payload': payload,
+            'valid_until': valid_until,
+        }
+
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+@receiver(post_save, sender=UserCoupon)
+@receiver(post_delete, sender=UserCoupon)
+def _invalidate_public_coupons(sender, **kwargs):
+    # Bump now (this process / tests) and again once the write is visible to
+    # other connections, so a rebuild that raced the commit is thrown away
+    PublicCouponCatalog.invalidate()
+    transaction.on_commit(PublicCouponCatalog.invalidate)
+
+
+class CouponStatsService:
+    """
+    📈 Coupon dashboard rollup (CouponDailyStat)
+    Order and wallet changes are applied as deltas on (coupon, day) rows, so
+    analytics read a few grouped rows instead of aggregating orders per coupon.
+    """
+    PAID_STATUSES = ('Paid', 'Processing', 'Shipped', 'Completed')
+    FIELDS = (
+        ('uses', IntegerField()),
+        ('revenue', DecimalField(max_digits=14, decimal_places=2)),
+        ('discount', DecimalField(max_digits=12, decimal_places=2)),
+        ('collections', IntegerField()),
+    )
+
+    @staticmethod
+    def order_entry(coupon_id, status, total_price, discount_amount, created_at):
+        """((coupon_id, day), (uses, revenue, discount, collections)) an order adds, or None."""
+        if not coupon_id or status not in CouponStatsService.PAID_STATUSES:
+            return None
+        return (
+            (coupon_id, timezone.localdate(created_at)),
+            (1, total_price or Decimal(0), discount_amount or Decimal(0), 0)
+        )
+
+    @staticmethod
+    def apply(entries, sign=1):
+        """
+        entries: iterable of ((coupon_id, day), (uses, revenue, discount, collections)).
+        Two statements for any number of rows: create missing rows, then one
+        UPDATE adding every delta.
+        """
+        deltas = defaultdict(lambda: [0, Decimal(0), Decimal(0), 0])
+        for key, values in entries:
+            for i, v in enumerate(values):
+                deltas[key][i] += sign * v
+        deltas = {key: values for key, values in deltas.items() if any(values)}
+        if not deltas:
+            return
+
+        CouponDailyStat.objects.bulk_create(
+            [CouponDailyStat(coupon_id=coupon_id, day=day) for (coupon_id, day) in deltas],
+            ignore_conflicts=True
+        )
+
+        match = Q()
+        whens = defaultdict(list)
+        for (coupon_id, day), values in deltas.items():
+            key_q = Q(coupon_id=coupon_id, day=day)
+            match |= key_q
+            for (field, _), v in zip(CouponStatsService.FIELDS, values):
+                if v:
+                    whens[field].append(When(key_q, then=Value(v)))
+        CouponDailyStat.objects.filter(match).update(**{
+            field: F(field) + Case(*whens[field], default=Value(0), output_field=output_field)
+            for field, output_field in CouponStatsService.FIELDS
+            if whens[field]
+        })
+
+    @staticmethod
+    def rebuild(coupon_ids=None):
+        """
+        Recompute the rollup (all coupons, or only coupon_ids) from one grouped
+        aggregate over orders and one over wallet rows. Returns rows written.
+        """
+        orders = Order.objects.filter(coupon__isnull=False, status__in=CouponStatsService.PAID_STATUSES)
+        wallets = UserCoupon.objects.all()
+        stats = CouponDailyStat.objects.all()
+        if coupon_ids is not None:
+            coupon_ids = list(coupon_ids)
+            orders = orders.filter(coupon_id__in=coupon_ids)
+            wallets = wallets.filter(coupon_id__in=coupon_ids)
+            stats = stats.filter(coupon_id__in=coupon_ids)
+
+        rows = defaultdict(lambda: [0, Decimal(0), Decimal(0), 0])
+        for r in orders.annotate(day=TruncDate('created_at')).values('coupon_id', 'day').annotate(
+            uses=Count('id'), revenue=Sum('total_price'), discount=Sum('discount_amount')
+        ).order_by():
+            row = rows[(r['coupon_id'], r['day'])]
+            row[0], row[1], row[2] = r['uses'], r['revenue'] or 0, r['discount'] or 0
+        for r in wallets.annotate(day=TruncDate('collected_at')).values('coupon_id', 'day').annotate(n=Count('id')).order_by():
+            rows[(r['coupon_id'], r['day'])][3] = r['n']
+
+        with transaction.atomic():
+            stats.delete()
+            CouponDailyStat.objects.bulk_create([
+                CouponDailyStat(
+                    coupon_id=coupon_id, day=day,
+                    uses=uses, revenue=revenue, discount=discount, collections=collections
+                )
+                for (coupon_id, day), (uses, revenue, discount, collections) in rows.items()
+            ], batch_size=1000)
+        return len(rows)
+
+
+def _deleted_with_coupon(origin):
+    # Coupon deletes cascade to the rollup itself; nothing to decrement
+    return isinstance(origin, Coupon) or (isinstance(origin, QuerySet) and origin.model is Coupon)
+
+
+@receiver(pre_save, sender=Order)
+def _snapshot_order_stats(sender, instance, raw=False, **kwargs):
+    instance._coupon_stats_before = None
+    if instance.pk and not raw:
+        before = Order.objects.filter(pk=instance.pk).values_list(
+            'coupon_id', 'status', 'total_price', 'discount_amount', 'created_at'
+        ).first()
+        instance._coupon_stats_before = before and CouponStatsService.order_entry(*before)
+
+
+@receiver(post_save, sender=Order)
+def _update_order_stats(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    before = None if created else getattr(instance, '_coupon_stats_before', None)
+    after = CouponStatsService.order_entry(
+        instance.coupon_id, instance.status, instance.total_price, instance.discount_amount, instance.created_at
+    )
+    entries = [after] if after else []
+    if before:
+        # Status/coupon/total changed: take back what the old state contributed
+        entries.append((before[0], tuple(-v for v in before[1])))
+    CouponStatsService.apply(entries)
+
+
+@receiver(post_delete, sender=Order)
+def _remove_order_stats(sender, instance, origin=None, **kwargs):
+    entry = CouponStatsService.order_entry(
+        instance.coupon_id, instance.status, instance.total_price, instance.discount_amount, instance.created_at
+    )
+    if entry and not _deleted_with_coupon(origin):
+        CouponStatsService.apply([entry], sign=-1)
+
+
+@receiver(post_save, sender=UserCoupon)
+def _count_coupon_collection(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        CouponStatsService.apply([((instance.coupon_id, timezone.localdate(instance.collected_at)), (0, 0, 0, 1))])
+
+
+@receiver(post_delete, sender=UserCoupon)
+def _uncount_coupon_collection(sender, instance, origin=None, **kwargs):
+    if not _deleted_with_coupon(origin):
+        CouponStatsService.apply(
+            [((instance.coupon_id, timezone.localdate(instance.collected_at)), (0, 0, 0, 1))], sign=-1
+        )
+
+
+class PriceCalculator:
+    """
+    The Brain: Compares and selects the best deal.
+    """
+    SHIPPING_COST = Decimal(50) # Flat rate (checkout + coupon preview)
+
+    @staticmethod
+    def price_cart(user, items, coupon=None, now=None):
+        """
+        Price a whole cart in one pass: products in one query, Flash Sale
+        candidates in one query (rounds evaluated once per sale).
+        `coupon` may be a Coupon or a code; coupon problems are reported in
+        'coupon_error' instead of raising. Returns {
+            'lines': [{'product', 'quantity', 'price', 'base_price',
+                       'flash_sale_product', 'source_type', 'line_total'}],
+            'subtotal', 'has_flash_sale_item', 'shipping_cost',
+            'coupon', 'coupon_error', 'discount_amount', 'total'
+        }
+        """
+        now = now or timezone.now()
+        requested = [(int(item['id']), int(item.get('quantity', 1))) for item in items]
+        products = Product.objects.in_bulk({pid for pid, _ in requested})
+        for pid, _ in requested:
+            if pid not in products:
+                raise ValueError(f"สินค้า ID {pid} ไม่พบในระบบ")
+        active_fs = FlashSaleService.pick_live(products.keys(), now)
+
+        lines = []
+        subtotal = Decimal(0)
+        for pid, qty in requested:
+            p = products[pid]
+            fs = active_fs.get(pid)
+            price = fs.sale_price if fs else p.price
+            subtotal += price * qty
+            lines.append({
+                "product": p,
+                "quantity": qty,
+                "price": price,
+                "base_price": p.price,
+                "flash_sale_product": fs,
+                "source_type": 'flash_sale' if fs else 'normal',
+                "line_total": price * qty
+            })
+
+        has_flash_sale_item = any(line['flash_sale_product'] for line in lines)
+        shipping_cost = PriceCalculator.SHIPPING_COST
+        applied, coupon_error, discount = None, None, Decimal(0)
+        if coupon:
+            code = getattr(coupon, 'code', coupon)
+            try:
+                applied, discount = PriceCalculator.apply_coupon(
+                    user, code, subtotal, has_flash_sale_item, items, shipping_cost
+                )
+            except ValueError as e:
+                coupon_error = str(e)
+
+        return {
+            "lines": lines,
+            "subtotal": subtotal,
+            "has_flash_sale_item": has_flash_sale_item,
+            "shipping_cost": shipping_cost,
+            "coupon": applied,
+            "coupon_error": coupon_error,
+            "discount_amount": discount,
+            "total": subtotal + shipping_cost - discount
+        }
+
+    @staticmethod
+    def apply_coupon(user, coupon_code, subtotal, has_flash_sale_item, cart_items, shipping_cost, lock=False):
+        """
+        Validate a coupon against a priced cart and compute its discount.
+        lock=True takes the coupon row FOR UPDATE (checkout).
+        Returns (coupon, discount_amount); raises ValueError when not usable.
+        """
+        if lock:
+            if not CouponCodeFilter.might_exist(coupon_code):
+                raise ValueError("รหัสคูปองไม่ถูกต้อง")
+            # 🔒 Lock Coupon Row to prevent Race Condition
+            try:
+                Coupon.objects.select_for_update().get(code=coupon_code)
+            except Coupon.DoesNotExist:
+                CouponCodeFilter.record_false_positive()
+                raise ValueError("รหัสคูปองไม่ถูกต้อง")
+
+        is_valid, msg, coupon = CouponService.validate_coupon(
+            user=user,
+            coupon_code=coupon_code,
+            cart_total=subtotal, # Validate against Item Subtotal
+            cart_items=cart_items
+        )
+        if not is_valid:
+            raise ValueError(msg)
+
+        # ⚡ Flash Sale Stackability Check
+        if has_flash_sale_item and not coupon.is_stackable_with_flash_sale:
+            raise ValueError("คูปองนี้ไม่สามารถใช้ร่วมกับสินค้า Flash Sale ได้")
+
+        # Discount can never exceed (Subtotal + Shipping)
+        discount = CouponService.calculate_discount(coupon, subtotal, shipping_cost)
+        return coupon, min(discount, Decimal(subtotal) + Decimal(shipping_cost))
+
+    @staticmethod
+    def calculate_best_item_price(product, user, quantity=1, applied_coupon=None):
+        """
+        Determine the best price for a single item type.
+        Returns: {
+            'final_price': Decimal,
             'source_type': 'normal' | 'flash_sale' | 'coupon',
             'ref_id': int | None,
             'discount_amount': Decimal
@@ -276,3 +1596,1250 @@ class PriceCalculator:
                 # Or 'flash_sale_plus_coupon'? Let's keep formatted simple.
                 
         return best_deal
+
+
+class CouponSimulationService:
+    """
+    🧮 Replay a draft coupon over real order baskets
+    The paid-order basket distribution is loaded once per local day into a
+    NumPy array; every draft is then priced against all of it vectorized.
+    """
+    LOOKBACK_DAYS = 90
+    PERCENTILES = (50, 90, 95, 99)
+    FALLBACK_ORDER_VALUE = 500.0 # Basket assumed before there is any paid order to replay
+
+    @staticmethod
+    def order_baskets(today=None):
+        """Item subtotals of paid orders in the lookback window (float64 array, cached per day)."""
+        today = today or timezone.localdate()
+        cache_key = f'coupon_sim:baskets:{today.isoformat()}'
+        baskets = cache.get(cache_key)
+        if baskets is None:
+            since = timezone.now() - timedelta(days=CouponSimulationService.LOOKBACK_DAYS)
+            values = Order.objects.filter(
+                created_at__gte=since,
+                status__in=CouponStatsService.PAID_STATUSES
+            ).annotate(
+                # Older orders have no item_subtotal snapshot; fall back to the paid total
+                basket=Case(When(item_subtotal__gt=0, then=F('item_subtotal')), default=F('total_price'))
+            ).values_list('basket', flat=True)
+            baskets = np.fromiter((float(v) for v in values.iterator(chunk_size=5000)), dtype=np.float64)
+            cache.set(cache_key, baskets, 60 * 60 * 24)
+        return baskets
+
+    @staticmethod
+    def discounts(baskets, discount_type, discount_value, min_spend=0, max_discount_amount=None, tiered_rules=None):
+        """Per-order discount of the draft (0 where it does not qualify), same rules as calculate_discount."""
+        value = float(discount_value)
+        if discount_type == 'tiered':
+            tiers = sorted((float(r.get('min', 0)), float(r.get('disc', 0))) for r in (tiered_rules or []))
+            if tiers:
+                mins = np.array([t[0] for t in tiers])
+                discs = np.array([t[1] for t in tiers])
+                idx = np.searchsorted(mins, baskets, side='right') - 1 # Highest tier reached
+                discount = np.where(idx >= 0, discs[np.clip(idx, 0, None)], 0.0)
+            else:
+                discount = np.zeros_like(baskets)
+        elif discount_type == 'fixed':
+            discount = np.full_like(baskets, value)
+        elif discount_type in ('percent', 'capped_percent'):
+            discount = baskets * value / 100
+            if max_discount_amount and float(max_discount_amount) > 0:
+                discount = np.minimum(discount, float(max_discount_amount))
+        elif discount_type == 'free_shipping':
+            discount = np.full_like(baskets, float(PriceCalculator.SHIPPING_COST))
+        else:
+            raise ValueError(f"ประเภทส่วนลดไม่ถูกต้อง: {discount_type}")
+
+        if discount_type != 'free_shipping':
+            discount = np.minimum(discount, baskets) # Cap at price
+        return np.where(baskets >= float(min_spend or 0), discount, 0.0)
+
+    @staticmethod
+    def simulate(discount_type, discount_value, usage_limit, min_spend=0, max_discount_amount=None,
+                 tiered_rules=None, baskets=None):
+        """
+        Liability of usage_limit redemptions drawn from the historical orders
+        the draft qualifies for. Percentiles use the normal approximation of a
+        sum of usage_limit per-order discounts. With no history every
+        redemption is priced at FALLBACK_ORDER_VALUE (or min_spend if higher),
+        i.e. the worst-case usage_limit x discount estimate.
+        """
+        baskets = CouponSimulationService.order_baskets() if baskets is None else baskets
+        sampled = int(baskets.size)
+        if not sampled:
+            baskets = np.array([max(CouponSimulationService.FALLBACK_ORDER_VALUE, float(min_spend or 0))])
+        discount = CouponSimulationService.discounts(
+            baskets, discount_type, discount_value, min_spend, max_discount_amount, tiered_rules
+        )
+        qualifying = discount > 0
+        n_qualifying = int(qualifying.sum())
+
+        if n_qualifying:
+            per_order = discount[qualifying]
+            order_values = baskets[qualifying]
+            mean, std = float(per_order.mean()), float(per_order.std())
+            avg_basket = float(order_values.mean())
+        else:
+            mean = std = 0.0
+            avg_basket = float(baskets.mean()) if baskets.size else 0.0
+
+        spread = std * usage_limit ** 0.5
+        liability = {
+            f'p{p}': round(max(usage_limit * mean + NormalDist().inv_cdf(p / 100) * spread, 0.0), 2)
+            for p in CouponSimulationService.PERCENTILES
+        }
+        liability['max'] = round(usage_limit * float(per_order.max()), 2) if n_qualifying else 0.0
+
+        expected_liability = usage_limit * mean
+        est_revenue = usage_limit * avg_basket
+        return {
+            'orders_sampled': sampled,
+            'qualifying_orders': n_qualifying if sampled else 0,
+            'qualify_rate': round(n_qualifying / baskets.size, 4) if sampled else 0.0,
+            'avg_order_value': round(float(baskets.mean()), 2),
+            'avg_qualifying_order_value': round(avg_basket, 2),
+            'avg_discount': round(mean, 2),
+            'discount_percentiles': {
+                f'p{p}': round(float(np.percentile(per_order, p)), 2) if n_qualifying else 0.0
+                for p in CouponSimulationService.PERCENTILES
+            },
+            'expected_liability': round(expected_liability, 2),
+            'liability': liability,
+            'est_revenue': round(est_revenue, 2),
+            'break_even': {
+                'roas': round(est_revenue / expected_liability, 2) if expected_liability else 0,
+                # Extra orders of a typical qualifying size needed to earn back the discount spend
+                'incremental_orders': int(np.ceil(expected_liability / avg_basket)) if avg_basket else 0,
+                'discount_share_of_revenue': round(expected_liability / est_revenue, 4) if est_revenue else 0,
+            },
+        }
+
+
+def _per_row_delta(deltas):
+    """
+    Build a CASE expression mapping row id -> delta so a whole batch of
+    counters can be moved with a single UPDATE statement.
+    """
+    return Case(
+        *[When(id=row_id, then=Value(delta)) for row_id, delta in deltas.items()],
+        default=Value(0),
+        output_field=IntegerField()
+    )
+
+class InventoryService:
+    """
+    Stock engines used by checkout.
+    The engine is picked per deployment with settings.CHECKOUT_STOCK_ENGINE:
+    - 'row_lock':    legacy, one SELECT ... FOR UPDATE and one save() per cart line
+    - 'batched':     one ordered FOR UPDATE per table + set-based UPDATEs (default)
+    - 'conditional': no row locks, guarded atomic UPDATEs (hot-SKU throughput)
+    """
+    ENGINES = ('row_lock', 'batched', 'conditional')
+
+    @staticmethod
+    def get_engine():
+        engine = getattr(settings, 'CHECKOUT_STOCK_ENGINE', 'batched')
+        if engine not in InventoryService.ENGINES:
+            raise ValueError(f"Unknown CHECKOUT_STOCK_ENGINE: {engine}")
+        return engine
+
+    @staticmethod
+    def deduct_for_order(cart_items, now=None):
+        """
+        Deduct stock (and Flash Sale quota) for every cart line.
+        Must run inside transaction.atomic(); raises ValueError to abort the order.
+        Returns (lines, total_price, has_flash_sale_item) where each line is
+        {'product', 'quantity', 'price', 'flash_sale_product'}.
+        """
+        now = now or timezone.now()
+        engine = InventoryService.get_engine()
+        if engine == 'row_lock':
+            return InventoryService._deduct_row_lock(cart_items, now)
+        if engine == 'conditional':
+            return InventoryService._deduct_conditional(cart_items, now)
+        return InventoryService._deduct_batched(cart_items, now)
+
+    @staticmethod
+    def _deduct_row_lock(cart_items, now):
+        total_price = 0
+        lines = []
+        has_flash_sale_item = False
+
+        for item in cart_items:
+            try:
+                p = Product.objects.select_for_update().get(id=item['id'])
+            except Product.DoesNotExist:
+                raise ValueError(f"สินค้า ID {item['id']} ไม่พบในระบบ")
+
+            qty = int(item['quantity'])
+
+            # ⚡ Check Active Flash Sale
+            active_fs = FlashSaleService.pick_live([p.id], now, lock=True).get(p.id)
+
+            final_price = p.price
+            used_fs = None
+            if active_fs and active_fs.sold_count + active_fs.reserved_stock < active_fs.quantity_limit:
+                final_price = active_fs.sale_price
+                has_flash_sale_item = True
+                used_fs = active_fs
+
+                fs_remaining = active_fs.quantity_limit - active_fs.sold_count - active_fs.reserved_stock
+                if qty > fs_remaining:
+                    raise ValueError(f"สินค้า '{p.title}' เหลือสิทธิ์ Flash Sale เพียง {fs_remaining} ชิ้น")
+
+                active_fs.sold_count += qty
+                active_fs.save()
+
+            if p.stock < qty:
+                raise ValueError(f"สินค้า '{p.title}' สินค้าหมดหรือมีไม่พอ (เหลือ {p.stock})")
+
+            p.stock -= qty
+            p.save()
+
+            total_price += final_price * qty
+            lines.append({
+                "product": p,
+                "quantity": qty,
+                "price": final_price,
+                "flash_sale_product": used_fs
+            })
+
+        return lines, total_price, has_flash_sale_item
+
+    @staticmethod
+    def _load_cart_rows(cart_items, now, lock):
+        """
+        Fetch products and their live Flash Sale rows for the whole cart in two
+        queries, ordered by id. With lock=True both are SELECT ... FOR UPDATE.
+        """
+        requested = [(item['id'], int(item['quantity'])) for item in cart_items]
+        product_ids = sorted({int(pid) for pid, _ in requested})
+
+        product_qs = Product.objects.filter(id__in=product_ids).order_by('id')
+        if lock:
+            product_qs = product_qs.select_for_update()
+        products = {p.id: p for p in product_qs}
+        for pid, _ in requested:
+            if int(pid) not in products:
+                raise ValueError(f"สินค้า ID {pid} ไม่พบในระบบ")
+
+        # One live Flash Sale row per product (same pick as the storefront price)
+        active_fs = FlashSaleService.pick_live(product_ids, now, lock=lock)
+
+        return requested, products, active_fs
+
+    @staticmethod
+    def _price_lines(requested, products, active_fs):
+        """
+        Apply the per-line checkout rules in memory against running totals.
+        Returns (lines, total_price, has_flash_sale_item, stock_delta, sold_delta).
+        """
+        total_price = 0
+        lines = []
+        has_flash_sale_item = False
+        stock_delta = defaultdict(int)
+        sold_delta = defaultdict(int)
+
+        for pid, qty in requested:
+            p = products[int(pid)]
+            fs = active_fs.get(p.id)
+
+            final_price = p.price
+            used_fs = None
+            if fs:
+                # Quota held by unexpired reservations is not for sale
+                sold = fs.sold_count + fs.reserved_stock + sold_delta[fs.id]
+                if sold < fs.quantity_limit:
+                    final_price = fs.sale_price
+                    has_flash_sale_item = True
+                    used_fs = fs
+
+                    fs_remaining = fs.quantity_limit - sold
+                    if qty > fs_remaining:
+                        raise ValueError(f"สินค้า '{p.title}' เหลือสิทธิ์ Flash Sale เพียง {fs_remaining} ชิ้น")
+                    sold_delta[fs.id] += qty
+
+            available = p.stock - stock_delta[p.id]
+            if available < qty:
+                raise ValueError(f"สินค้า '{p.title}' สินค้าหมดหรือมีไม่พอ (เหลือ {available})")
+            stock_delta[p.id] += qty
+
+            total_price += final_price * qty
+            lines.append({
+                "product": p,
+                "quantity": qty,
+                "price": final_price,
+                "flash_sale_product": used_fs
+            })
+
+        return lines, total_price, has_flash_sale_item, stock_delta, sold_delta
+
+    @staticmethod
+    def _deduct_batched(cart_items, now, fs_field='sold_count'):
+        """
+        Lock every product and Flash Sale row up front in id order (so two
+        checkouts can never wait on each other in opposite order), run the
+        per-line rules in memory, then write all counters back with one
+        UPDATE per table. Query count is constant in the number of lines.
+        fs_field picks the Flash Sale counter to move ('reserved_stock' for holds).
+        """
+        requested, products, active_fs = InventoryService._load_cart_rows(cart_items, now, lock=True)
+        lines, total_price, has_flash_sale_item, stock_delta, sold_delta = \
+            InventoryService._price_lines(requested, products, active_fs)
+
+        # ✅ Set-based writes (1 UPDATE per table)
+        Product.objects.filter(id__in=list(stock_delta)).update(
+            stock=F('stock') - _per_row_delta(stock_delta),
+            updated_at=now
+        )
+        if sold_delta:
+            FlashSaleProduct.objects.filter(id__in=list(sold_delta)).update(
+                **{fs_field: F(fs_field) + _per_row_delta(sold_delta)}
+            )
+            FlashSaleStream.counters_moved()
+
+        # Keep in-memory instances in sync with the DB
+        for pid, delta in stock_delta.items():
+            products[pid].stock -= delta
+        for fs in active_fs.values():
+            setattr(fs, fs_field, getattr(fs, fs_field) + sold_delta.get(fs.id, 0))
+
+        return lines, total_price, has_flash_sale_item
+
+    @staticmethod
+    def _deduct_conditional(cart_items, now):
+        """
+        Lock-free engine: rows are read without FOR UPDATE and every counter is
+        moved with a guarded UPDATE, e.g.
+            UPDATE products SET stock = stock - n WHERE id = ? AND stock >= n
+        A guard that matches 0 rows raises ValueError so the caller's
+        transaction rolls back the whole order. Rows are updated in id order.
+        """
+        requested, products, active_fs = InventoryService._load_cart_rows(cart_items, now, lock=False)
+        lines, total_price, has_flash_sale_item, stock_delta, sold_delta = \
+            InventoryService._price_lines(requested, products, active_fs)
+
+        for pid in sorted(stock_delta):
+            qty = stock_delta[pid]
+            updated = Product.objects.filter(id=pid, stock__gte=qty).update(
+                stock=F('stock') - qty,
+                updated_at=now
+            )
+            if not updated:
+                p = products[pid]
+                left = Product.objects.filter(id=pid).values_list('stock', flat=True).first() or 0
+                raise ValueError(f"สินค้า '{p.title}' สินค้าหมดหรือมีไม่พอ (เหลือ {left})")
+            products[pid].stock -= qty
+
+        fs_by_id = {fs.id: fs for fs in active_fs.values()}
+        for fs_id in sorted(sold_delta):
+            qty = sold_delta[fs_id]
+            updated = FlashSaleProduct.objects.filter(
+                id=fs_id,
+                sold_count__lte=F('quantity_limit') - F('reserved_stock') - qty
+            ).update(sold_count=F('sold_count') + qty)
+            if not updated:
+                fs = fs_by_id[fs_id]
+                current = FlashSaleProduct.objects.filter(id=fs_id).values('sold_count', 'reserved_stock', 'quantity_limit').first()
+                fs_remaining = max(current['quantity_limit'] - current['sold_count'] - current['reserved_stock'], 0) if current else 0
+                raise ValueError(f"สินค้า '{products[fs.product_id].title}' เหลือสิทธิ์ Flash Sale เพียง {fs_remaining} ชิ้น")
+            fs_by_id[fs_id].sold_count += qty
+        if sold_delta:
+            FlashSaleStream.counters_moved()
+
+        return lines, total_price, has_flash_sale_item
+
+
+class FlashSaleAdmissionService:
+    """
+    ⚡ Flash Sale admission control (quota tokens)
+    Remaining quota of every live FlashSaleProduct is mirrored into a counter in
+    the Django cache. Buyers take tokens *before* the checkout transaction, so
+    once a sale is sold out the rest are rejected without touching MySQL.
+
+    The default LocMemCache is a per-process stand-in; set CACHE_BACKEND /
+    CACHE_LOCATION (e.g. Redis) so all workers share the same counters.
+    The DB engine stays authoritative: tokens only decide who may try.
+    """
+    LIVE_MAP_KEY = 'fs_admission:live_map'
+    REMAINING_KEY = 'fs_admission:remaining:{}'
+    INFLIGHT_KEY = 'fs_admission:inflight:{}'
+    COUNTER_TIMEOUT = 60 * 60
+
+    @staticmethod
+    def is_enabled():
+        return getattr(settings, 'FLASH_SALE_ADMISSION_ENABLED', False)
+
+    @staticmethod
+    def reconcile(now=None):
+        """
+        Re-sync every live counter with sold_count/reserved_stock in two queries
+        and one cache write, and rebuild the product -> Flash Sale map.
+        The row per product is the one checkout prices with (pick_live:
+        priority, rounds, sold-out rows fall through), so a product outside
+        its round is not gated at all. When every in-round row is sold out
+        the top one stays in the map with nothing left, so the rush is still
+        turned away here.
+        remaining = quantity_limit - sold_count - reserved_stock - in-flight tokens
+        """
+        now = now or timezone.now()
+        titles = dict(FlashSaleProduct.objects.filter(
+            flash_sale__start_time__lte=now,
+            flash_sale__end_time__gte=now,
+            flash_sale__is_active=True
+        ).values_list('product_id', 'product__title'))
+
+        live_map = {}
+        for fs in FlashSaleService.live_rows(titles, now):
+            available = fs.quantity_limit - fs.sold_count - fs.reserved_stock
+            entry = live_map.get(fs.product_id)
+            if entry is None or (entry['available'] <= 0 < available):
+                live_map[fs.product_id] = {'id': fs.id, 'title': titles[fs.product_id], 'available': max(available, 0)}
+
+        inflight_keys = {FlashSaleAdmissionService.INFLIGHT_KEY.format(e['id']): e['id'] for e in live_map.values()}
+        inflight = cache.get_many(list(inflight_keys))
+        counters = {}
+        for entry in live_map.values():
+            in_flight = inflight.get(FlashSaleAdmissionService.INFLIGHT_KEY.format(entry['id']), 0)
+            counters[FlashSaleAdmissionService.REMAINING_KEY.format(entry['id'])] = max(entry.pop('available') - in_flight, 0)
+
+        if counters:
+            cache.set_many(counters, timeout=FlashSaleAdmissionService.COUNTER_TIMEOUT)
+        cache.set(
+            FlashSaleAdmissionService.LIVE_MAP_KEY,
+            live_map,
+            timeout=getattr(settings, 'FLASH_SALE_ADMISSION_RECONCILE_SECONDS', 5)
+        )
+        return live_map
+
+    @staticmethod
+    def get_live_map(now=None):
+        live_map = cache.get(FlashSaleAdmissionService.LIVE_MAP_KEY)
+        if live_map is None:
+            live_map = FlashSaleAdmissionService.reconcile(now)
+        return live_map
+
+    @staticmethod
+    def _take(fs_id, qty, now):
+        key = FlashSaleAdmissionService.REMAINING_KEY.format(fs_id)
+        try:
+            return cache.decr(key, qty)
+        except ValueError:
+            # Counter evicted/expired - reload once, otherwise let the DB decide
+            FlashSaleAdmissionService.reconcile(now)
+            try:
+                return cache.decr(key, qty)
+            except ValueError:
+                return None
+
+    @staticmethod
+    def acquire(cart_items, now=None):
+        """
+        Take quota tokens for every Flash Sale line in the cart.
+        Returns {flash_sale_product_id: qty}; raises ValueError (no DB access
+        once the live map is warm) when the quota cannot cover the request.
+        """
+        now = now or timezone.now()
+        live_map = FlashSaleAdmissionService.get_live_map(now)
+
+        wanted = defaultdict(int)
+        titles = {}
+        for item in cart_items:
+            entry = live_map.get(int(item['id']))
+            if entry:
+                wanted[entry['id']] += int(item['quantity'])
+                titles[entry['id']] = entry['title']
+
+        tokens = {}
+        try:
+            for fs_id in sorted(wanted):
+                qty = wanted[fs_id]
+                remaining = FlashSaleAdmissionService._take(fs_id, qty, now)
+                if remaining is None:
+                    continue
+                if remaining < 0:
+                    cache.incr(FlashSaleAdmissionService.REMAINING_KEY.format(fs_id), qty)
+                    left = max(remaining + qty, 0)
+                    if left == 0:
+                        raise ValueError(f"สินค้า '{titles[fs_id]}' สิทธิ์ Flash Sale หมดแล้ว")
+                    raise ValueError(f"สินค้า '{titles[fs_id]}' เหลือสิทธิ์ Flash Sale เพียง {left} ชิ้น")
+
+                inflight_key = FlashSaleAdmissionService.INFLIGHT_KEY.format(fs_id)
+                cache.add(inflight_key, 0, timeout=FlashSaleAdmissionService.COUNTER_TIMEOUT)
+                cache.incr(inflight_key, qty)
+                tokens[fs_id] = qty
+        except ValueError:
+            FlashSaleAdmissionService.finish(tokens, committed=False)
+            raise
+
+        return tokens
+
+    @staticmethod
+    def finish(tokens, committed):
+        """
+        Close out tokens once the checkout transaction is over.
+        committed=True: quota is now in sold_count, just drop the in-flight mark.
+        committed=False: give the tokens back to the counter.
+        """
+        for fs_id, qty in tokens.items():
+            try:
+                cache.decr(FlashSaleAdmissionService.INFLIGHT_KEY.format(fs_id), qty)
+            except ValueError:
+                pass
+            if not committed:
+                try:
+                    cache.incr(FlashSaleAdmissionService.REMAINING_KEY.format(fs_id), qty)
+                except ValueError:
+                    pass
+
+
+class ReservationService:
+    """
+    ⏳ Two-phase checkout (reserve -> confirm)
+    reserve(): one locked transaction that takes stock + Flash Sale quota for
+    the whole cart and records time-limited StockReservation rows.
+    confirm(): turns a user's holds into order lines without locking
+    inventory again (only the reservation rows themselves are locked).
+    release_expired(): gives expired holds back with set-based updates.
+    """
+
+    @staticmethod
+    def hold_minutes():
+        return getattr(settings, 'STOCK_RESERVATION_MINUTES', 15)
+
+    @staticmethod
+    def reserve(user, cart_items, now=None):
+        """
+        Must run inside transaction.atomic().
+        Returns (reservations, total_price, expires_at).
+        """
+        now = now or timezone.now()
+        expires_at = now + timedelta(minutes=ReservationService.hold_minutes())
+
+        lines, total_price, _ = InventoryService._deduct_batched(cart_items, now, fs_field='reserved_stock')
+
+        reservations = StockReservation.objects.bulk_create([
+            StockReservation(
+                user=user,
+                product=line['product'],
+                flash_sale_product=line['flash_sale_product'],
+                quantity=line['quantity'],
+                expires_at=expires_at
+            )
+            for line in lines
+        ])
+        return reservations, total_price, expires_at
+
+    @staticmethod
+    def confirm(user, reservation_ids, now=None):
+        """
+        Consume the user's unexpired holds. Must run inside transaction.atomic().
+        Returns (lines, total_price, has_flash_sale_item) in the same shape as
+        InventoryService.deduct_for_order().
+        """
+        now = now or timezone.now()
+        wanted = {int(rid) for rid in reservation_ids}
+        holds = list(
+            StockReservation.objects.select_for_update()
+            .filter(id__in=wanted, user=user)
+            .select_related('product', 'flash_sale_product')
+            .order_by('id')
+        )
+        if not holds or len(holds) != len(wanted):
+            raise ValueError("ไม่พบรายการจองสินค้า หรือการจองถูกยกเลิกไปแล้ว")
+        if any(h.expires_at <= now for h in holds):
+            raise ValueError("การจองสินค้าหมดเวลาแล้ว กรุณาทำรายการใหม่")
+
+        total_price = 0
+        lines = []
+        has_flash_sale_item = False
+        fs_delta = defaultdict(int)
+
+        for h in holds:
+            fs = h.flash_sale_product
+            price = fs.sale_price if fs else h.product.price
+            if fs:
+                has_flash_sale_item = True
+                fs_delta[fs.id] += h.quantity
+
+            total_price += price * h.quantity
+            lines.append({
+                "product": h.product,
+                "quantity": h.quantity,
+                "price": price,
+                "flash_sale_product": fs
+            })
+
+        # Held quota becomes sold quota (stock was already taken at reserve time)
+        if fs_delta:
+            delta = _per_row_delta(fs_delta)
+            FlashSaleProduct.objects.filter(id__in=list(fs_delta)).update(
+                reserved_stock=F('reserved_stock') - delta,
+                sold_count=F('sold_count') + delta
+            )
+            FlashSaleStream.counters_moved()
+        StockReservation.objects.filter(id__in=[h.id for h in holds]).delete()
+
+        return lines, total_price, has_flash_sale_item
+
+    @staticmethod
+    def release_expired(now=None, batch_size=None):
+        """
+        Return stock and Flash Sale quota of every expired hold, walking the
+        expires_at index in batches of `batch_size` (one short transaction each).
+        Returns the number of reservations released.
+        """
+        now = now or timezone.now()
+        batch_size = batch_size or getattr(settings, 'RESERVATION_SWEEP_BATCH_SIZE', 500)
+
+        released = 0
+        while True:
+            count = ReservationService._release_batch(now, batch_size)
+            released += count
+            if count < batch_size:
+                return released
+
+    @staticmethod
+    def _release_batch(now, batch_size):
+        """
+        One locking read, one UPDATE per table and one DELETE for up to
+        `batch_size` expired holds, aggregated per product / Flash Sale product.
+        """
+        with transaction.atomic():
+            expired = list(
+                StockReservation.objects.select_for_update()
+                .filter(expires_at__lte=now)
+                .order_by('expires_at', 'id')
+                .values('id', 'product_id', 'flash_sale_product_id', 'quantity')[:batch_size]
+            )
+            if not expired:
+                return 0
+
+            stock_delta = defaultdict(int)
+            fs_delta = defaultdict(int)
+            for row in expired:
+                stock_delta[row['product_id']] += row['quantity']
+                if row['flash_sale_product_id']:
+                    fs_delta[row['flash_sale_product_id']] += row['quantity']
+
+            Product.objects.filter(id__in=list(stock_delta)).update(
+                stock=F('stock') + _per_row_delta(stock_delta),
+                updated_at=now
+            )
+            if fs_delta:
+                FlashSaleProduct.objects.filter(id__in=list(fs_delta)).update(
+                    reserved_stock=F('reserved_stock') - _per_row_delta(fs_delta)
+                )
+                FlashSaleStream.counters_moved()
+            StockReservation.objects.filter(id__in=[row['id'] for row in expired]).delete()
+
+        return len(expired)
+
+    @staticmethod
+    def next_wakeup(now=None):
+        """
+        When the sweeper has to run next: the earliest pending expires_at, or
+        now + hold_minutes() when nothing is held (no hold created from now on
+        can expire earlier than that).
+        """
+        now = now or timezone.now()
+        next_expiry = (
+            StockReservation.objects.order_by('expires_at')
+            .values_list('expires_at', flat=True).first()
+        )
+        horizon = now + timedelta(minutes=ReservationService.hold_minutes())
+        if next_expiry is None:
+            return horizon
+        return min(next_expiry, horizon)
+
+
+class IdempotencyService:
+    """
+    🔁 Idempotency-Key for checkout retries
+    The key row is inserted at the start of the order transaction, so the
+    unique (user, key) index serializes concurrent retries: the loser gets an
+    IntegrityError once the winner commits and replays its stored response.
+    """
+
+    MAX_KEY_LENGTH = 255
+
+    @staticmethod
+    def ttl():
+        return timedelta(hours=getattr(settings, 'CHECKOUT_IDEMPOTENCY_TTL_HOURS', 24))
+
+    @staticmethod
+    def request_hash(data):
+        payload = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def lookup(user, key, request_hash, now=None):
+        """
+        Stored record for an unexpired key (one indexed lookup), or None.
+        Raises ValueError when the key was used for a different request body.
+        """
+        now = now or timezone.now()
+        record = CheckoutIdempotencyKey.objects.filter(user=user, key=key, expires_at__gt=now).first()
+        if record and record.request_hash != request_hash:
+            raise ValueError("Idempotency-Key นี้ถูกใช้กับคำสั่งซื้ออื่นแล้ว")
+        return record
+
+    @staticmethod
+    def claim(user, key, request_hash, now=None):
+        """
+        Must run inside the order's transaction.atomic(). Raises IntegrityError
+        if another request holds (or committed) the same key.
+        """
+        now = now or timezone.now()
+        # An expired key may be reused
+        CheckoutIdempotencyKey.objects.filter(user=user, key=key, expires_at__lte=now).delete()
+        return CheckoutIdempotencyKey.objects.create(
+            user=user,
+            key=key,
+            request_hash=request_hash,
+            expires_at=now + IdempotencyService.ttl()
+        )
+
+    @staticmethod
+    def store(record, order, status, body):
+        record.order = order
+        record.response_status = status
+        record.response_body = body
+        record.save(update_fields=['order', 'response_status', 'response_body'])
+
+    @staticmethod
+    def purge_expired(now=None):
+        now = now or timezone.now()
+        deleted, _ = CheckoutIdempotencyKey.objects.filter(expires_at__lte=now).delete()
+        return deleted
+
+
+class OrderEventService:
+    """
+    📮 Order outbox
+    Checkout only writes one OrderEvent row; run_order_events drains pending
+    events in batches and applies their side effects with set-based writes.
+    """
+
+    MAX_ATTEMPTS = 5
+
+    # customer payload key -> User field (overwritten on every order)
+    PROFILE_FIELDS = {
+        'phone': 'phone',
+        'address': 'address',
+        'province': 'province',
+        'zip_code': 'zipcode',
+        'latitude': 'latitude',
+        'longitude': 'longitude',
+    }
+
+    @staticmethod
+    def enqueue_order_placed(order, user, customer_data, lines, coupon=None):
+        """Must run inside the checkout transaction (one INSERT)."""
+        customer_keys = ['name'] + list(OrderEventService.PROFILE_FIELDS)
+        return OrderEvent.objects.create(
+            event_type='order_placed',
+            order=order,
+            user=user,
+            payload={
+                "customer": {k: customer_data[k] for k in customer_keys if customer_data.get(k)},
+                "coupon_id": coupon.id if coupon else None,
+                "usage_recorded": True, # PromoUsageService.record_order ran in checkout
+                "total": order.total_price,
+                "placed_at": order.created_at,
+                "lines": [
+                    {
+                        "product_id": line['product'].id,
+                        "quantity": line['quantity'],
+                        "remaining_stock": line['product'].stock,
+                        "flash_sale_id": line['flash_sale_product'].flash_sale_id if line['flash_sale_product'] else None,
+                    }
+                    for line in lines
+                ],
+            }
+        )
+
+    @staticmethod
+    def process_batch(batch_size=None, now=None):
+        """
+        Apply up to `batch_size` pending events. The whole batch is written
+        with one statement per side-effect table; if that fails, events are
+        retried one by one so a single bad event cannot block the queue.
+        Returns the number of events taken from the queue.
+        """
+        now = now or timezone.now()
+        batch_size = batch_size or getattr(settings, 'ORDER_EVENTS_BATCH_SIZE', 200)
+
+        with transaction.atomic():
+            events = list(
+                OrderEvent.objects.select_for_update(skip_locked=True)
+                .filter(status='pending')
+                .order_by('id')[:batch_size]
+            )
+            if not events:
+                return 0
+
+            try:
+                with transaction.atomic():
+                    OrderEventService._apply(events, now)
+                done = events
+            except Exception:
+                done = []
+                for event in events:
+                    try:
+                        with transaction.atomic():
+                            OrderEventService._apply([event], now)
+                        done.append(event)
+                    except Exception as e:
+                        event.attempts += 1
+                        event.last_error = str(e)
+                        event.status = 'failed' if event.attempts >= OrderEventService.MAX_ATTEMPTS else 'pending'
+                        event.save(update_fields=['attempts', 'last_error', 'status'])
+
+            if done:
+                OrderEvent.objects.filter(id__in=[e.id for e in done]).update(status='done', processed_at=now)
+
+        return len(events)
+
+    @staticmethod
+    def _apply(events, now):
+        users = User.objects.in_bulk({e.user_id for e in events})
+
+        # 1. Profile auto-save (later orders win), one bulk UPDATE
+        changed_fields = set()
+        changed_users = {}
+        for e in events:
+            user = users.get(e.user_id)
+            if not user:
+                continue
+            customer = e.payload.get('customer', {})
+
+            if customer.get('name'):
+                parts = customer['name'].strip().split(' ', 1)
+                if not user.first_name and len(parts) > 0:
+                    user.first_name = parts[0]
+                    changed_fields.add('first_name')
+                    changed_users[user.id] = user
+                if not user.last_name and len(parts) > 1:
+                    user.last_name = parts[1]
+                    changed_fields.add('last_name')
+                    changed_users[user.id] = user
+
+            for key, field in OrderEventService.PROFILE_FIELDS.items():
+                if customer.get(key):
+                    setattr(user, field, User._meta.get_field(field).to_python(customer[key]))
+                    changed_fields.add(field)
+                    changed_users[user.id] = user
+
+        if changed_users:
+            User.objects.bulk_update(list(changed_users.values()), sorted(changed_fields))
+
+        # 2. New User -> Customer
+        User.objects.filter(id__in=list(users), role='new_user').update(role='customer')
+
+        # 3. Usage logs, stock history and notifications: one INSERT each
+        usage_logs = []
+        uncounted_logs = []
+        history = []
+        notifications = []
+        for e in events:
+            payload = e.payload
+            placed_at = payload.get('placed_at') or now
+
+            logs = []
+            if payload.get('coupon_id'):
+                logs.append(PromoUsageLog(user_id=e.user_id, promo_type='coupon', promo_id=payload['coupon_id'], order_id=e.order_id))
+            for flash_sale_id in sorted({l['flash_sale_id'] for l in payload.get('lines', []) if l.get('flash_sale_id')}):
+                logs.append(PromoUsageLog(user_id=e.user_id, promo_type='flash', promo_id=flash_sale_id, order_id=e.order_id))
+            usage_logs += logs
+            if not payload.get('usage_recorded'):
+                uncounted_logs += logs # Enqueued before checkout counted usage itself
+
+            for l in payload.get('lines', []):
+                history.append(StockHistory(
+                    product_id=l['product_id'],
+                    change_quantity=-l['quantity'],
+                    remaining_stock=l['remaining_stock'],
+                    action='sale',
+                    note=f"Order #{e.order_id}",
+                    created_at=placed_at,
+                    created_by_id=e.user_id
+                ))
+
+            notifications.append(Notification(
+                user_id=e.user_id,
+                title="สั่งซื้อสำเร็จ",
+                message=f"คำสั่งซื้อ #{e.order_id} ยอดรวม ฿{payload.get('total')} รอการชำระเงิน",
+                type='order_update',
+                related_id=e.order_id
+            ))
+
+        PromoUsageLog.objects.bulk_create(usage_logs)
+        PromoUsageService.record_logs(uncounted_logs)
+        StockHistory.objects.bulk_create(history)
+        Notification.objects.bulk_create(notifications)
+
+
+class PromotionSchedulerService:
+    """
+    ⏰ Boundary-driven housekeeping (run_scheduler)
+    run() applies everything due at `now` for the given jobs with set-based
+    writes and one AdminLog bulk insert; next_boundaries() says when each job
+    is due again, so the daemon sleeps exactly until then instead of polling.
+    """
+
+    JOBS = ('flash_sales', 'tags', 'reservations')
+
+    @staticmethod
+    def system_user():
+        return User.objects.filter(username='system').first() or User.objects.filter(is_superuser=True).first()
+
+    @staticmethod
+    def flash_sale_changes(now):
+        """(to_activate, to_deactivate) as lists of (id, name)."""
+        to_activate = FlashSale.objects.filter(is_active=False, start_time__lte=now, end_time__gte=now)
+        to_deactivate = FlashSale.objects.filter(is_active=True, auto_disable_on_end=True, end_time__lt=now)
+        return (
+            list(to_activate.order_by('id').values_list('id', 'name')),
+            list(to_deactivate.order_by('id').values_list('id', 'name'))
+        )
+
+    @staticmethod
+    def expired_tags(now):
+        """Tags whose expiration_date (a shop-local day) is over."""
+        return Tag.objects.filter(expiration_date__isnull=False, expiration_date__lt=timezone.localdate(now))
+
+    @staticmethod
+    def run(jobs=JOBS, now=None):
+        """
+        Apply the due changes of `jobs`. Returns
+        {"activated": [(id, name)], "deactivated": [...], "tags": [name], "reservations": int}.
+        """
+        now = now or timezone.now()
+        result = {"activated": [], "deactivated": [], "tags": [], "reservations": 0}
+        actions = []
+
+        if 'flash_sales' in jobs:
+            with transaction.atomic():
+                activated, deactivated = PromotionSchedulerService.flash_sale_changes(now)
+                # Re-check the conditions in the UPDATE: a sale edited meanwhile is left alone
+                if activated:
+                    FlashSale.objects.filter(
+                        id__in=[i for i, _ in activated], is_active=False, start_time__lte=now, end_time__gte=now
+                    ).update(is_active=True)
+                if deactivated:
+                    FlashSale.objects.filter(
+                        id__in=[i for i, _ in deactivated], is_active=True, end_time__lt=now
+                    ).update(is_active=False)
+            if activated or deactivated:
+                # update() skips post_save, so the index is told directly
+                PromotionIndex.invalidate()
+                # Prebuild the landing payload before traffic asks for it
+                ActiveFlashSaleFeed.get(now)
+            result["activated"], result["deactivated"] = activated, deactivated
+            actions += [f"Auto-activated Flash Sale: {name} (ID: {i})" for i, name in activated]
+            actions += [f"Auto-deactivated Flash Sale: {name} (ID: {i})" for i, name in deactivated]
+
+        if 'tags' in jobs:
+            expired = PromotionSchedulerService.expired_tags(now)
+            names = list(expired.order_by('name').values_list('name', flat=True))
+            if names:
+                expired.delete()
+            result["tags"] = names
+            actions += [f"Auto-removed expired tag: {name}" for name in names]
+
+        if 'reservations' in jobs:
+            result["reservations"] = ReservationService.release_expired(now=now)
+
+        system_user = PromotionSchedulerService.system_user() if actions else None
+        if system_user:
+            AdminLog.objects.bulk_create([
+                AdminLog(admin=system_user, action=action[:255], timestamp=now) for action in actions
+            ])
+        return result
+
+    @staticmethod
+    def next_flash_sale_boundary(now=None):
+        """Next sale start or end (two indexed LIMIT 1 lookups), or None."""
+        now = now or timezone.now()
+        next_start = FlashSale.objects.filter(
+            is_active=False, start_time__gt=now, end_time__gte=F('start_time')
+        ).order_by('start_time').values_list('start_time', flat=True).first()
+        next_end = FlashSale.objects.filter(
+            is_active=True, auto_disable_on_end=True, end_time__gte=now
+        ).order_by('end_time').values_list('end_time', flat=True).first()
+        if next_end is not None:
+            next_end += timedelta(microseconds=1) # end_time itself is still part of the sale
+        boundaries = [b for b in (next_start, next_end) if b is not None]
+        return min(boundaries) if boundaries else None
+
+    @staticmethod
+    def next_boundaries(now=None):
+        """
+        {job: datetime} of the next moment each job has work to do. Every
+        lookup is an ORDER BY ... LIMIT 1 on an indexed column.
+        """
+        now = now or timezone.now()
+
+        # A tag expiring on day D is removed at local midnight after D
+        next_expiry = Tag.objects.filter(
+            expiration_date__gte=timezone.localdate(now)
+        ).order_by('expiration_date').values_list('expiration_date', flat=True).first()
+        tag_boundary = None
+        if next_expiry is not None:
+            tag_boundary = timezone.make_aware(datetime.combine(next_expiry + timedelta(days=1), datetime.min.time()))
+
+        return {
+            'flash_sales': PromotionSchedulerService.next_flash_sale_boundary(now),
+            'tags': tag_boundary,
+            'reservations': ReservationService.next_wakeup(now),
+        }
+
+
+class PromotionConflictService:
+    """
+    🗓️ Conflict engine over the promotion calendar (PromotionSchedule)
+    Every flash sale and active coupon keeps one schedule row (kept in sync on
+    save). Conflicts are found with a sweep-line: all start/end points are
+    sorted once and the promotions that are running are kept in sets per
+    scope (global / category / product), so each new promotion is only compared
+    with the running ones whose scope can overlap with it. The cost is
+    O(n log n + conflicts), even for calendars that cover several years.
+    Windows are half-open: a sale that ends exactly when the next one starts
+    is not a conflict.
+    """
+
+    @staticmethod
+    def flash_sale_scope(product_ids):
+        return {'type': 'product', 'ids': sorted(set(product_ids))}
+
+    _queued = threading.local() # {sale_id: run_on_commit list of the transaction it was queued in}
+
+    @staticmethod
+    def sync_flash_sale(sale_id):
+        # Inactive sales stay on the calendar: run_scheduler may switch them on
+        PromotionConflictService._queued.__dict__.get('sales', {}).pop(sale_id, None)
+        sale = FlashSale.objects.filter(id=sale_id).values('start_time', 'end_time', 'priority').first()
+        if sale is None:
+            PromotionSchedule.objects.filter(promo_type='flash_sale', promo_id=sale_id).delete()
+            return
+        product_ids = FlashSaleProduct.objects.filter(flash_sale_id=sale_id).values_list('product_id', flat=True)
+        PromotionSchedule.objects.update_or_create(
+            promo_type='flash_sale', promo_id=sale_id,
+            defaults={**sale, 'impact_scope': PromotionConflictService.flash_sale_scope(product_ids)}
+        )
+
+    @staticmethod
+    def queue_flash_sale_sync(sale_id):
+        """
+        Product rows are written in bulk (the admin views replace them all),
+        so inside a transaction the sale is synced once on commit instead of
+        once per row. Call sync_flash_sale() directly to read the row back
+        before then (e.g. validate()).
+        """
+        conn = transaction.get_connection()
+        if not conn.in_atomic_block:
+            PromotionConflictService.sync_flash_sale(sale_id)
+            return
+        queued = PromotionConflictService._queued.__dict__.setdefault('sales', {})
+        if queued.get(sale_id) is conn.run_on_commit:
+            return # Already queued (commit and rollback both start a new list)
+        queued[sale_id] = conn.run_on_commit
+
+        def flush():
+            if sale_id in queued:
+                PromotionConflictService.sync_flash_sale(sale_id)
+        transaction.on_commit(flush)
+
+    @staticmethod
+    def sync_coupon(coupon):
+        if not coupon.active:
+            PromotionSchedule.objects.filter(promo_type='coupon', promo_id=coupon.id).delete()
+            return
+        # A coupon discounts the whole cart
+        PromotionSchedule.objects.update_or_create(
+            promo_type='coupon', promo_id=coupon.id,
+            defaults={
+                'start_time': coupon.start_date,
+                'end_time': coupon.end_date,
+                'priority': coupon.priority,
+                'impact_scope': {'type': 'global'},
+            }
+        )
+
+    @staticmethod
+    def load(start=None, end=None, promo_type=None):
+        """Schedule rows overlapping [start, end) and {product_id: category_id} for their product scopes."""
+        rows = PromotionSchedule.objects.all()
+        if start is not None:
+            rows = rows.filter(end_time__gt=start)
+        if end is not None:
+            rows = rows.filter(start_time__lt=end)
+        if promo_type:
+            rows = rows.filter(promo_type=promo_type)
+        entries = list(rows.values('id', 'promo_type', 'promo_id', 'start_time', 'end_time', 'priority', 'impact_scope'))
+
+        product_ids = {
+            pid for e in entries
+            if (e['impact_scope'] or {}).get('type') == 'product'
+            for pid in e['impact_scope'].get('ids', [])
+        }
+        categories = dict(
+            Product.objects.filter(id__in=product_ids).values_list('id', 'category_id')
+        ) if product_ids else {}
+        return entries, categories
+
+    @staticmethod
+    def find_conflicts(entries, categories):
+        """
+        Sweep-line over `entries` (dicts with start_time, end_time, priority,
+        impact_scope). Returns one conflict per overlapping pair in the order
+        the overlaps begin.
+        """
+        events = []
+        for i, e in enumerate(entries):
+            if e['start_time'] < e['end_time']:
+                events.append((e['start_time'], 1, i))
+                events.append((e['end_time'], 0, i)) # Ends sort before starts at the same instant
+        events.sort()
+
+        running = set()
+        running_global = set()
+        by_category = defaultdict(set) # category scopes
+        by_product = defaultdict(set) # product scopes
+        products_in_category = defaultdict(set) # product scopes, by their products' categories
+
+        def keys(e):
+            scope = e['impact_scope'] or {}
+            kind = scope.get('type', 'global')
+            ids = scope.get('ids', []) if kind in ('category', 'product') else []
+            return kind, ids
+
+        conflicts = []
+        for _, is_start, i in events:
+            kind, ids = keys(entries[i])
+
+            if not is_start:
+                running.discard(i)
+                running_global.discard(i)
+                for x in ids:
+                    (by_category if kind == 'category' else by_product)[x].discard(i)
+                    if kind == 'product' and categories.get(x) is not None:
+                        products_in_category[categories[x]].discard(i)
+                continue
+
+            if kind == 'global':
+                overlapping = set(running)
+            else:
+                overlapping = set(running_global)
+                for x in ids:
+                    if kind == 'category':
+                        overlapping |= by_category[x] | products_in_category[x]
+                    else:
+                        overlapping |= by_product[x]
+                        if categories.get(x) is not None:
+                            overlapping |= by_category[categories[x]]
+
+            for j in sorted(overlapping):
+                conflicts.append(PromotionConflictService._conflict(entries[j], entries[i]))
+
+            running.add(i)
+            if kind == 'global':
+                running_global.add(i)
+            for x in ids:
+                (by_category if kind == 'category' else by_product)[x].add(i)
+                if kind == 'product' and categories.get(x) is not None:
+                    products_in_category[categories[x]].add(i)
+        return conflicts
+
+    @staticmethod
+    def _conflict(a, b):
+        def ref(e):
+            return {"promo_type": e['promo_type'], "promo_id": e['promo_id'], "priority": e['priority']}
+
+        winner = None
+        if a['priority'] != b['priority']:
+            winner = ref(a if a['priority'] > b['priority'] else b)
+        return {
+            "promotions": [ref(a), ref(b)],
+            "overlap_start": max(a['start_time'], b['start_time']),
+            "overlap_end": min(a['end_time'], b['end_time']),
+            "winner": winner, # None = same priority, nothing decides between them
+        }
+
+    @staticmethod
+    def detect(start=None, end=None, promo_type=None):
+        entries, categories = PromotionConflictService.load(start, end, promo_type)
+        return PromotionConflictService.find_conflicts(entries, categories)
+
+    @staticmethod
+    def conflicts_of(promo_type, promo_id):
+        """Conflicts involving one promotion (only its own time window is loaded)."""
+        row = PromotionSchedule.objects.filter(promo_type=promo_type, promo_id=promo_id).first()
+        if row is None:
+            return []
+        entries, categories = PromotionConflictService.load(row.start_time, row.end_time)
+        return [
+            c for c in PromotionConflictService.find_conflicts(entries, categories)
+            if {"promo_type": promo_type, "promo_id": promo_id} in [
+                {"promo_type": p['promo_type'], "promo_id": p['promo_id']} for p in c['promotions']
+            ]
+        ]
+
+    @staticmethod
+    def validate(promo_type, promo_id):
+        """
+        Save-time check, run inside the saving transaction. Returns the
+        overlaps with promotions of the same type (a flash sale next to a
+        coupon is governed by is_stackable_with_flash_sale, not priority).
+        Two active flash sales on the same product and time with the same
+        priority have no winner, so checkout would pick one arbitrarily. That
+        raises ValueError. Ties with an inactive sale (a draft, or one waiting
+        for run_scheduler) are only returned, as warnings.
+        """
+        conflicts = [
+            c for c in PromotionConflictService.conflicts_of(promo_type, promo_id)
+            if all(p['promo_type'] == promo_type for p in c['promotions'])
+        ]
+        ties = [c for c in conflicts if c['winner'] is None]
+        if promo_type != 'flash_sale' or not ties:
+            return conflicts
+
+        active = set(FlashSale.objects.filter(
+            id__in={p['promo_id'] for c in ties for p in c['promotions']}, is_active=True
+        ).values_list('id', flat=True))
+        for c in ties:
+            if all(p['promo_id'] in active for p in c['promotions']):
+                other = next(p for p in c['promotions'] if p['promo_id'] != promo_id)
+                raise ValueError(
+                    f"ช่วงเวลาและสินค้าซ้อนทับกับ Flash Sale ID {other['promo_id']} ที่มีลำดับความสำคัญ "
+                    f"(priority {other['priority']}) เท่ากัน กรุณาปรับ priority หรือช่วงเวลา"
+                )
+        return conflicts
+
+
+# Coupon fields that decide its calendar row (counter-only saves are ignored)
+_SCHEDULED_COUPON_FIELDS = ('start_date', 'end_date', 'priority', 'active')
+
+
+@receiver(post_save, sender=Coupon)
+def _sync_coupon_schedule(sender, instance, created, raw=False, **kwargs):
+    if raw or (not created and not _changed_since_load(instance, _SCHEDULED_COUPON_FIELDS)):
+        return
+    _remember_saved_values(instance, _SCHEDULED_COUPON_FIELDS)
+    PromotionConflictService.sync_coupon(instance)
+
+
+@receiver(post_delete, sender=Coupon)
+def _drop_coupon_schedule(sender, instance, **kwargs):
+    PromotionSchedule.objects.filter(promo_type='coupon', promo_id=instance.id).delete()
+
+
+@receiver(post_delete, sender=FlashSale)
+@receiver(post_delete, sender=FlashSaleProduct)
+def _resync_flash_sale_schedule(sender, instance, **kwargs):
+    if sender is FlashSale:
+        PromotionConflictService.sync_flash_sale(instance.id)
+    else:
+        PromotionConflictService.queue_flash_sale_sync(instance.flash_sale_id)
@@ -0,0 +1,886 @@
+"""
+Unit Tests for Checkout Stock Engines
+Tests: InventoryService engines, create_order stock/quota writes and query counts
+"""
+
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction, OperationalError
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from django.core.management import call_command
+import io
+import json
+import os
+import tempfile
+import time
+from django.utils import timezone
+from django.contrib.auth import get_user_model
+from rest_framework.test import APIClient
+from datetime import timedelta
+from decimal import Decimal
+from myapp.models import (
+    FlashSale, FlashSaleProduct, Product, Category, Order, OrderItem, StockReservation,
+    CheckoutIdempotencyKey, OrderEvent, PromoUsageLog, StockHistory, Notification, Coupon,
+    PromoUsageCounter
+)
+from myapp.services import (
+    InventoryService, FlashSaleAdmissionService, ReservationService, IdempotencyService,
+    OrderEventService, PromoUsageService, PriceCalculator, PromotionIndex, FlashSaleService
+)
+from django.core.cache import cache
+
+User = get_user_model()
+
+
+class BatchedStockEngineTest(TestCase):
+    """Test the batched (ordered lock + set-based update) engine"""
+
+    def setUp(self):
+        self.category = Category.objects.create(name="Checkout")
+        self.products = [
+            Product.objects.create(
+                title=f"Item {i}",
+                price=Decimal('100.00'),
+                stock=50,
+                category=self.category
+            )
+            for i in range(20)
+        ]
+
+        now = timezone.now()
+        self.flash_sale = FlashSale.objects.create(
+            name="Checkout Sale",
+            start_time=now - timedelta(minutes=5),
+            end_time=now + timedelta(hours=1),
+            is_active=True
+        )
+        self.fs_product = FlashSaleProduct.objects.create(
+            flash_sale=self.flash_sale,
+            product=self.products[0],
+            sale_price=Decimal('60.00'),
+            quantity_limit=5
+        )
+
+    def _deduct(self, cart_items):
+        with transaction.atomic():
+            return InventoryService.deduct_for_order(cart_items)
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='batched')
+    def test_deducts_stock_and_flash_quota(self):
+        """Test stock and sold_count are moved in one pass"""
+        cart = [
+            {"id": self.products[0].id, "quantity": 2},
+            {"id": self.products[1].id, "quantity": 3},
+        ]
+        lines, total, has_flash = self._deduct(cart)
+
+        self.assertTrue(has_flash)
+        self.assertEqual(total, Decimal('60.00') * 2 + Decimal('100.00') * 3)
+        self.assertEqual(lines[0]['flash_sale_product'].id, self.fs_product.id)
+        self.assertIsNone(lines[1]['flash_sale_product'])
+
+        self.products[0].refresh_from_db()
+        self.products[1].refresh_from_db()
+        self.fs_product.refresh_from_db()
+        self.assertEqual(self.products[0].stock, 48)
+        self.assertEqual(self.products[1].stock, 47)
+        self.assertEqual(self.fs_product.sold_count, 2)
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='batched')
+    def test_duplicate_lines_share_counters(self):
+        """Test repeated product lines are checked against the running total"""
+        cart = [
+            {"id": self.products[1].id, "quantity": 30},
+            {"id": self.products[1].id, "quantity": 30},
+        ]
+        with self.assertRaises(ValueError):
+            self._deduct(cart)
+
+        self.products[1].refresh_from_db()
+        self.assertEqual(self.products[1].stock, 50)
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='batched')
+    def test_flash_quota_exceeded_rejects(self):
+        """Test asking for more than the remaining Flash Sale quota fails"""
+        with self.assertRaises(ValueError):
+            self._deduct([{"id": self.products[0].id, "quantity": 6}])
+
+        self.fs_product.refresh_from_db()
+        self.assertEqual(self.fs_product.sold_count, 0)
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='batched')
+    def test_missing_product_rejects(self):
+        """Test unknown product id aborts the order"""
+        with self.assertRaises(ValueError):
+            self._deduct([{"id": 999999, "quantity": 1}])
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='batched')
+    def test_query_count_is_flat(self):
+        """Test query count does not grow with cart size"""
+        small_cart = [{"id": p.id, "quantity": 1} for p in self.products[:2]]
+        large_cart = [{"id": p.id, "quantity": 1} for p in self.products]
+        PromotionIndex.rebuild() # Warm the in-process index (rebuilt once per promotion write)
+
+        with CaptureQueriesContext(connection) as small:
+            self._deduct(small_cart)
+        with CaptureQueriesContext(connection) as large:
+            self._deduct(large_cart)
+
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='row_lock')
+    def test_row_lock_engine_matches(self):
+        """Test legacy engine produces the same result"""
+        lines, total, has_flash = self._deduct([{"id": self.products[0].id, "quantity": 2}])
+
+        self.assertTrue(has_flash)
+        self.assertEqual(total, Decimal('120.00'))
+        self.fs_product.refresh_from_db()
+        self.assertEqual(self.fs_product.sold_count, 2)
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='unknown')
+    def test_unknown_engine_rejected(self):
+        """Test misconfigured engine fails loudly"""
+        with self.assertRaises(ValueError):
+            InventoryService.get_engine()
+
+
+class ConditionalStockEngineTest(TestCase):
+    """Test the lock-free guarded update engine"""
+
+    def setUp(self):
+        self.product = Product.objects.create(title="Hot SKU", price=Decimal('100.00'), stock=3)
+        now = timezone.now()
+        self.flash_sale = FlashSale.objects.create(
+            name="Hot Sale",
+            start_time=now - timedelta(minutes=5),
+            end_time=now + timedelta(hours=1),
+            is_active=True
+        )
+        self.fs_product = FlashSaleProduct.objects.create(
+            flash_sale=self.flash_sale,
+            product=self.product,
+            sale_price=Decimal('50.00'),
+            quantity_limit=2
+        )
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='conditional')
+    def test_guarded_update_deducts(self):
+        """Test stock and quota move when the guard passes"""
+        with transaction.atomic():
+            lines, total, has_flash = InventoryService.deduct_for_order([{"id": self.product.id, "quantity": 2}])
+
+        self.assertTrue(has_flash)
+        self.assertEqual(total, Decimal('100.00'))
+        self.product.refresh_from_db()
+        self.fs_product.refresh_from_db()
+        self.assertEqual(self.product.stock, 1)
+        self.assertEqual(self.fs_product.sold_count, 2)
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='conditional')
+    def test_failed_guard_rolls_back_order(self):
+        """Test a failed quota guard undoes the stock already deducted"""
+        original_load = InventoryService._load_cart_rows
+
+        def load_then_drain(*args, **kwargs):
+            # Another buyer takes the quota between our read and our UPDATE
+            rows = original_load(*args, **kwargs)
+            FlashSaleProduct.objects.filter(id=self.fs_product.id).update(sold_count=2)
+            return rows
+
+        with patch.object(InventoryService, '_load_cart_rows', side_effect=load_then_drain):
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    InventoryService.deduct_for_order([{"id": self.product.id, "quantity": 1}])
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+
+
+class ConditionalEngineConcurrencyTest(TransactionTestCase):
+    """Test parallel checkouts on one hot SKU never oversell"""
+
+    BUYERS = 12
+
+    def setUp(self):
+        self.product = Product.objects.create(title="Hot SKU", price=Decimal('100.00'), stock=5)
+        now = timezone.now()
+        flash_sale = FlashSale.objects.create(
+            name="Hot Sale",
+            start_time=now - timedelta(minutes=5),
+            end_time=now + timedelta(hours=1),
+            is_active=True
+        )
+        self.fs_product = FlashSaleProduct.objects.create(
+            flash_sale=flash_sale,
+            product=self.product,
+            sale_price=Decimal('50.00'),
+            quantity_limit=3
+        )
+
+    def _buy(self, _):
+        try:
+            for attempt in range(5):
+                try:
+                    with transaction.atomic():
+                        InventoryService.deduct_for_order([{"id": self.product.id, "quantity": 1}])
+                    return True
+                except OperationalError:
+                    # SQLite table lock under contention - retry like a client would
+                    time.sleep(0.01 * (attempt + 1))
+                except Exception:
+                    # Rejected by a guard - never partial
+                    return False
+            return False
+        finally:
+            connection.close()
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='conditional')
+    def test_no_oversell_under_contention(self):
+        """Test stock and quota stay consistent with the number of successful buys"""
+        with ThreadPoolExecutor(max_workers=self.BUYERS) as pool:
+            results = list(pool.map(self._buy, range(self.BUYERS)))
+
+        succeeded = sum(results)
+        self.product.refresh_from_db()
+        self.fs_product.refresh_from_db()
+
+        self.assertGreaterEqual(succeeded, 1)
+        self.assertLessEqual(succeeded, 5)
+        self.assertGreaterEqual(self.product.stock, 0)
+        self.assertEqual(self.product.stock, 5 - succeeded)
+        self.assertLessEqual(self.fs_product.sold_count, self.fs_product.quantity_limit)
+
+
+class FlashSaleAdmissionTest(TestCase):
+    """Test quota tokens handed out before the checkout transaction"""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='rusher',
+            email='rusher@test.com',
+            password='test123',
+            role='customer'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.product = Product.objects.create(title="Drop Item", price=Decimal('100.00'), stock=50)
+        now = timezone.now()
+        flash_sale = FlashSale.objects.create(
+            name="Drop",
+            start_time=now - timedelta(minutes=5),
+            end_time=now + timedelta(hours=1),
+            is_active=True
+        )
+        self.fs_product = FlashSaleProduct.objects.create(
+            flash_sale=flash_sale,
+            product=self.product,
+            sale_price=Decimal('10.00'),
+            quantity_limit=3,
+            sold_count=1
+        )
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_tokens_limited_to_remaining_quota(self):
+        """Test tokens stop at quantity_limit - sold_count"""
+        cart = [{"id": self.product.id, "quantity": 1}]
+        first = FlashSaleAdmissionService.acquire(cart)
+        second = FlashSaleAdmissionService.acquire(cart)
+        self.assertEqual(first, {self.fs_product.id: 1})
+        self.assertEqual(second, {self.fs_product.id: 1})
+
+        with self.assertRaises(ValueError):
+            FlashSaleAdmissionService.acquire(cart)
+
+    def test_sold_out_rejected_without_queries(self):
+        """Test a warm counter rejects sold-out requests with zero DB queries"""
+        cart = [{"id": self.product.id, "quantity": 2}]
+        FlashSaleAdmissionService.acquire(cart)
+
+        with self.assertNumQueries(0):
+            with self.assertRaises(ValueError):
+                FlashSaleAdmissionService.acquire([{"id": self.product.id, "quantity": 1}])
+
+    def test_release_returns_tokens(self):
+        """Test rolled back checkouts give their tokens back"""
+        tokens = FlashSaleAdmissionService.acquire([{"id": self.product.id, "quantity": 2}])
+        FlashSaleAdmissionService.finish(tokens, committed=False)
+
+        tokens = FlashSaleAdmissionService.acquire([{"id": self.product.id, "quantity": 2}])
+        self.assertEqual(tokens, {self.fs_product.id: 2})
+
+    def test_reconcile_tracks_database(self):
+        """Test reconcile re-syncs counters with sold_count/reserved_stock"""
+        FlashSaleAdmissionService.reconcile()
+        FlashSaleProduct.objects.filter(id=self.fs_product.id).update(sold_count=2, reserved_stock=1)
+        FlashSaleAdmissionService.reconcile()
+
+        with self.assertRaises(ValueError):
+            FlashSaleAdmissionService.acquire([{"id": self.product.id, "quantity": 1}])
+
+    def test_counts_the_row_checkout_prices_with(self):
+        """Test admission follows priority like pick_live, not the lowest row id"""
+        now = timezone.now()
+        priority_sale = FlashSale.objects.create(
+            name="Priority Drop", priority=5, is_active=True,
+            start_time=now - timedelta(minutes=5), end_time=now + timedelta(hours=1)
+        )
+        priority_row = FlashSaleProduct.objects.create(
+            flash_sale=priority_sale, product=self.product, sale_price=Decimal('20.00'), quantity_limit=10
+        )
+
+        tokens = FlashSaleAdmissionService.acquire([{"id": self.product.id, "quantity": 3}])
+
+        self.assertEqual(tokens, {priority_row.id: 3})
+        self.assertEqual(FlashSaleService.pick_live([self.product.id])[self.product.id].id, priority_row.id)
+
+    def test_outside_round_is_not_gated(self):
+        """Test a sold-out sale that is between rounds does not turn away normal-price buyers"""
+        local = timezone.localtime()
+        self.fs_product.flash_sale.rounds = [{
+            'start': (local + timedelta(hours=3)).strftime('%H:%M'),
+            'end': (local + timedelta(hours=4)).strftime('%H:%M')
+        }]
+        self.fs_product.flash_sale.save()
+        FlashSaleProduct.objects.filter(id=self.fs_product.id).update(sold_count=3)
+
+        self.assertEqual(FlashSaleAdmissionService.acquire([{"id": self.product.id, "quantity": 1}]), {})
+
+    @override_settings(FLASH_SALE_ADMISSION_ENABLED=True)
+    def test_create_order_rejects_sold_out_before_transaction(self):
+        """Test checkout short-circuits once the quota tokens are gone"""
+        FlashSaleAdmissionService.acquire([{"id": self.product.id, "quantity": 2}])
+
+        response = self.client.post('/api/checkout/', {
+            "items": [{"id": self.product.id, "quantity": 1}],
+            "customer": {
+                "name": "Rusher",
+                "phone": "0812345678",
+                "address": "123 Test Rd",
+                "province": "Bangkok"
+            }
+        }, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 50)
+
+
+class CreateOrderStockTest(TestCase):
+    """Test create_order API end-to-end with the batched engine"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='buyer',
+            email='buyer@test.com',
+            password='test123',
+            role='customer'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.product = Product.objects.create(title="Keyboard", price=Decimal('500.00'), stock=10)
+        self.customer = {
+            "name": "Test Buyer",
+            "phone": "0812345678",
+            "address": "123 Test Rd",
+            "province": "Bangkok"
+        }
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='batched')
+    def test_create_order_bulk_creates_items(self):
+        """Test order items are written with pricing snapshot"""
+        response = self.client.post('/api/checkout/', {
+            "items": [{"id": self.product.id, "quantity": 2}],
+            "customer": self.customer
+        }, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(id=response.data['order_id'])
+        item = OrderItem.objects.get(order=order)
+        self.assertEqual(item.quantity, 2)
+        self.assertEqual(item.base_price_at_time, Decimal('500.00'))
+        self.assertEqual(item.promotion_source, 'normal')
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 8)
+
+    @override_settings(CHECKOUT_STOCK_ENGINE='batched')
+    def test_create_order_out_of_stock(self):
+        """Test insufficient stock returns 400 and leaves stock untouched"""
+        response = self.client.post('/api/checkout/', {
+            "items": [{"id": self.product.id, "quantity": 11}],
+            "customer": self.customer
+        }, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 10)
+        self.assertFalse(Order.objects.exists())
+
+
+class TwoPhaseCheckoutTest(TestCase):
+    """Test reserve -> confirm checkout and the expiry sweeper"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='holder',
+            email='holder@test.com',
+            password='test123',
+            role='customer'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.product = Product.objects.create(title="Console", price=Decimal('1000.00'), stock=5)
+        now = timezone.now()
+        self.flash_sale = FlashSale.objects.create(
+            name="Console Sale",
+            start_time=now - timedelta(minutes=5),
+            end_time=now + timedelta(hours=1),
+            is_active=True
+        )
+        self.fs_product = FlashSaleProduct.objects.create(
+            flash_sale=self.flash_sale,
+            product=self.product,
+            sale_price=Decimal('800.00'),
+            quantity_limit=3
+        )
+        self.customer = {
+            "name": "Test Holder",
+            "phone": "0812345678",
+            "address": "1 Hold St",
+            "province": "Bangkok"
+        }
+
+    def _reserve(self, quantity):
+        return self.client.post('/api/checkout/reserve/', {
+            "items": [{"id": self.product.id, "quantity": quantity}]
+        }, format='json')
+
+    def test_reserve_holds_stock_and_quota(self):
+        """Test reserve takes stock and reserved_stock, not sold_count"""
+        response = self._reserve(2)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['reservation_ids']), 1)
+        self.product.refresh_from_db()
+        self.fs_product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(self.fs_product.reserved_stock, 2)
+        self.assertEqual(self.fs_product.sold_count, 0)
+
+    def test_reserved_quota_blocks_other_buyers(self):
+        """Test held Flash Sale quota is not sold twice"""
+        self._reserve(2)
+        response = self._reserve(2)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(StockReservation.objects.count(), 1)
+
+    def test_confirm_creates_order(self):
+        """Test confirm moves held quota to sold and creates the order"""
+        ids = self._reserve(2).data['reservation_ids']
+
+        response = self.client.post('/api/checkout/confirm/', {
+            "reservation_ids": ids,
+            "customer": self.customer
+        }, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        item = OrderItem.objects.get(order_id=response.data['order_id'])
+        self.assertEqual(item.price_at_purchase, Decimal('800.00'))
+        self.assertEqual(item.promotion_source, 'flash_sale')
+        self.product.refresh_from_db()
+        self.fs_product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(self.fs_product.reserved_stock, 0)
+        self.assertEqual(self.fs_product.sold_count, 2)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_confirm_rejects_expired_hold(self):
+        """Test an expired reservation cannot be confirmed"""
+        ids = self._reserve(1).data['reservation_ids']
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        response = self.client.post('/api/checkout/confirm/', {
+            "reservation_ids": ids,
+            "customer": self.customer
+        }, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+    def test_confirm_rejects_other_users_hold(self):
+        """Test reservations belong to the user who made them"""
+        ids = self._reserve(1).data['reservation_ids']
+        other = User.objects.create_user(username='other', email='other@test.com', password='test123')
+        self.client.force_authenticate(user=other)
+
+        response = self.client.post('/api/checkout/confirm/', {
+            "reservation_ids": ids,
+            "customer": self.customer
+        }, format='json')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_release_expired_returns_stock_and_quota(self):
+        """Test the sweeper gives back stock and reserved_stock"""
+        self._reserve(2)
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        released = ReservationService.release_expired()
+
+        self.assertEqual(released, 1)
+        self.product.refresh_from_db()
+        self.fs_product.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+        self.assertEqual(self.fs_product.reserved_stock, 0)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_release_expired_in_batches(self):
+        """Test the sweeper aggregates per product across bounded batches"""
+        past = timezone.now() - timedelta(seconds=1)
+        StockReservation.objects.bulk_create([
+            StockReservation(user=self.user, product=self.product, flash_sale_product=self.fs_product,
+                             quantity=1, expires_at=past)
+            for _ in range(3)
+        ])
+        Product.objects.filter(id=self.product.id).update(stock=2)
+        FlashSaleProduct.objects.filter(id=self.fs_product.id).update(reserved_stock=3)
+
+        released = ReservationService.release_expired(batch_size=2)
+
+        self.assertEqual(released, 3)
+        self.product.refresh_from_db()
+        self.fs_product.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+        self.assertEqual(self.fs_product.reserved_stock, 0)
+
+    def test_next_wakeup_follows_earliest_expiry(self):
+        """Test the daemon sleeps until the next hold expires"""
+        now = timezone.now()
+        self.assertEqual(ReservationService.next_wakeup(now), now + timedelta(minutes=ReservationService.hold_minutes()))
+
+        soon = now + timedelta(seconds=30)
+        StockReservation.objects.create(user=self.user, product=self.product, quantity=1, expires_at=soon)
+        self.assertEqual(ReservationService.next_wakeup(now), soon)
+
+
+class CheckoutIdempotencyTest(TestCase):
+    """Test Idempotency-Key replay on /api/checkout/"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='retrier',
+            email='retrier@test.com',
+            password='test123',
+            role='customer'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.product = Product.objects.create(title="Mouse", price=Decimal('200.00'), stock=10)
+        self.payload = {
+            "items": [{"id": self.product.id, "quantity": 1}],
+            "customer": {
+                "name": "Test Retrier",
+                "phone": "0812345678",
+                "address": "9 Retry Rd",
+                "province": "Bangkok"
+            }
+        }
+
+    def _checkout(self, key, payload=None):
+        return self.client.post('/api/checkout/', payload or self.payload, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_stored_response(self):
+        """Test a retried key returns the first response without a second order"""
+        first = self._checkout('retry-1')
+        second = self._checkout('retry-1')
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.data['order_id'], first.data['order_id'])
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 9)
+
+    def test_replay_is_one_lookup(self):
+        """Test a replay does not touch stock rows"""
+        self._checkout('retry-2')
+        with CaptureQueriesContext(connection) as ctx:
+            self._checkout('retry-2')
+        self.assertFalse(any('products' in q['sql'] for q in ctx.captured_queries))
+
+    def test_key_reused_with_different_body(self):
+        """Test a key cannot be reused for another cart"""
+        self._checkout('retry-3')
+        other = dict(self.payload, items=[{"id": self.product.id, "quantity": 2}])
+
+        response = self._checkout('retry-3', other)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_checkout_does_not_store_key(self):
+        """Test a rejected checkout can be retried with the same key"""
+        Product.objects.filter(id=self.product.id).update(stock=0)
+        self.assertEqual(self._checkout('retry-4').status_code, 400)
+        self.assertFalse(CheckoutIdempotencyKey.objects.exists())
+
+        Product.objects.filter(id=self.product.id).update(stock=5)
+        self.assertEqual(self._checkout('retry-4').status_code, 201)
+
+    def test_expired_key_runs_again(self):
+        """Test keys past the TTL are ignored and purged"""
+        self._checkout('retry-5')
+        CheckoutIdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        response = self._checkout('retry-5')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(IdempotencyService.purge_expired(), 0)
+        self.assertEqual(CheckoutIdempotencyKey.objects.count(), 1)
+
+
+class OrderEventOutboxTest(TestCase):
+    """Test checkout side effects go through the order outbox"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='firsttimer',
+            email='firsttimer@test.com',
+            password='test123',
+            role='new_user'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.product = Product.objects.create(title="Headset", price=Decimal('1500.00'), stock=100)
+        self.coupon = Coupon.objects.create(
+            code='OUTBOX100',
+            discount_type='fixed',
+            discount_value=Decimal('100.00'),
+            start_date=timezone.now() - timedelta(days=1),
+            end_date=timezone.now() + timedelta(days=1),
+            active=True
+        )
+        self.payload = {
+            "items": [{"id": self.product.id, "quantity": 2}],
+            "couponCode": 'OUTBOX100',
+            "customer": {
+                "name": "Somchai Jaidee",
+                "phone": "0812345678",
+                "address": "5 Outbox Rd",
+                "province": "Chiang Mai"
+            }
+        }
+
+    def test_checkout_only_writes_event(self):
+        """Test the checkout transaction defers profile, role and logs"""
+        response = self.client.post('/api/checkout/', self.payload, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        event = OrderEvent.objects.get()
+        self.assertEqual(event.status, 'pending')
+        self.assertEqual(event.order_id, response.data['order_id'])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.role, 'new_user')
+        self.assertFalse(PromoUsageLog.objects.exists())
+        self.assertFalse(StockHistory.objects.exists())
+
+    def test_worker_applies_side_effects(self):
+        """Test run_order_events applies every side effect once"""
+        order_id = self.client.post('/api/checkout/', self.payload, format='json').data['order_id']
+
+        processed = OrderEventService.process_batch()
+
+        self.assertEqual(processed, 1)
+        self.assertEqual(OrderEvent.objects.get().status, 'done')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.role, 'customer')
+        self.assertEqual(self.user.first_name, 'Somchai')
+        self.assertEqual(self.user.last_name, 'Jaidee')
+        self.assertEqual(self.user.province, 'Chiang Mai')
+        self.assertTrue(PromoUsageLog.objects.filter(user=self.user, promo_type='coupon', promo_id=self.coupon.id, order_id=order_id).exists())
+        history = StockHistory.objects.get(product=self.product)
+        self.assertEqual(history.change_quantity, -2)
+        self.assertEqual(history.remaining_stock, 98)
+        self.assertTrue(Notification.objects.filter(user=self.user, related_id=order_id).exists())
+
+        self.assertEqual(OrderEventService.process_batch(), 0)
+        self.assertEqual(StockHistory.objects.count(), 1)
+
+    def test_usage_counted_at_checkout_once(self):
+        """Test the coupon counter moves in the checkout transaction and the worker does not add to it"""
+        self.client.post('/api/checkout/', self.payload, format='json')
+        self.assertEqual(PromoUsageService.usage(self.user, 'coupon', self.coupon.id), (1, 1))
+        # limit_per_user=1 holds for a back-to-back order, before the worker has run
+        self.assertEqual(self.client.post('/api/checkout/', self.payload, format='json').status_code, 400)
+
+        OrderEventService.process_batch()
+        self.assertEqual(PromoUsageService.usage(self.user, 'coupon', self.coupon.id), (1, 1))
+        self.assertEqual(PromoUsageLog.objects.filter(promo_type='coupon', promo_id=self.coupon.id).count(), 1)
+
+        # Events queued before checkout counted usage are still counted by the worker
+        PromoUsageCounter.objects.all().delete()
+        event = OrderEvent.objects.get()
+        del event.payload['usage_recorded']
+        event.status = 'pending'
+        event.save()
+        OrderEventService.process_batch()
+        self.assertEqual(PromoUsageService.usage(self.user, 'coupon', self.coupon.id), (1, 1))
+
+    def test_batch_query_count_is_flat(self):
+        """Test a batch costs the same number of queries for 1 or many events"""
+        for _ in range(5):
+            self.client.post('/api/checkout/', dict(self.payload, couponCode=None), format='json')
+
+        with CaptureQueriesContext(connection) as ctx:
+            OrderEventService.process_batch()
+        many = len(ctx.captured_queries)
+
+        self.client.post('/api/checkout/', dict(self.payload, couponCode=None), format='json')
+        with CaptureQueriesContext(connection) as ctx:
+            OrderEventService.process_batch()
+
+        self.assertEqual(len(ctx.captured_queries), many)
+        self.assertFalse(OrderEvent.objects.filter(status='pending').exists())
+
+    def test_bad_event_does_not_block_batch(self):
+        """Test a failing event is retried alone and the rest are applied"""
+        self.client.post('/api/checkout/', dict(self.payload, couponCode=None), format='json')
+        self.client.post('/api/checkout/', dict(self.payload, couponCode=None), format='json')
+        bad = OrderEvent.objects.order_by('id').first()
+        del bad.payload['lines'][0]['quantity']
+        bad.save()
+
+        OrderEventService.process_batch()
+
+        bad.refresh_from_db()
+        self.assertEqual(bad.status, 'pending')
+        self.assertEqual(bad.attempts, 1)
+        self.assertEqual(OrderEvent.objects.filter(status='done').count(), 1)
+
+
+class PriceCartTest(TestCase):
+    """Test whole-cart pricing shared by coupon preview and checkout"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='shopper',
+            email='shopper@test.com',
+            password='test123',
+            role='customer'
+        )
+        self.client.force_authenticate(user=self.user)
+        now = timezone.now()
+        self.products = [
+            Product.objects.create(title=f"Item {i}", price=Decimal('100.00'), stock=50)
+            for i in range(6)
+        ]
+        self.low = FlashSale.objects.create(
+            name="Low", start_time=now - timedelta(minutes=5), end_time=now + timedelta(hours=1),
+            is_active=True, priority=0
+        )
+        self.high = FlashSale.objects.create(
+            name="High", start_time=now - timedelta(minutes=5), end_time=now + timedelta(hours=1),
+            is_active=True, priority=10
+        )
+        for p in self.products[:3]:
+            FlashSaleProduct.objects.create(flash_sale=self.low, product=p, sale_price=Decimal('80.00'), quantity_limit=10)
+        FlashSaleProduct.objects.create(flash_sale=self.high, product=self.products[0], sale_price=Decimal('60.00'), quantity_limit=10)
+        self.coupon = Coupon.objects.create(
+            code='CART50',
+            discount_type='fixed',
+            discount_value=Decimal('50.00'),
+            start_date=now - timedelta(days=1),
+            end_date=now + timedelta(days=1),
+            is_stackable_with_flash_sale=True,
+            active=True
+        )
+        self.items = [{"id": p.id, "quantity": 1} for p in self.products]
+
+    def test_two_queries_for_any_cart(self):
+        """Test products and Flash Sale candidates are loaded once per cart"""
+        PromotionIndex.rebuild()
+        with self.assertNumQueries(2):
+            breakdown = PriceCalculator.price_cart(self.user, self.items)
+
+        prices = [line['price'] for line in breakdown['lines']]
+        self.assertEqual(prices, [Decimal('60.00'), Decimal('80.00'), Decimal('80.00')] + [Decimal('100.00')] * 3)
+        self.assertEqual(breakdown['subtotal'], Decimal('520.00'))
+        self.assertTrue(breakdown['has_flash_sale_item'])
+
+    def test_sold_out_sale_falls_through(self):
+        """Test a sold-out higher priority sale falls back to the next one"""
+        FlashSaleProduct.objects.filter(flash_sale=self.high).update(sold_count=10)
+        breakdown = PriceCalculator.price_cart(self.user, self.items[:1])
+        self.assertEqual(breakdown['lines'][0]['price'], Decimal('80.00'))
+
+    def test_coupon_applied_on_cart(self):
+        """Test a valid coupon is applied on the server-side subtotal"""
+        breakdown = PriceCalculator.price_cart(self.user, self.items, 'CART50')
+        self.assertEqual(breakdown['coupon'], self.coupon)
+        self.assertEqual(breakdown['discount_amount'], Decimal('50.00'))
+        self.assertEqual(breakdown['total'], Decimal('520.00') + PriceCalculator.SHIPPING_COST - Decimal('50.00'))
+
+    def test_non_stackable_coupon_reported(self):
+        """Test a coupon that cannot stack with Flash Sale is reported, not raised"""
+        Coupon.objects.filter(id=self.coupon.id).update(is_stackable_with_flash_sale=False)
+        breakdown = PriceCalculator.price_cart(self.user, self.items, 'CART50')
+        self.assertIsNone(breakdown['coupon'])
+        self.assertEqual(breakdown['coupon_error'], "คูปองนี้ไม่สามารถใช้ร่วมกับสินค้า Flash Sale ได้")
+
+    def test_validate_coupon_api_returns_lines(self):
+        """Test coupon preview returns the per-line breakdown"""
+        response = self.client.post('/api/coupons/validate/', {
+            "code": 'CART50',
+            "total_amount": 1,
+            "items": self.items
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['valid'])
+        self.assertEqual(response.data['subtotal'], Decimal('520.00'))
+        self.assertEqual(len(response.data['lines']), 6)
+        self.assertEqual(response.data['lines'][0]['source_type'], 'flash_sale')
+
+    def test_checkout_charges_preview_price(self):
+        """Test checkout uses the same Flash Sale pick as the preview"""
+        preview = PriceCalculator.price_cart(self.user, self.items[:2])
+        response = self.client.post('/api/checkout/', {
+            "items": self.items[:2],
+            "customer": {"name": "Shopper", "phone": "0812345678", "address": "1 Cart Rd", "province": "Bangkok"}
+        }, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Decimal(str(response.data['total'])), preview['subtotal'])
+
+
+class BenchmarkCheckoutCommandTest(TestCase):
+    """Test the benchmark_checkout management command (serial mode)"""
+
+    def test_serial_run_reports_consistency(self):
+        """Test a serial run writes a JSON report with no oversell"""
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        call_command(
+            'benchmark_checkout', users=3, requests=6, concurrency=1,
+            stock=5, quota=2, output=path, stdout=io.StringIO()
+        )
+
+        with open(path, encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertEqual(report['requests'], 6)
+        self.assertEqual(report['succeeded'], 5)
+        self.assertEqual(report['consistency']['sold_count'], 2)
+        self.assertEqual(report['consistency']['final_stock'], 0)
+        self.assertTrue(report['consistency']['ok'])
+        self.assertIn('p99', report['latency_ms'])
@@ -3,14 +3,23 @@ Unit Tests for Coupon System
 Tests: Coupon model, validation, discount calculation, and APIs
 """
 
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from datetime import timedelta
 from decimal import Decimal
-from myapp.models import Coupon, UserCoupon, Product, Category, PromoUsageLog
+from myapp.models import Coupon, UserCoupon, Product, Category, PromoUsageLog, PromoUsageCounter, Order, CouponDailyStat
 import json
-from myapp.services import CouponService
+from myapp.services import CouponService, PromoUsageService, CouponSimulationService, PublicCouponCatalog, CouponCodeFilter
+from django.db.models import F
+from django.core.cache import cache
+import numpy as np
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import io
+from importlib import import_module
+from django.apps import apps as django_apps
 
 User = get_user_model()
 
@@ -495,3 +504,548 @@ class AdvancedCouponValidationTest(TestCase):
         )
         self.assertFalse(is_valid)
         self.assertIn("คูปองนี้ถูกใช้งานครบจำนวนแล้ว", message)
+
+
+class CompiledCouponRulesTest(TestCase):
+    """Test batched product lookup and cached compiled coupon rules"""
+
+    def setUp(self):
+        now = timezone.now()
+        self.user = User.objects.create_user(username='rules_user', email='rules@test.com', password='test123', role='customer')
+        self.excluded_cat = Category.objects.create(name="Excluded")
+        self.products = [
+            Product.objects.create(title=f"Rule Item {i}", price=Decimal('100.00'), stock=10)
+            for i in range(10)
+        ]
+        self.excluded = Product.objects.create(title="Excluded Item", price=Decimal('900.00'), stock=10, category=self.excluded_cat)
+        self.coupon = Coupon.objects.create(
+            code="RULES",
+            discount_type="tiered",
+            discount_value=Decimal('0'),
+            min_spend=Decimal('500.00'),
+            start_date=now - timedelta(days=1),
+            end_date=now + timedelta(days=1),
+            conditions={"exclude_categories": [self.excluded_cat.id]},
+            tiered_rules=[{"min": 500, "disc": 50}, {"min": 1000, "disc": 150}],
+            active=True
+        )
+
+    def test_query_count_independent_of_cart_size(self):
+        """Test conditions resolve all cart products with one query"""
+        small = [{"id": p.id, "quantity": 1} for p in self.products[:5]]
+        large = [{"id": p.id, "quantity": 1} for p in self.products]
+        CouponService.validate_coupon(self.user, "RULES", Decimal('500'), small)
+
+        with self.assertNumQueries(4):
+            CouponService.validate_coupon(self.user, "RULES", Decimal('500'), small)
+        with self.assertNumQueries(4):
+            is_valid, _, _ = CouponService.validate_coupon(self.user, "RULES", Decimal('1000'), large)
+        self.assertTrue(is_valid)
+
+    def test_excluded_category_not_counted(self):
+        """Test excluded products do not count towards min spend"""
+        items = [{"id": self.excluded.id, "quantity": 1}]
+        is_valid, message, _ = CouponService.validate_coupon(self.user, "RULES", Decimal('900'), items)
+        self.assertFalse(is_valid)
+        self.assertIn("สินค้าที่ร่วมรายการ", message)
+
+    def test_rules_reused_until_coupon_saved(self):
+        """Test compiled rules are cached and rebuilt on save"""
+        rules = CouponService.get_rules(self.coupon)
+        self.assertIs(CouponService.get_rules(self.coupon), rules)
+        self.assertEqual(CouponService.calculate_discount(self.coupon, Decimal('1200')), Decimal('150'))
+
+        self.coupon.tiered_rules = [{"min": 500, "disc": 80}]
+        self.coupon.save()
+
+        self.assertIsNot(CouponService.get_rules(self.coupon), rules)
+        self.assertEqual(CouponService.calculate_discount(self.coupon, Decimal('1200')), Decimal('80'))
+
+    def test_stale_rules_detected_without_signal(self):
+        """Test rules changed by another process are recompiled"""
+        CouponService.get_rules(self.coupon)
+        Coupon.objects.filter(id=self.coupon.id).update(tiered_rules=[{"min": 0, "disc": 10}])
+        fresh = Coupon.objects.get(id=self.coupon.id)
+        self.assertEqual(CouponService.calculate_discount(fresh, Decimal('1200')), Decimal('10'))
+
+
+class PromoUsageCounterTest(TestCase):
+    """Test materialized promo usage counters, backfill and log retention"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='counter_user', email='counter@test.com', password='test123')
+        self.other = User.objects.create_user(username='counter_other', email='counter2@test.com', password='test123')
+
+    def test_log_increments_counter(self):
+        """Test each usage log increments its daily counter"""
+        PromoUsageLog.objects.create(user=self.user, promo_type='coupon', promo_id=7)
+        PromoUsageLog.objects.create(user=self.user, promo_type='coupon', promo_id=7)
+
+        counter = PromoUsageCounter.objects.get(user=self.user, promo_type='coupon', promo_id=7)
+        self.assertEqual(counter.day, timezone.localdate())
+        self.assertEqual(counter.count, 2)
+
+    def test_usage_is_one_query(self):
+        """Test daily and lifetime usage come from one counter query"""
+        yesterday = timezone.localdate() - timedelta(days=1)
+        PromoUsageService.record([
+            (self.user.id, 'coupon', 7, yesterday),
+            (self.user.id, 'coupon', 7, timezone.localdate()),
+            (self.other.id, 'coupon', 7, timezone.localdate()),
+        ])
+
+        with self.assertNumQueries(1):
+            today, lifetime = PromoUsageService.usage(self.user, 'coupon', 7)
+        self.assertEqual((today, lifetime), (1, 2))
+
+    def test_record_batch_is_two_statements(self):
+        """Test a batch of entries costs one INSERT and one UPDATE"""
+        today = timezone.localdate()
+        entries = [(self.user.id, 'flash', i % 3, today) for i in range(9)]
+
+        with self.assertNumQueries(2):
+            PromoUsageService.record(entries)
+        self.assertEqual(
+            sorted(PromoUsageCounter.objects.values_list('count', flat=True)), [3, 3, 3]
+        )
+
+    def test_backfill_rebuilds_from_logs(self):
+        """Test backfill recreates counters from existing logs"""
+        for _ in range(3):
+            PromoUsageLog.objects.create(user=self.user, promo_type='coupon', promo_id=9)
+        PromoUsageCounter.objects.all().delete()
+
+        call_command('backfill_promo_usage_counters', stdout=io.StringIO())
+
+        _, lifetime = PromoUsageService.usage(self.user, 'coupon', 9)
+        self.assertEqual(lifetime, 3)
+
+    def test_prune_keeps_limits(self):
+        """Test pruning old raw logs does not change remaining quota"""
+        log = PromoUsageLog.objects.create(user=self.user, promo_type='coupon', promo_id=11)
+        PromoUsageLog.objects.filter(id=log.id).update(timestamp=timezone.now() - timedelta(days=400))
+
+        call_command('prune_promo_usage_logs', days=30, stdout=io.StringIO())
+
+        self.assertFalse(PromoUsageLog.objects.exists())
+        _, lifetime = PromoUsageService.usage(self.user, 'coupon', 11)
+        self.assertEqual(lifetime, 1)
+
+
+class BestCouponTest(TestCase):
+    """Test auto-apply best coupon evaluation for a cart"""
+
+    def setUp(self):
+        now = timezone.now()
+        self.user = User.objects.create_user(username='best_user', email='best@test.com', password='test123', role='customer')
+        self.product = Product.objects.create(title="Best Item", price=Decimal('1000.00'), stock=10)
+        self.items = [{"id": self.product.id, "quantity": 1}]
+
+        def make(code, **kwargs):
+            defaults = dict(
+                discount_type='fixed', discount_value=Decimal('50.00'),
+                start_date=now - timedelta(days=1), end_date=now + timedelta(days=1), active=True
+            )
+            defaults.update(kwargs)
+            return Coupon.objects.create(code=code, **defaults)
+
+        self.auto_small = make('AUTO50', auto_apply=True)
+        self.auto_big = make('AUTO10P', auto_apply=True, discount_type='percent', discount_value=Decimal('10.00'))
+        self.wallet = make('WALLET200', discount_value=Decimal('200.00'), min_spend=Decimal('2000.00'))
+        self.not_offered = make('HIDDEN500', discount_value=Decimal('500.00'))
+        UserCoupon.objects.create(user=self.user, coupon=self.wallet)
+
+    def test_best_coupon_picked(self):
+        """Test the largest valid discount wins and min spend is enforced"""
+        result = CouponService.best_coupons(self.user, self.items)
+
+        self.assertEqual(result['best']['coupon'], self.auto_big)
+        self.assertEqual(result['best']['discount_amount'], Decimal('100.00'))
+        codes = [c['coupon'].code for c in result['candidates']]
+        self.assertNotIn('HIDDEN500', codes)
+        wallet = next(c for c in result['candidates'] if c['coupon'] == self.wallet)
+        self.assertFalse(wallet['valid'])
+
+    def test_fixed_query_count(self):
+        """Test evaluation cost does not grow with the number of coupons"""
+        CouponService.best_coupons(self.user, self.items)
+        with self.assertNumQueries(5): # Flash Sale rows are always read from the DB for pricing
+            CouponService.best_coupons(self.user, self.items)
+
+        for i in range(5):
+            Coupon.objects.create(
+                code=f'AUTOX{i}', discount_type='fixed', discount_value=Decimal('5.00'), auto_apply=True,
+                start_date=timezone.now() - timedelta(days=1), end_date=timezone.now() + timedelta(days=1)
+            )
+        with self.assertNumQueries(5):
+            CouponService.best_coupons(self.user, self.items)
+
+    def test_api_returns_best(self):
+        """Test best coupon endpoint"""
+        client = Client()
+        client.force_login(self.user)
+        response = client.post('/api/coupons/best/', json.dumps({"items": self.items}), content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['best']['code'], 'AUTO10P')
+        self.assertEqual(len(data['candidates']), 3)
+
+
+class CouponClaimTest(TestCase):
+    """Test contention-safe coupon collection via the collected_count counter"""
+
+    def setUp(self):
+        now = timezone.now()
+        self.user = User.objects.create_user(username='claim_user', email='claim@test.com', password='test123', role='customer')
+        self.other = User.objects.create_user(username='claim_other', email='claim2@test.com', password='test123', role='customer')
+        self.coupon = Coupon.objects.create(
+            code='CLAIM1', discount_type='fixed', discount_value=Decimal('10.00'),
+            start_date=now - timedelta(days=1), end_date=now + timedelta(days=1),
+            usage_limit=1, total_supply=1, active=True
+        )
+
+    def test_claim_increments_counter(self):
+        """Test a claim adds the wallet row and bumps collected_count"""
+        CouponService.claim(self.user, self.coupon)
+
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.collected_count, 1)
+        self.assertTrue(UserCoupon.objects.filter(user=self.user, coupon=self.coupon).exists())
+
+    def test_duplicate_claim_rejected(self):
+        """Test the unique wallet row blocks a second claim by the same user"""
+        self.coupon.total_supply = 10
+        self.coupon.save()
+        CouponService.claim(self.user, self.coupon)
+
+        with self.assertRaisesMessage(ValueError, 'คุณเก็บคูปองนี้ครบจำนวนสิทธิ์แล้ว'):
+            CouponService.claim(self.user, self.coupon)
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.collected_count, 1)
+
+    def test_supply_exhausted_leaves_no_wallet_row(self):
+        """Test a claim past total supply is rolled back"""
+        CouponService.claim(self.user, self.coupon)
+
+        client = Client()
+        client.force_login(self.other)
+        response = client.post(f'/api/coupons/{self.coupon.id}/collect/')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['message'], 'คูปองหมดแล้ว!')
+        self.assertFalse(UserCoupon.objects.filter(user=self.other).exists())
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.collected_count, 1)
+
+    def test_benchmark_reports_no_over_issue(self):
+        """Test benchmark_coupon_claims command (serial run)"""
+        out = io.StringIO()
+        call_command('benchmark_coupon_claims', users=6, supply=3, repeat=1, concurrency=1, stdout=out)
+
+        self.assertIn('Consistent: zero over-issue', out.getvalue())
+        self.assertIn('(3 claimed, 9 rejected)', out.getvalue())
+
+
+class CouponDailyStatsTest(TestCase):
+    """Test the incrementally maintained coupon_daily_stats rollup"""
+
+    def setUp(self):
+        now = timezone.now()
+        self.admin = User.objects.create_user(username='stats_admin', email='stats@test.com', password='test123', role='admin')
+        self.user = User.objects.create_user(username='stats_user', email='stats_u@test.com', password='test123', role='customer')
+        self.coupon = Coupon.objects.create(
+            code='STATS1', discount_type='fixed', discount_value=Decimal('50.00'),
+            start_date=now - timedelta(days=1), end_date=now + timedelta(days=1)
+        )
+
+    def make_order(self, status='Paid', total='950.00', discount='50.00'):
+        return Order.objects.create(
+            user=self.user, customer_name='Stats', customer_tel='0812345678', shipping_address='Bangkok',
+            total_price=Decimal(total), discount_amount=Decimal(discount), coupon=self.coupon, status=status
+        )
+
+    def stat(self):
+        return CouponDailyStat.objects.get(coupon=self.coupon, day=timezone.localdate())
+
+    def test_paid_orders_roll_up(self):
+        """Test only paid statuses count and status changes move the totals"""
+        self.make_order()
+        pending = self.make_order(status='Pending', total='500.00')
+        self.assertEqual((self.stat().uses, self.stat().revenue, self.stat().discount), (1, Decimal('950.00'), Decimal('50.00')))
+
+        pending.status = 'Paid'
+        pending.save()
+        self.assertEqual((self.stat().uses, self.stat().revenue), (2, Decimal('1450.00')))
+
+        pending.status = 'Cancelled'
+        pending.save()
+        self.assertEqual((self.stat().uses, self.stat().revenue), (1, Decimal('950.00')))
+
+        Order.objects.filter(coupon=self.coupon, status='Paid').delete()
+        self.assertEqual(self.stat().uses, 0)
+
+    def test_collections_and_rebuild_match(self):
+        """Test claims count as collections and a rebuild reproduces the rollup"""
+        CouponService.claim(self.user, self.coupon)
+        self.make_order()
+        incremental = CouponDailyStat.objects.values('coupon_id', 'day', 'uses', 'revenue', 'discount', 'collections').get()
+        self.assertEqual(incremental['collections'], 1)
+
+        call_command('rebuild_coupon_daily_stats', stdout=io.StringIO())
+        rebuilt = CouponDailyStat.objects.values('coupon_id', 'day', 'uses', 'revenue', 'discount', 'collections').get()
+        self.assertEqual(rebuilt, incremental)
+
+    def test_migration_backfills_existing_orders(self):
+        """Test orders and claims made before the rollup table are counted on migrate"""
+        CouponService.claim(self.user, self.coupon)
+        self.make_order()
+        self.make_order(status='Pending')
+        CouponDailyStat.objects.all().delete()
+
+        backfill = import_module('myapp.migrations.0045_backfill_coupon_daily_stats').backfill_coupon_daily_stats
+        backfill(django_apps, None)
+
+        self.assertEqual((self.stat().uses, self.stat().revenue, self.stat().collections), (1, Decimal('950.00'), 1))
+
+    def test_bulk_status_update_rebuilds(self):
+        """Test bulk order status updates (no signals) still refresh the rollup"""
+        order = self.make_order(status='Pending')
+        client = Client()
+        client.force_login(self.admin)
+        client.post('/api/admin/orders/bulk-update/', json.dumps({"order_ids": [order.id], "status": "Paid"}),
+                    content_type='application/json')
+        self.assertEqual(self.stat().uses, 1)
+
+    def test_dashboard_query_count_is_fixed(self):
+        """Test coupon analytics cost does not grow with the number of coupons"""
+        self.make_order()
+        client = Client()
+        client.force_login(self.admin)
+
+        with CaptureQueriesContext(connection) as few:
+            response = client.get('/api/analytics/coupons/')
+        self.assertEqual(response.json()['coupons'][0]['total_revenue'], 950.0)
+
+        for i in range(30):
+            Coupon.objects.create(
+                code=f'STATSX{i}', discount_type='fixed', discount_value=Decimal('5.00'),
+                end_date=timezone.now() + timedelta(days=1)
+            )
+        with CaptureQueriesContext(connection) as many:
+            response = client.get('/api/analytics/coupons/')
+        self.assertEqual(len(many), len(few))
+        self.assertEqual(response.json()['summary']['total_coupons'], 31)
+        self.assertEqual(len(response.json()['coupons']), 20)
+
+        detail = client.get(f'/api/analytics/coupons/{self.coupon.id}/').json()
+        self.assertEqual(detail['daily_usage'][-1]['usage'], 1)
+        self.assertEqual(detail['recent_orders_count'], 1)
+
+
+class CouponSimulationTest(TestCase):
+    """Test historical replay of draft coupons"""
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(username='sim_admin', email='sim@test.com', password='test123', role='admin')
+        for total, status in [('200.00', 'Paid'), ('800.00', 'Shipped'), ('1500.00', 'Completed'),
+                              ('3000.00', 'Processing'), ('9999.00', 'Pending')]:
+            Order.objects.create(
+                customer_name='Sim', customer_tel='0812345678', shipping_address='Bangkok',
+                item_subtotal=Decimal(total), total_price=Decimal(total), status=status
+            )
+
+    def test_baskets_use_paid_statuses_and_cache_per_day(self):
+        """Test only paid orders are loaded, once per day"""
+        baskets = CouponSimulationService.order_baskets()
+        self.assertEqual(sorted(baskets.tolist()), [200.0, 800.0, 1500.0, 3000.0])
+        with self.assertNumQueries(0):
+            CouponSimulationService.order_baskets()
+
+    def test_vectorized_discount_rules(self):
+        """Test min spend, caps and tiers match calculate_discount"""
+        baskets = np.array([200.0, 800.0, 1500.0, 3000.0])
+        fixed = CouponSimulationService.discounts(baskets, 'fixed', 300, min_spend=500)
+        self.assertEqual(fixed.tolist(), [0.0, 300.0, 300.0, 300.0])
+        capped = CouponSimulationService.discounts(baskets, 'percent', 10, max_discount_amount=100)
+        self.assertEqual(capped.tolist(), [20.0, 80.0, 100.0, 100.0])
+        tiered = CouponSimulationService.discounts(
+            baskets, 'tiered', 0, tiered_rules=[{'min': 3000, 'disc': 500}, {'min': 1000, 'disc': 100}]
+        )
+        self.assertEqual(tiered.tolist(), [0.0, 0.0, 100.0, 500.0])
+
+    def test_simulate_api(self):
+        """Test simulate endpoint returns percentile liability and qualify rate"""
+        client = Client()
+        client.force_login(self.admin)
+        response = client.post('/api/admin/coupons/simulate/', json.dumps({
+            "discount_type": "fixed", "discount_value": 100, "usage_limit": 10, "min_spend": 1000
+        }), content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['orders_sampled'], 4)
+        self.assertEqual(data['qualify_rate'], 0.5)
+        self.assertEqual(data['liability']['p95'], 1000.0)
+        self.assertEqual(data['max_liability'], 1000.0)
+        self.assertEqual(data['break_even']['roas'], 22.5)
+
+        response = client.post('/api/admin/coupons/simulate/', json.dumps({
+            "discount_type": "bogus", "discount_value": 1
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_no_history_falls_back_to_worst_case(self):
+        """Test an empty order history still bounds liability at usage_limit x discount"""
+        empty = np.array([])
+        fixed = CouponSimulationService.simulate('fixed', Decimal('100'), 10, baskets=empty)
+        self.assertEqual(fixed['orders_sampled'], 0)
+        self.assertEqual(fixed['liability']['p95'], 1000.0)
+        self.assertEqual(fixed['avg_order_value'], 500.0)
+
+        percent = CouponSimulationService.simulate('percent', Decimal('10'), 10, max_discount_amount=40, baskets=empty)
+        self.assertEqual(percent['liability']['p95'], 400.0) # min(500 x 10%, 40) per use
+        high_min = CouponSimulationService.simulate('fixed', Decimal('100'), 10, min_spend=2000, baskets=empty)
+        self.assertEqual(high_min['liability']['p95'], 1000.0)
+
+
+class PublicCouponCatalogTest(TestCase):
+    """Test the cached, versioned public coupon payload"""
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='cat_user', email='cat@test.com', password='test123', role='customer')
+        self.coupon = Coupon.objects.create(
+            code='CATALOG1', discount_type='fixed', discount_value=Decimal('20.00'),
+            end_date=timezone.now() + timedelta(days=1), usage_limit=5, total_supply=5
+        )
+
+    def test_served_from_cache_until_write(self):
+        """Test repeat loads skip the DB and writes rebuild the payload"""
+        first = self.client.get('/api/coupons-public/')
+        self.assertEqual([c['code'] for c in first.json()], ['CATALOG1'])
+
+        with self.assertNumQueries(0):
+            self.client.get('/api/coupons-public/')
+
+        CouponService.claim(self.user, self.coupon)
+        response = self.client.get('/api/coupons-public/')
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertEqual(response.json()[0]['remaining'], 4)
+
+        self.coupon.active = False
+        self.coupon.save()
+        self.assertEqual(self.client.get('/api/coupons-public/').json(), [])
+
+    def test_keeps_priority_order(self):
+        """Test the catalog lists coupons by priority, then latest end date first"""
+        now = timezone.now()
+        Coupon.objects.create(code='CATALOG_TOP', discount_type='fixed', discount_value=Decimal('5.00'),
+                              end_date=now + timedelta(hours=1), priority=10)
+        Coupon.objects.create(code='CATALOG_LATE', discount_type='fixed', discount_value=Decimal('5.00'),
+                              end_date=now + timedelta(days=3))
+
+        codes = [c['code'] for c in self.client.get('/api/coupons-public/').json()]
+        self.assertEqual(codes, ['CATALOG_TOP', 'CATALOG_LATE', 'CATALOG1'])
+
+    def test_etag_not_modified(self):
+        """Test If-None-Match returns 304 while nothing changed"""
+        etag = self.client.get('/api/coupons-public/')['ETag']
+
+        response = self.client.get('/api/coupons-public/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        Coupon.objects.create(code='CATALOG2', discount_type='fixed', discount_value=Decimal('5.00'),
+                              end_date=timezone.now() + timedelta(days=1))
+        response = self.client.get('/api/coupons-public/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+
+    def test_payload_expires_with_first_coupon(self):
+        """Test a cached payload is rebuilt once a listed coupon has ended"""
+        PublicCouponCatalog.get()
+        etag, payload = PublicCouponCatalog.get(now=timezone.now() + timedelta(days=2))
+        self.assertEqual(payload, [])
+
+
+@override_settings(CACHE_IS_SHARED=True)
+class CouponCodeFilterTest(TestCase):
+    """Test the Bloom-filter prefilter in front of coupon code lookups"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='bloom_user', email='bloom@test.com', password='test123', role='customer')
+        self.coupon = Coupon.objects.create(
+            code='BLOOM50', discount_type='fixed', discount_value=Decimal('50.00'),
+            end_date=timezone.now() + timedelta(days=1)
+        )
+        CouponCodeFilter.rebuild()
+
+    def test_unknown_code_rejected_without_query(self):
+        """Test misses skip the DB and are counted"""
+        before = CouponCodeFilter.snapshot()
+        with self.assertNumQueries(0):
+            is_valid, message, _ = CouponService.validate_coupon(self.user, 'GUESS-0001', 1000)
+        self.assertFalse(is_valid)
+        self.assertEqual(message, 'ไม่พบรหัสคูปองนี้')
+        self.assertEqual(CouponCodeFilter.snapshot()['rejected'], before['rejected'] + 1)
+
+    def test_known_codes_pass_case_insensitively(self):
+        """Test existing codes always pass (no false negatives)"""
+        self.assertTrue(CouponCodeFilter.might_exist('BLOOM50'))
+        self.assertTrue(CouponCodeFilter.might_exist('bloom50'))
+        is_valid, _, coupon = CouponService.validate_coupon(self.user, 'BLOOM50', 1000)
+        self.assertTrue(is_valid)
+        self.assertEqual(coupon, self.coupon)
+
+    def test_writes_update_filter(self):
+        """Test created and renamed coupons pass without a manual rebuild"""
+        Coupon.objects.create(code='FRESH10', discount_type='fixed', discount_value=Decimal('10.00'),
+                              end_date=timezone.now() + timedelta(days=1))
+        self.assertTrue(CouponCodeFilter.might_exist('FRESH10'))
+
+        self.coupon.code = 'RENAMED50'
+        self.coupon.save()
+        self.assertTrue(CouponCodeFilter.might_exist('RENAMED50'))
+
+        # Counter-only saves do not force a rebuild
+        rebuilds = CouponCodeFilter.stats['rebuilds']
+        self.coupon.used_count = F('used_count') + 1
+        self.coupon.save()
+        CouponCodeFilter.might_exist('RENAMED50')
+        self.assertEqual(CouponCodeFilter.stats['rebuilds'], rebuilds)
+
+    @override_settings(CACHE_IS_SHARED=False)
+    def test_per_process_cache_never_rejects_on_a_miss(self):
+        """Test a code created by another worker (no signal, no shared version) still reaches the DB"""
+        Coupon.objects.bulk_create([Coupon(
+            code='OTHERWORKER', discount_type='fixed', discount_value=Decimal('10.00'),
+            end_date=timezone.now() + timedelta(days=1)
+        )])
+        before = CouponCodeFilter.snapshot()
+
+        is_valid, _, coupon = CouponService.validate_coupon(self.user, 'OTHERWORKER', 1000)
+
+        self.assertTrue(is_valid)
+        self.assertEqual(coupon.code, 'OTHERWORKER')
+        self.assertEqual(CouponCodeFilter.snapshot()['unverified'], before['unverified'] + 1)
+        self.assertEqual(CouponCodeFilter.snapshot()['rejected'], before['rejected'])
+
+    def test_checkout_rejects_unknown_code_early(self):
+        """Test create_order fails fast on an unknown coupon code"""
+        client = Client()
+        client.force_login(self.user)
+        product = Product.objects.create(title="Bloom Item", price=Decimal('100.00'), stock=5)
+        response = client.post('/api/checkout/', json.dumps({
+            "items": [{"id": product.id, "quantity": 1}],
+            "customer": {"name": "Bloom", "phone": "0812345678", "address": "Bangkok Rd", "province": "Bangkok"},
+            "couponCode": "NOPE-123"
+        }), content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'รหัสคูปองไม่ถูกต้อง')
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 5)
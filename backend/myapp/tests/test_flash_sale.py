@@ -4,16 +4,25 @@ Tests: FlashSale model, FlashSaleProduct, FlashSaleCampaign, and related APIs
 """
 
 from django.test import TestCase, Client
+from django.db import connection, transaction
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from datetime import timedelta
+from datetime import datetime, timedelta
 from decimal import Decimal
 from myapp.models import (
     FlashSale, FlashSaleProduct, FlashSaleCampaign, 
-    Product, Category, PromoUsageLog
+    Product, Category, PromoUsageLog, Tag, ProductImage, AdminLog, PromotionSchedule, Coupon, FlashSaleRound
 )
+from myapp.serializers import ProductSerializer, FlashSaleSerializer, FlashSaleCampaignSerializer
+from rest_framework.renderers import JSONRenderer
 import json
-from myapp.services import FlashSaleService
+from myapp.services import FlashSaleService, PromotionIndex, PromotionSchedulerService, FlashSaleStream, ActiveFlashSaleFeed, PromotionConflictService
+from unittest.mock import patch
+from django.core.management import call_command
+from io import StringIO
+import time
+from importlib import import_module
+from django.apps import apps as django_apps
 
 User = get_user_model()
 
@@ -279,7 +288,7 @@ class FlashSaleServiceTest(TestCase):
 
     def test_flash_sale_rounds_logic(self):
         """Test round-based time validation in service"""
-        now = timezone.now()
+        now = timezone.localtime() # Rounds are shop-local HH:MM
         current_hour = now.hour
         self.flash_sale.rounds = [{"start": f"{current_hour:02d}:00", "end": f"{current_hour:02d}:59"}]
         self.flash_sale.save()
@@ -288,7 +297,7 @@ class FlashSaleServiceTest(TestCase):
 
     def test_flash_sale_rounds_logic_outside(self):
         """Test round-based time validation when outside round"""
-        now = timezone.now()
+        now = timezone.localtime()
         next_hour = (now.hour + 1) % 24
         self.flash_sale.rounds = [{"start": f"{next_hour:02d}:00", "end": f"{next_hour:02d}:59"}]
         self.flash_sale.save()
@@ -330,3 +339,726 @@ class FlashSaleAnalyticsExtendedTest(TestCase):
         fs = FlashSale(name="Invalid Time", start_time=now, end_time=now - timedelta(hours=1))
         # If the model has a clean method, we check it. Otherwise just model persistence.
         self.assertTrue(fs.end_time < fs.start_time)
+
+
+class PromotionIndexTest(TestCase):
+    """Test the in-process Flash Sale interval index"""
+
+    def setUp(self):
+        now = timezone.now()
+        self.product = Product.objects.create(title="Index Item", price=Decimal('100.00'), stock=10)
+        self.other = Product.objects.create(title="No Sale Item", price=Decimal('50.00'), stock=10)
+        self.flash_sale = FlashSale.objects.create(
+            name="Index Sale", start_time=now - timedelta(minutes=5), end_time=now + timedelta(hours=1), is_active=True
+        )
+        self.upcoming = FlashSale.objects.create(
+            name="Later Sale", start_time=now + timedelta(hours=2), end_time=now + timedelta(hours=3), is_active=True
+        )
+        self.fs_product = FlashSaleProduct.objects.create(
+            flash_sale=self.flash_sale, product=self.product, sale_price=Decimal('70.00'), quantity_limit=5
+        )
+        FlashSaleProduct.objects.create(
+            flash_sale=self.upcoming, product=self.other, sale_price=Decimal('10.00'), quantity_limit=5
+        )
+        PromotionIndex.rebuild()
+
+    def test_lookups_are_memory_hits(self):
+        """Test product lookups need no query once the index is built"""
+        with self.assertNumQueries(0):
+            info = PromotionIndex.flash_sale_info(self.product.id)
+            self.assertIsNone(PromotionIndex.flash_sale_info(self.other.id))
+        self.assertEqual(info['id'], self.flash_sale.id)
+        self.assertEqual(info['sale_price'], Decimal('70.00'))
+
+    def test_checkout_prices_from_the_db_not_the_index(self):
+        """Test pick_live sees boundaries the index has not caught up with yet"""
+        # Written behind the index's back: it still shows the old state
+        FlashSaleProduct.objects.bulk_create([FlashSaleProduct(
+            flash_sale=self.flash_sale, product=self.other, sale_price=Decimal('40.00'), quantity_limit=5
+        )])
+        FlashSale.objects.filter(id=self.flash_sale.id).update(end_time=timezone.now() - timedelta(seconds=1))
+
+        with self.settings(CACHE_IS_SHARED=True):
+            self.assertIsNone(PromotionIndex.flash_sale_info(self.other.id))
+            self.assertEqual(PromotionIndex.flash_sale_info(self.product.id)['sale_price'], Decimal('70.00'))
+        self.assertEqual(FlashSaleService.pick_live([self.product.id, self.other.id]), {}) # Just ended
+
+        FlashSale.objects.filter(id=self.flash_sale.id).update(end_time=timezone.now() + timedelta(hours=1))
+        picked = FlashSaleService.pick_live([self.product.id, self.other.id])
+        self.assertEqual(picked[self.other.id].sale_price, Decimal('40.00')) # Just added
+
+    def test_upcoming_window_opens_at_boundary(self):
+        """Test a window becomes live once its start boundary passes"""
+        later = timezone.now() + timedelta(hours=2, minutes=1)
+        self.assertEqual(PromotionIndex.flash_sale_info(self.other.id, now=later)['sale_price'], Decimal('10.00'))
+        self.assertIsNone(PromotionIndex.flash_sale_info(self.product.id, now=later))
+
+    def test_promotion_writes_rebuild(self):
+        """Test config writes reach the index and counter saves do not"""
+        self.fs_product.sale_price = Decimal('60.00')
+        self.fs_product.save()
+        self.assertEqual(PromotionIndex.flash_sale_info(self.product.id)['sale_price'], Decimal('60.00'))
+
+        self.fs_product.sold_count += 1
+        self.fs_product.save()
+        with self.assertNumQueries(0):
+            PromotionIndex.flash_sale_info(self.product.id)
+        loaded = FlashSaleProduct.objects.get(id=self.fs_product.id) # Compared with the values it was read with
+        loaded.sold_count += 1
+        loaded.save()
+        with self.assertNumQueries(0):
+            PromotionIndex.flash_sale_info(self.product.id)
+
+        # In-place edit of rounds: one round that ended an hour ago
+        ended = timezone.localtime(timezone.now() - timedelta(hours=2))
+        self.flash_sale.rounds.append({'start': ended.strftime('%H:%M'), 'end': ended.strftime('%H:%M')})
+        self.flash_sale.save()
+        self.assertIsNone(PromotionIndex.flash_sale_info(self.product.id))
+
+        self.flash_sale.rounds = []
+        self.flash_sale.is_active = False
+        self.flash_sale.save()
+        self.assertEqual(PromotionIndex.candidates([self.product.id]), {})
+
+    def test_per_process_cache_rereads_other_workers_writes(self):
+        """Test a sale written by another worker (no version bump seen here) reaches the index"""
+        FlashSaleProduct.objects.bulk_create([FlashSaleProduct(
+            flash_sale=self.flash_sale, product=self.other, sale_price=Decimal('40.00'), quantity_limit=5
+        )])
+
+        with self.settings(CACHE_IS_SHARED=True):
+            self.assertIsNone(PromotionIndex.flash_sale_info(self.other.id)) # Waits for the version bump
+        with self.settings(CACHE_IS_SHARED=False, PROMOTION_INDEX_LOCAL_MAX_AGE=0):
+            self.assertEqual(PromotionIndex.flash_sale_info(self.other.id)['sale_price'], Decimal('40.00'))
+
+    def test_product_detail_uses_index(self):
+        """Test product detail reports the live flash sale"""
+        response = Client().get(f'/api/products/{self.product.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['flash_sale_info']['id'], self.flash_sale.id)
+
+
+class ProductSerializerQueryTest(TestCase):
+    """Test ProductSerializer(many=True) runs a fixed number of queries"""
+
+    def setUp(self):
+        now = timezone.now()
+        self.category = Category.objects.create(name="Page Category")
+        self.tags = [Tag.objects.create(name=f"Page Tag {i}") for i in range(3)]
+        sale = FlashSale.objects.create(
+            name="Page Sale", start_time=now - timedelta(minutes=1), end_time=now + timedelta(hours=1), is_active=True
+        )
+        for i in range(50):
+            product = Product.objects.create(
+                title=f"Page Item {i}", price=Decimal('100.00'), stock=10, category=self.category
+            )
+            product.tags.set(self.tags[:1 + i % 3])
+            ProductImage.objects.create(product=product, image_url=f'products/gallery/{i}.jpg')
+            if i % 5 == 0:
+                FlashSaleProduct.objects.create(flash_sale=sale, product=product, sale_price=Decimal('50.00'), quantity_limit=5)
+        PromotionIndex.rebuild()
+
+    def serialize(self, limit):
+        return ProductSerializer(Product.objects.order_by('id')[:limit], many=True).data
+
+    def test_fixed_query_count_for_page(self):
+        """Test a 50-item page costs the same queries as a 5-item page"""
+        # products, category, images, tags, tag counts, tag thumbnails
+        with self.assertNumQueries(6):
+            page = self.serialize(50)
+        with self.assertNumQueries(6):
+            self.serialize(5)
+
+        self.assertEqual(len(page), 50)
+        self.assertEqual(page[0]['category'], 'Page Category')
+        self.assertEqual(page[0]['flash_sale_info']['sale_price'], Decimal('50.00'))
+        self.assertIsNone(page[1]['flash_sale_info'])
+        self.assertEqual(len(page[2]['tags']), 3)
+        self.assertEqual(page[2]['tags'][0]['product_count'], 50)
+        self.assertEqual(len(page[2]['tags'][0]['product_thumbnails']), 3)
+        self.assertEqual(len(page[0]['images']), 1)
+
+    def test_single_product_matches_page(self):
+        """Test the batched output equals per-object serialization"""
+        product = Product.objects.order_by('id')[2]
+        self.assertEqual(dict(ProductSerializer(product).data), dict(self.serialize(3)[2]))
+
+
+class FlashSaleRoundTest(TestCase):
+    """Test compiled round intervals (Asia/Bangkok)"""
+
+    def setUp(self):
+        self.tz = timezone.get_default_timezone()
+        self.product = Product.objects.create(title="Round Item", price=Decimal('100.00'), stock=10)
+        self.sale = FlashSale.objects.create(
+            name="Round Sale",
+            start_time=datetime(2026, 1, 1, 0, 0, tzinfo=self.tz),
+            end_time=datetime(2026, 1, 2, 23, 59, tzinfo=self.tz),
+            rounds=[{'start': '10:00', 'end': '12:00'}, {'start': '23:00', 'end': '01:00'}],
+            is_active=True
+        )
+        FlashSaleProduct.objects.create(flash_sale=self.sale, product=self.product, sale_price=Decimal('60.00'))
+
+    def test_rounds_compiled_in_shop_timezone(self):
+        """Test rounds become absolute Bangkok intervals clipped to the sale"""
+        intervals = list(self.sale.round_intervals.order_by('start_at').values_list('start_at', 'end_at'))
+        local = [(timezone.localtime(s, self.tz).strftime('%d %H:%M'), timezone.localtime(e, self.tz).strftime('%d %H:%M'))
+                 for s, e in intervals]
+        self.assertEqual(local, [
+            ('01 00:00', '01 01:01'), # Overnight round of Dec 31 carried into the sale
+            ('01 10:00', '01 12:01'),
+            ('01 23:00', '02 01:01'),
+            ('02 10:00', '02 12:01'),
+            ('02 23:00', '02 23:59'),
+        ])
+
+    def test_live_round_uses_local_time(self):
+        """Test 10:30 Bangkok (03:30 UTC) is inside the 10:00-12:00 round"""
+        inside = datetime(2026, 1, 1, 10, 30, tzinfo=self.tz)
+        self.assertTrue(FlashSaleService.in_round(self.sale, inside))
+        self.assertFalse(FlashSaleService.in_round(self.sale, datetime(2026, 1, 1, 3, 30, tzinfo=self.tz)))
+        self.assertEqual(PromotionIndex.flash_sale_info(self.product.id, now=inside)['sale_price'], Decimal('60.00'))
+        self.assertIsNone(PromotionIndex.flash_sale_info(self.product.id, now=datetime(2026, 1, 1, 13, 0, tzinfo=self.tz)))
+
+    def test_rounds_between_and_recompile(self):
+        """Test upcoming rounds are a range query and saving recompiles"""
+        start = datetime(2026, 1, 1, 9, 30, tzinfo=self.tz)
+        upcoming = FlashSaleService.rounds_between(start, start + timedelta(hours=1))
+        self.assertEqual([timezone.localtime(r.start_at, self.tz).hour for r in upcoming], [10])
+
+        self.sale.rounds = [{'start': '14:00', 'end': '15:00'}]
+        self.sale.save()
+        self.assertEqual(self.sale.round_intervals.count(), 2)
+        self.assertFalse(FlashSaleService.rounds_between(start, start + timedelta(hours=1)).exists())
+
+    def test_migration_backfills_existing_sales(self):
+        """Test sales created before the rounds table get their intervals on migrate"""
+        now = timezone.now()
+        upcoming = FlashSale.objects.create(
+            name="Upcoming Round Sale", start_time=now, end_time=now + timedelta(days=1),
+            rounds=[{'start': '10:00', 'end': '12:00'}]
+        )
+        FlashSaleRound.objects.all().delete()
+
+        backfill = import_module('myapp.migrations.0044_backfill_flash_sale_rounds').backfill_flash_sale_rounds
+        backfill(django_apps, None)
+
+        self.assertEqual(
+            list(upcoming.round_intervals.order_by('start_at').values_list('start_at', 'end_at')),
+            FlashSaleService.round_intervals(upcoming.rounds, upcoming.start_time, upcoming.end_time)
+        )
+        self.assertFalse(self.sale.round_intervals.exists()) # Already ended
+
+
+class PromotionSchedulerTest(TestCase):
+    """Test boundary-driven housekeeping (run_scheduler)"""
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.system = User.objects.create_user(username='system', email='system@test.com', password='x')
+        self.product = Product.objects.create(title="Scheduled Item", price=Decimal('100.00'), stock=10)
+        self.starting = FlashSale.objects.create(
+            name="Starting", is_active=False,
+            start_time=self.now - timedelta(seconds=1), end_time=self.now + timedelta(hours=1)
+        )
+        FlashSaleProduct.objects.create(flash_sale=self.starting, product=self.product, sale_price=Decimal('50.00'))
+        self.ended = FlashSale.objects.create(
+            name="Ended", is_active=True,
+            start_time=self.now - timedelta(hours=2), end_time=self.now - timedelta(seconds=1)
+        )
+        self.kept = FlashSale.objects.create(
+            name="Kept", is_active=True, auto_disable_on_end=False,
+            start_time=self.now - timedelta(hours=2), end_time=self.now - timedelta(seconds=1)
+        )
+        self.expired_tag = Tag.objects.create(name="Old Promo", expiration_date=timezone.localdate(self.now) - timedelta(days=1))
+        self.today_tag = Tag.objects.create(name="Today Promo", expiration_date=timezone.localdate(self.now))
+
+    def test_run_applies_due_changes_in_one_pass(self):
+        """Test sales flip, expired tags go and every change is logged in one insert"""
+        PromotionIndex.rebuild()
+        self.assertIsNone(PromotionIndex.flash_sale_info(self.product.id))
+
+        result = PromotionSchedulerService.run(now=self.now)
+
+        self.assertEqual(result['activated'], [(self.starting.id, "Starting")])
+        self.assertEqual(result['deactivated'], [(self.ended.id, "Ended")])
+        self.assertEqual(result['tags'], ["Old Promo"])
+        self.assertTrue(FlashSale.objects.get(id=self.starting.id).is_active)
+        self.assertFalse(FlashSale.objects.get(id=self.ended.id).is_active)
+        self.assertTrue(FlashSale.objects.get(id=self.kept.id).is_active) # auto_disable_on_end=False
+        self.assertTrue(Tag.objects.filter(id=self.today_tag.id).exists())
+        self.assertFalse(Tag.objects.filter(id=self.expired_tag.id).exists())
+        self.assertEqual(AdminLog.objects.filter(admin=self.system).count(), 3)
+        # update() bypasses post_save: the index must still see the activation
+        self.assertEqual(PromotionIndex.flash_sale_info(self.product.id)['sale_price'], Decimal('50.00'))
+
+        # Nothing left to do
+        result = PromotionSchedulerService.run(now=self.now)
+        self.assertEqual(result, {"activated": [], "deactivated": [], "tags": [], "reservations": 0})
+
+    def test_next_boundaries(self):
+        """Test the wheel wakes at the next start, just after the next end and at local midnight"""
+        PromotionSchedulerService.run(now=self.now)
+        later = FlashSale.objects.create(
+            name="Later", is_active=False,
+            start_time=self.now + timedelta(minutes=10), end_time=self.now + timedelta(hours=3)
+        )
+
+        boundaries = PromotionSchedulerService.next_boundaries(self.now)
+
+        self.assertEqual(boundaries['flash_sales'], later.start_time)
+        tomorrow = timezone.localdate(self.now) + timedelta(days=1)
+        midnight = timezone.localtime(boundaries['tags'])
+        self.assertEqual((midnight.date(), midnight.hour, midnight.minute), (tomorrow, 0, 0))
+
+        later.delete()
+        boundaries = PromotionSchedulerService.next_boundaries(self.now)
+        self.assertEqual(boundaries['flash_sales'], self.starting.end_time + timedelta(microseconds=1))
+
+    def _run_loop_until_sneaky_sale_starts(self):
+        """Run the daemon; a sale is inserted behind its back (no signal, no version bump) on the first tick."""
+        real_sleep = time.sleep
+        ticks = []
+
+        def tick(seconds):
+            ticks.append(seconds)
+            if len(ticks) == 1:
+                FlashSale.objects.bulk_create([FlashSale(
+                    name="Sneaky", is_active=False,
+                    start_time=timezone.now() + timedelta(milliseconds=200), end_time=timezone.now() + timedelta(hours=1)
+                )])
+            elif FlashSale.objects.get(name="Sneaky").is_active or len(ticks) > 20:
+                raise KeyboardInterrupt
+            real_sleep(min(seconds, 0.05))
+
+        # The daemon drops stale connections each tick; here that would be the test's own connection
+        with patch.object(time, 'sleep', side_effect=tick), \
+                patch('myapp.management.commands.run_scheduler.close_old_connections'):
+            call_command('run_scheduler', '--jobs', 'flash_sales', '--poll', '0.05', stdout=StringIO())
+        return FlashSale.objects.get(name="Sneaky").is_active
+
+    def test_daemon_reads_boundaries_from_db_without_shared_cache(self):
+        """Test a per-process cache makes the daemon poll the next sale boundary instead of the version key"""
+        with self.settings(CACHE_IS_SHARED=False):
+            self.assertTrue(self._run_loop_until_sneaky_sale_starts())
+        FlashSale.objects.filter(name="Sneaky").delete()
+        with self.settings(CACHE_IS_SHARED=True):
+            self.assertFalse(self._run_loop_until_sneaky_sale_starts()) # Waits for a version bump
+
+    def test_run_scheduler_once(self):
+        """Test the daemon command applies what is due and exits with --once"""
+        out = StringIO()
+        call_command('run_scheduler', '--once', stdout=out)
+        self.assertIn('Activated 1 Flash Sale(s)', out.getvalue())
+        self.assertIn('Removed 1 expired tag(s)', out.getvalue())
+
+
+class FlashSaleStreamTest(TestCase):
+    """Test the SSE fan-out of live Flash Sale counters"""
+
+    def setUp(self):
+        now = timezone.now()
+        self.sale = FlashSale.objects.create(
+            name="Stream Sale", is_active=True,
+            start_time=now - timedelta(hours=1), end_time=now + timedelta(hours=1)
+        )
+        p1 = Product.objects.create(title="Stream A", price=Decimal('100.00'), stock=50)
+        p2 = Product.objects.create(title="Stream B", price=Decimal('100.00'), stock=50)
+        self.fsp1 = FlashSaleProduct.objects.create(flash_sale=self.sale, product=p1, sale_price=Decimal('50.00'), quantity_limit=20)
+        self.fsp2 = FlashSaleProduct.objects.create(flash_sale=self.sale, product=p2, sale_price=Decimal('50.00'), quantity_limit=20)
+        # Never start the real fan-out thread: it would outlive the test and close its DB connection
+        run = patch.object(FlashSaleStream, '_run')
+        run.start()
+        self.addCleanup(run.stop)
+        # Streaming responses fire request_finished when consumed or closed (the test client
+        # re-connects close_old_connections on the way), which would close the test's DB connection
+        keep = patch.object(connection, 'close_if_unusable_or_obsolete')
+        keep.start()
+        self.addCleanup(keep.stop)
+        self._reset()
+        self.addCleanup(self._reset)
+
+    def _reset(self):
+        FlashSaleStream._subscribers = set()
+        FlashSaleStream._thread = None
+        FlashSaleStream._counts = None
+        FlashSaleStream._seq = 0
+        FlashSaleStream._version = None
+        FlashSaleStream._polled_at = 0.0
+
+    def _frame_items(self, frame):
+        data = [line[len('data: '):] for line in frame.splitlines() if line.startswith('data: ')][0]
+        return json.loads(data)['items']
+
+    def test_one_coalesced_delta_for_every_watcher(self):
+        """Test several writes become one frame with only the changed rows, fanned out to all queues"""
+        FlashSaleStream.poll(force=True)
+        watchers = [FlashSaleStream.subscribe() for _ in range(3)]
+
+        for _ in range(3):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.fsp1.sold_count += 1
+                self.fsp1.save() # Counter-only save (legacy engine path)
+
+        with self.assertNumQueries(1):
+            frame = FlashSaleStream.poll()
+        self.assertIn('event: counts', frame)
+        self.assertEqual(self._frame_items(frame), [
+            {"flash_sale_product_id": self.fsp1.id, "sold_count": 3, "reserved_stock": 0}
+        ])
+        for q in watchers:
+            self.assertEqual(q.get_nowait(), frame)
+
+        # Nothing moved: no query, no frame
+        with self.assertNumQueries(0):
+            self.assertIsNone(FlashSaleStream.poll())
+
+    def test_slow_watcher_resyncs_from_snapshot(self):
+        """Test a full queue is replaced by one snapshot frame"""
+        FlashSaleStream.poll(force=True)
+        with self.settings(FLASH_SALE_STREAM_BUFFER=1):
+            q = FlashSaleStream.subscribe()
+        for sold in (1, 2):
+            FlashSaleProduct.objects.filter(id=self.fsp2.id).update(sold_count=sold)
+            FlashSaleStream.touch()
+            FlashSaleStream.poll()
+
+        frame = q.get_nowait()
+        self.assertIn('event: snapshot', frame)
+        self.assertEqual({i['flash_sale_product_id']: i['sold_count'] for i in self._frame_items(frame)}, {
+            self.fsp1.id: 0, self.fsp2.id: 2
+        })
+
+    def test_stream_endpoint_starts_with_snapshot(self):
+        """Test the SSE endpoint sends retry + snapshot and unsubscribes on close"""
+        response = self.client.get('/api/flash-sales/stream/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = iter(response.streaming_content)
+        self.assertTrue(next(chunks).decode().startswith('retry: '))
+        snapshot = next(chunks).decode()
+        self.assertEqual(len(FlashSaleStream._subscribers), 1)
+        response.close()
+        self.assertTrue(FlashSale.objects.filter(id=self.sale.id).exists()) # Connection still usable
+
+        self.assertIn('event: snapshot', snapshot)
+        self.assertEqual(len(self._frame_items(snapshot)), 2)
+        self.assertEqual(FlashSaleStream._subscribers, set())
+
+    def test_stream_cap_returns_503(self):
+        """Test a process refuses watchers past FLASH_SALE_STREAM_MAX_CLIENTS until one disconnects"""
+        with self.settings(FLASH_SALE_STREAM_MAX_CLIENTS=1):
+            first = self.client.get('/api/flash-sales/stream/')
+            self.assertEqual(first.status_code, 200)
+            refused = self.client.get('/api/flash-sales/stream/')
+            self.assertEqual(refused.status_code, 503)
+            self.assertIn('Retry-After', refused)
+
+            # Dropped before a single frame was sent: the slot is still freed
+            first.close()
+            self.assertEqual(FlashSaleStream._subscribers, set())
+            self.assertEqual(self.client.get('/api/flash-sales/stream/').status_code, 200)
+
+
+class ActiveFlashSaleFeedTest(TestCase):
+    """Test the prebuilt /api/flash-sales/active/ payload"""
+
+    def setUp(self):
+        now = timezone.now()
+        self.sale = FlashSale.objects.create(
+            name="Feed Sale", is_active=True,
+            start_time=now - timedelta(hours=1), end_time=now + timedelta(hours=1)
+        )
+        FlashSale.objects.create(
+            name="Feed Upcoming", is_active=True,
+            start_time=now + timedelta(hours=2), end_time=now + timedelta(hours=3)
+        )
+        tag = Tag.objects.create(name="Feed Tag")
+        self.fsps = []
+        for i in range(3):
+            product = Product.objects.create(title=f"Feed {i}", price=Decimal('100.00'), stock=10 + i)
+            product.tags.add(tag)
+            self.fsps.append(FlashSaleProduct.objects.create(
+                flash_sale=self.sale, product=product, sale_price=Decimal('50.00'), quantity_limit=20, sold_count=i
+            ))
+
+    def _expected(self):
+        sales = FlashSale.objects.filter(end_time__gte=timezone.now(), is_active=True).order_by('-id')
+        return json.loads(JSONRenderer().render(FlashSaleSerializer(sales, many=True).data))
+
+    def test_payload_matches_serializer(self):
+        """Test the prebuilt bytes are the same JSON the serializer produces"""
+        response = self.client.get('/api/flash-sales/active/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.json(), self._expected())
+
+    def test_only_hot_counters_are_read_per_request(self):
+        """Test a warm payload costs one query and still shows current counts"""
+        self.client.get('/api/flash-sales/active/')
+        FlashSaleProduct.objects.filter(id=self.fsps[0].id).update(sold_count=7)
+        Product.objects.filter(id=self.fsps[1].product_id).update(stock=0)
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/flash-sales/active/')
+        items = {item['id']: item for item in response.json()[1]['products']}
+        self.assertEqual(items[self.fsps[0].id]['sold_count'], 7)
+        self.assertEqual(items[self.fsps[1].id]['stock'], 0)
+        self.assertEqual(response.json(), self._expected())
+
+    def test_render_fills_every_placeholder(self):
+        """Test render() merges counters into the cached bytes without leaking placeholder tokens"""
+        token = ActiveFlashSaleFeed.get()['token']
+        body = ActiveFlashSaleFeed.render()
+
+        self.assertNotIn(token, body.decode())
+        self.assertEqual(json.loads(body), self._expected())
+
+    def test_sale_edits_rebuild_the_payload(self):
+        """Test FlashSale and FlashSaleProduct writes invalidate the payload"""
+        self.client.get('/api/flash-sales/active/')
+        self.sale.name = "Renamed Sale"
+        self.sale.save()
+        self.fsps[2].sale_price = Decimal('45.00')
+        self.fsps[2].save()
+
+        response = self.client.get('/api/flash-sales/active/')
+        self.assertEqual(response.json()[1]['name'], "Renamed Sale")
+        self.assertEqual(response.json(), self._expected())
+
+
+class PromotionConflictTest(TestCase):
+    """Test the sweep-line conflict engine over PromotionSchedule"""
+
+    def setUp(self):
+        self.admin = User.objects.create_user(username='calendar_admin', email='cal@test.com', password='x', role='admin')
+        self.category = Category.objects.create(name="Calendar Cat")
+        self.product = Product.objects.create(title="Calendar Item", price=Decimal('100.00'), stock=10, category=self.category)
+        self.other = Product.objects.create(title="Other Item", price=Decimal('100.00'), stock=10)
+        self.t0 = timezone.now().replace(microsecond=0) + timedelta(days=1)
+
+    def _entry(self, promo_id, start_h, end_h, scope, priority=0, promo_type='flash_sale'):
+        return {
+            'promo_type': promo_type, 'promo_id': promo_id, 'priority': priority, 'impact_scope': scope,
+            'start_time': self.t0 + timedelta(hours=start_h), 'end_time': self.t0 + timedelta(hours=end_h),
+        }
+
+    def _pairs(self, conflicts):
+        return sorted(tuple(sorted(p['promo_id'] for p in c['promotions'])) for c in conflicts)
+
+    def test_scopes_and_winners(self):
+        """Test global/category/product scopes, half-open windows and priority winners"""
+        entries = [
+            self._entry(1, 0, 4, {'type': 'product', 'ids': [self.product.id]}, priority=5),
+            self._entry(2, 2, 6, {'type': 'category', 'ids': [self.category.id]}),
+            self._entry(3, 4, 8, {'type': 'product', 'ids': [self.product.id]}), # Starts when 1 ends
+            self._entry(4, 1, 2, {'type': 'product', 'ids': [self.other.id]}),
+            self._entry(5, 7, 9, {'type': 'global'}, promo_type='coupon'),
+        ]
+        categories = {self.product.id: self.category.id, self.other.id: None}
+
+        conflicts = PromotionConflictService.find_conflicts(entries, categories)
+
+        self.assertEqual(self._pairs(conflicts), [(1, 2), (2, 3), (3, 5)])
+        first = next(c for c in conflicts if self._pairs([c]) == [(1, 2)])
+        self.assertEqual(first['winner']['promo_id'], 1)
+        self.assertEqual((first['overlap_start'], first['overlap_end']), (self.t0 + timedelta(hours=2), self.t0 + timedelta(hours=4)))
+        self.assertIsNone(next(c for c in conflicts if self._pairs([c]) == [(2, 3)])['winner'])
+
+    def test_matches_brute_force(self):
+        """Test the sweep finds exactly the overlapping pairs of a random calendar"""
+        import random
+        rng = random.Random(7)
+        categories = {pid: pid % 5 for pid in range(40)}
+        entries = []
+        for i in range(300):
+            start = rng.randrange(0, 2000)
+            kind = rng.choice(['global', 'category', 'product', 'product', 'product'])
+            ids = [] if kind == 'global' else rng.sample(range(5) if kind == 'category' else range(40), 2)
+            entries.append(self._entry(i, start, start + rng.randrange(1, 48), {'type': kind, 'ids': ids}))
+
+        def overlaps(a, b):
+            if not (a['start_time'] < b['end_time'] and b['start_time'] < a['end_time']):
+                return False
+            sa, sb = a['impact_scope'], b['impact_scope']
+            if 'global' in (sa['type'], sb['type']):
+                return True
+            cats = lambda s: set(s['ids']) if s['type'] == 'category' else set()
+            prods = lambda s: set(s['ids']) if s['type'] == 'product' else set()
+            prod_cats = lambda s: {categories[p] for p in prods(s)}
+            return bool(prods(sa) & prods(sb) or cats(sa) & (cats(sb) | prod_cats(sb)) or cats(sb) & prod_cats(sa))
+
+        expected = sorted(
+            (a['promo_id'], b['promo_id'])
+            for i, a in enumerate(entries) for b in entries[i + 1:] if overlaps(a, b)
+        )
+        self.assertEqual(self._pairs(PromotionConflictService.find_conflicts(entries, categories)), expected)
+
+    def test_calendar_follows_saves(self):
+        """Test flash sale and coupon saves keep their PromotionSchedule rows in sync"""
+        sale = FlashSale.objects.create(name="Cal Sale", start_time=self.t0, end_time=self.t0 + timedelta(hours=2), priority=3)
+        with self.captureOnCommitCallbacks(execute=True):
+            FlashSaleProduct.objects.create(flash_sale=sale, product=self.product, sale_price=Decimal('50.00'))
+        row = PromotionSchedule.objects.get(promo_type='flash_sale', promo_id=sale.id)
+        self.assertEqual((row.priority, row.impact_scope), (3, {'type': 'product', 'ids': [self.product.id]}))
+
+        coupon = Coupon.objects.create(
+            code='CALENDAR', discount_type='fixed', discount_value=Decimal('10.00'),
+            start_date=self.t0, end_date=self.t0 + timedelta(days=1)
+        )
+        self.assertTrue(PromotionSchedule.objects.filter(promo_type='coupon', promo_id=coupon.id).exists())
+        coupon.active = False
+        coupon.save()
+        self.assertFalse(PromotionSchedule.objects.filter(promo_type='coupon', promo_id=coupon.id).exists())
+
+        sale.delete()
+        self.assertFalse(PromotionSchedule.objects.filter(promo_type='flash_sale').exists())
+
+    def test_save_rejects_tied_flash_sales(self):
+        """Test the admin API refuses a second sale with the same product, time and priority"""
+        with self.captureOnCommitCallbacks(execute=True):
+            FlashSaleProduct.objects.create(
+                flash_sale=FlashSale.objects.create(name="First", start_time=self.t0, end_time=self.t0 + timedelta(hours=4)),
+                product=self.product, sale_price=Decimal('50.00')
+            )
+        self.client.force_login(self.admin)
+        payload = {
+            "name": "Second", "start_time": (self.t0 + timedelta(hours=1)).isoformat(),
+            "end_time": (self.t0 + timedelta(hours=2)).isoformat(),
+            "products": [{"product_id": self.product.id, "sale_price": 60, "quantity_limit": 5}]
+        }
+
+        response = self.client.post('/api/admin/flash-sales/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(FlashSale.objects.filter(name="Second").exists())
+
+        payload["products"] = [{"product_id": self.other.id, "sale_price": 60, "quantity_limit": 5}]
+        response = self.client.post('/api/admin/flash-sales/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+
+        response = self.client.get('/api/admin/promotions/conflicts/', {'start': self.t0.date().isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 0)
+
+    def test_tie_with_inactive_sale_is_a_warning(self):
+        """Test a draft that ties another sale is saved and the tie is returned as a warning"""
+        first = FlashSale.objects.create(name="First", start_time=self.t0, end_time=self.t0 + timedelta(hours=4))
+        with self.captureOnCommitCallbacks(execute=True):
+            FlashSaleProduct.objects.create(flash_sale=first, product=self.product, sale_price=Decimal('50.00'))
+        self.client.force_login(self.admin)
+        payload = {
+            "name": "Draft", "is_active": False, "start_time": (self.t0 + timedelta(hours=1)).isoformat(),
+            "end_time": (self.t0 + timedelta(hours=2)).isoformat(),
+            "products": [{"product_id": self.product.id, "sale_price": 60, "quantity_limit": 5}]
+        }
+
+        response = self.client.post('/api/admin/flash-sales/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        draft = FlashSale.objects.get(name="Draft")
+        self.assertEqual(
+            [sorted(p['promo_id'] for p in c['promotions']) for c in response.json()['conflicts']],
+            [sorted([first.id, draft.id])]
+        )
+
+        # Switching the draft on makes the tie a real one
+        payload["is_active"] = True
+        response = self.client.put(f'/api/admin/flash-sales/{draft.id}/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(FlashSale.objects.get(id=draft.id).is_active)
+
+    def test_bulk_product_save_syncs_once(self):
+        """Test an admin save with many products rebuilds the schedule row once, not per product"""
+        products = [
+            Product.objects.create(title=f"Bulk {i}", price=Decimal('100.00'), stock=10) for i in range(6)
+        ]
+        self.client.force_login(self.admin)
+        payload = {
+            "name": "Bulk", "start_time": self.t0.isoformat(), "end_time": (self.t0 + timedelta(hours=2)).isoformat(),
+            "products": [{"product_id": p.id, "sale_price": 60, "quantity_limit": 5} for p in products]
+        }
+
+        with patch.object(PromotionConflictService, 'sync_flash_sale', wraps=PromotionConflictService.sync_flash_sale) as sync:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/api/admin/flash-sales/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(sync.call_count, 2) # FlashSale save + once after the product rows
+
+        sale = FlashSale.objects.get(name="Bulk")
+        row = PromotionSchedule.objects.get(promo_type='flash_sale', promo_id=sale.id)
+        self.assertEqual(row.impact_scope['ids'], sorted(p.id for p in products))
+
+        # Removing product rows outside the view is synced once, on commit
+        with patch.object(PromotionConflictService, 'sync_flash_sale', wraps=PromotionConflictService.sync_flash_sale) as sync:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    for fsp in FlashSaleProduct.objects.filter(flash_sale=sale, product__in=products[:3]):
+                        fsp.delete()
+        self.assertEqual(sync.call_count, 1)
+        row.refresh_from_db()
+        self.assertEqual(row.impact_scope['ids'], sorted(p.id for p in products[3:]))
+
+
+class FlashSaleCampaignSerializerTest(TestCase):
+    """Test campaign lists load in a fixed number of queries"""
+
+    def setUp(self):
+        self.admin = User.objects.create_user(username='campaign_admin', email='camp@test.com', password='x', role='admin')
+        self.now = timezone.now()
+        self.tag = Tag.objects.create(name="Campaign Tag")
+        self._campaign(0)
+
+    def _campaign(self, n):
+        campaign = FlashSaleCampaign.objects.create(
+            name=f"Campaign {n}", campaign_start=self.now, campaign_end=self.now + timedelta(days=1)
+        )
+        for s in range(2):
+            sale = FlashSale.objects.create(
+                name=f"C{n} Sale {s}", campaign=campaign, priority=s,
+                start_time=self.now + timedelta(hours=s), end_time=self.now + timedelta(hours=s + 1)
+            )
+            for p in range(2):
+                product = Product.objects.create(title=f"C{n}S{s}P{p}", price=Decimal('100.00'), stock=5)
+                product.tags.add(self.tag)
+                FlashSaleProduct.objects.create(flash_sale=sale, product=product, sale_price=Decimal('50.00'))
+        return campaign
+
+    def _serialize(self, fields=None):
+        campaigns = FlashSaleCampaign.objects.order_by('id')
+        return FlashSaleCampaignSerializer(campaigns, many=True, context={'fields': fields}).data
+
+    def test_query_count_does_not_grow(self):
+        """Test campaigns, sales, products and tags are prefetched for the whole list"""
+        with self.assertNumQueries(7) as one:
+            self._serialize()
+        for n in range(1, 4):
+            self._campaign(n)
+        with self.assertNumQueries(len(one.captured_queries)):
+            data = self._serialize()
+
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data[0]['flash_sale_count'], 2)
+        self.assertEqual([s['name'] for s in data[0]['flash_sales']], ["C0 Sale 0", "C0 Sale 1"])
+        self.assertEqual(data[0]['flash_sales'][0]['campaign_name'], "Campaign 0")
+        tag = data[3]['flash_sales'][1]['products'][0]['product_tags'][0]
+        self.assertEqual(tag['product_count'], 16)
+
+    def test_summary_mode_skips_products(self):
+        """Test ?fields=summary returns sales without nested products in two queries"""
+        self._campaign(1)
+        with self.assertNumQueries(2):
+            data = self._serialize('summary')
+        self.assertNotIn('products', data[0]['flash_sales'][0])
+        self.assertEqual(data[1]['flash_sale_count'], 2)
+
+    def test_fields_list_via_api(self):
+        """Test ?fields=id,name,flash_sale_count limits the campaign fields"""
+        self.client.force_login(self.admin)
+        response = self.client.get('/api/admin/campaigns/', {'fields': 'id,name,flash_sale_count'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0], {
+            'id': FlashSaleCampaign.objects.get().id, 'name': "Campaign 0", 'flash_sale_count': 2
+        })
+
+        campaign_id = response.json()[0]['id']
+        detail = self.client.get(f'/api/admin/campaigns/{campaign_id}/').json()
+        self.assertEqual(len(detail['flash_sales'][0]['products']), 2)
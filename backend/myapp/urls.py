@@ -65,6 +65,8 @@ urlpatterns = [
     # --- Orders & Checkout (สั่งซื้อ) ---
     # ✅ แก้ไข 2: เพิ่ม api/ ให้ลิงก์ checkout (สำคัญมาก!)
     path('api/checkout/', views.checkout_api, name='checkout'), 
+    path('api/checkout/reserve/', views.reserve_checkout_api, name='checkout_reserve'), # ⏳ Two-phase: hold stock
+    path('api/checkout/confirm/', views.confirm_checkout_api, name='checkout_confirm'), # ✅ Two-phase: hold -> order
     path('api/upload_slip/<int:order_id>/', views.upload_slip_api, name='upload_slip'), 
     path('api/payment/promptpay_payload/', views.generate_promptpay_qr_api, name='promptpay_payload'), # ✅ Renamed to avoid alias conflict
 
@@ -83,6 +85,7 @@ urlpatterns = [
     path('api/admin/flash-sales/', views.admin_flash_sale_api, name='admin_flash_sale'),
     path('api/admin/flash-sales/<int:fs_id>/', views.admin_flash_sale_api, name='admin_flash_sale_detail'),
     path('api/flash-sales/active/', views.get_active_flash_sales_api, name='active_flash_sales'),
+    path('api/flash-sales/stream/', views.flash_sale_stream_api, name='flash_sale_stream'),
     
     # ✅ NEW: Flash Sale Campaigns
     path('api/admin/campaigns/', views.admin_campaign_api, name='admin_campaign'),
@@ -93,7 +96,10 @@ urlpatterns = [
     path('api/admin/coupons/', views.admin_coupon_api, name='admin_coupon'),
     path('api/admin/coupons/<int:coupon_id>/', views.admin_coupon_api, name='admin_coupon_detail'),
     path('api/admin/coupons/simulate/', admin_coupon_simulate_api, name='admin_coupon_simulate'), # ✅ Financial Simulation Endpoint
+    path('api/admin/coupons/code-filter/', views.coupon_code_filter_stats_api, name='coupon_code_filter_stats'),
+    path('api/admin/promotions/conflicts/', views.promotion_conflicts_api, name='promotion_conflicts'),
     path('api/coupons/validate/', views.validate_coupon_api, name='validate_coupon'),
+    path('api/coupons/best/', views.best_coupon_api, name='best_coupon'), # 🏆 Auto-apply best coupon for a cart
     path('api/coupons-public/', views.get_public_coupons, name='public_coupons'),
     
     # --- Wishlist ( ¡ô) ---
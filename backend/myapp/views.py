@@ -5,7 +5,7 @@ from rest_framework import status  # ✅ ใช้ตัวนี้จัดก
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.views import APIView
 from django.db.models import Sum, Q, Count, F
-from django.db import transaction  # ✅ สำหรับระบบ Checkout
+from django.db import transaction, IntegrityError  # ✅ สำหรับระบบ Checkout
 from django.contrib.auth import get_user_model, authenticate
 from rest_framework.authtoken.models import Token
 # ✅ รวม Model ทุกตัวไว้ในบรรทัดเดียว (ป้องกัน Error)
@@ -13,13 +13,16 @@ from .models import Product, Order, OrderItem, AdminLog, ProductImage, Review, S
 from .serializers import CouponSerializer, FlashSaleSerializer, FlashSaleProductSerializer, FlashSaleCampaignSerializer, NotificationSerializer 
 from .validators import validate_order_data
 from .exceptions import InlineValidationError 
-from .services import CouponService # ✅ Import Service 
+from .services import CouponService, InventoryService, FlashSaleAdmissionService, ReservationService, IdempotencyService, OrderEventService, PromoUsageService, PriceCalculator, CouponStatsService, PublicCouponCatalog, CouponCodeFilter, PromotionIndex, FlashSaleStream, ActiveFlashSaleFeed, PromotionConflictService # ✅ Import Service 
 import logging
 import traceback
 from django.utils import timezone
+from django.utils.http import parse_etags
+from django.utils.dateparse import parse_date, parse_datetime
 
 import csv
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
 from datetime import timedelta, datetime
 import calendar
 
@@ -680,25 +683,8 @@ def product_detail_api(request, product_id):
 
         }
 
-        # ✅ Check Flash Sale Logic (Manual Injection)
-        now = timezone.now()
-        active_fs = FlashSaleProduct.objects.filter(
-            product=product,
-            flash_sale__start_time__lte=now,
-            flash_sale__end_time__gte=now,
-            flash_sale__is_active=True
-        ).first()
-
-        if active_fs and active_fs.sold_count < active_fs.quantity_limit:
-            data["flash_sale_info"] = {
-                'id': active_fs.flash_sale.id,
-                'sale_price': active_fs.sale_price,
-                'end_time': active_fs.flash_sale.end_time,
-                'quantity_limit': active_fs.quantity_limit,
-                'sold_count': active_fs.sold_count
-            }
-        else:
-            data["flash_sale_info"] = None
+        # ✅ Check Flash Sale Logic (in-process promotion index, no query)
+        data["flash_sale_info"] = PromotionIndex.flash_sale_info(product.id)
 
         return Response(data)
     except Product.DoesNotExist:
@@ -1024,6 +1010,85 @@ def change_password_api(request):
 # 📦 Order & Stats
 # ==========================================
 
+def _place_order(request, cart_items, order_items_to_create, total_price, has_flash_sale_item):
+    """
+    Coupon, profile persistence, Order + OrderItem rows for lines whose stock
+    is already taken (create_order / confirm_reservation_api).
+    Must run inside transaction.atomic(); raises ValueError to abort.
+    """
+    customer_data = request.data.get('customer', {})
+    coupon_code = request.data.get('couponCode') # ✅ Coupon Code
+
+    # ✅ 3. Apply Coupon
+    item_subtotal_val = total_price # Rename for clarity
+    shipping_cost = PriceCalculator.SHIPPING_COST # Default Shipping Cost (Flat Rate)
+
+    # Recalculate Total (Subtotal + Shipping)
+    grand_total = item_subtotal_val + shipping_cost
+
+    discount_amount = 0
+    coupon = None
+
+    if coupon_code:
+        # ✅ Same coupon rules as the cart preview (PriceCalculator.price_cart)
+        coupon, discount_amount = PriceCalculator.apply_coupon(
+            request.user, coupon_code, item_subtotal_val, has_flash_sale_item, cart_items, shipping_cost, lock=True
+        )
+
+        # Update Usage
+        coupon.used_count = F('used_count') + 1
+        coupon.save()
+
+    grand_total -= discount_amount
+
+    # ✅ 4. Create Order
+    order = Order.objects.create(
+
+        user=request.user,
+        customer_name=customer_data.get('name', request.user.first_name or request.user.username),
+
+        customer_tel=customer_data.get('phone', customer_data.get('tel', request.user.phone)), 
+        customer_email=customer_data.get('email', request.user.email),
+        shipping_address=customer_data.get('address', request.user.address), 
+        shipping_province=customer_data.get('province'), 
+        payment_method=request.data.get('paymentMethod', 'Transfer'),
+
+        item_subtotal=item_subtotal_val,
+        shipping_cost=shipping_cost,
+        total_price=grand_total,
+
+        discount_amount=discount_amount, # ✅ Save Discount
+        coupon=coupon, # ✅ Save Coupon
+        status='Pending'
+    )
+
+    # ✅ 5. Create Order Items (single INSERT)
+    OrderItem.objects.bulk_create([
+        OrderItem(
+            order=order,
+            product=item_data['product'],
+            quantity=item_data['quantity'],
+            base_price_at_time=item_data['product'].price,
+            price_at_purchase=item_data['price'],
+            promotion_source='flash_sale' if item_data['flash_sale_product'] else 'normal',
+            promotion_ref_id=item_data['flash_sale_product'].id if item_data['flash_sale_product'] else None
+        )
+        for item_data in order_items_to_create
+    ])
+
+    # 📊 6. Usage counters move with the order, so the next checkout's limit check sees it
+    PromoUsageService.record_order(request.user, order, order_items_to_create, coupon)
+
+    # 📮 7. Profile auto-save, role upgrade, usage logs, stock history and
+    # notification are applied by run_order_events (outbox, one INSERT here)
+    OrderEventService.enqueue_order_placed(order, request.user, customer_data, order_items_to_create, coupon)
+
+    return order
+
+def _replay_checkout(record):
+    """Stored response of an already-committed checkout (Idempotency-Key retry)"""
+    return Response(record.response_body, status=record.response_status, headers={'Idempotent-Replayed': 'true'})
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def create_order(request):
@@ -1051,198 +1116,131 @@ def create_order(request):
     if not cart_items: 
         return Response({"error": "ไม่พบรายการสินค้า (Empty cart)"}, status=400)
 
+    # 🧹 Unknown coupon code -> reject before any stock lock or query
+    if coupon_code and not CouponCodeFilter.might_exist(coupon_code):
+        return Response({"error": "รหัสคูปองไม่ถูกต้อง"}, status=400)
+
+    # 🔁 Idempotency-Key: a retried checkout replays the stored response (no stock locks)
+    idem_key = request.headers.get('Idempotency-Key')
+    idem_hash = None
+    if idem_key:
+        if len(idem_key) > IdempotencyService.MAX_KEY_LENGTH:
+            return Response({"error": "Idempotency-Key ยาวเกินไป"}, status=400)
+        idem_hash = IdempotencyService.request_hash(request.data)
+        try:
+            stored = IdempotencyService.lookup(request.user, idem_key, idem_hash)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=422)
+        if stored:
+            return _replay_checkout(stored)
+
+    # ⚡ Flash Sale Admission: take quota tokens before any row lock (sold out = reject without DB)
+    fs_tokens = {}
+    if FlashSaleAdmissionService.is_enabled():
+        try:
+            fs_tokens = FlashSaleAdmissionService.acquire(cart_items)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+
     try:
         with transaction.atomic():
-            total_price = 0
-            order_items_to_create = []
-            has_flash_sale_item = False
             now = timezone.now()
+            # Claimed first: a concurrent retry with the same key waits here, not on stock rows
+            idem_record = IdempotencyService.claim(request.user, idem_key, idem_hash, now) if idem_key else None
+            transaction.on_commit(lambda: FlashSaleAdmissionService.finish(fs_tokens, committed=True))
             
-            # ✅ 2. Loop Process Items
-            for item in cart_items:
-                try:
-                    p = Product.objects.select_for_update().get(id=item['id'])
-                except Product.DoesNotExist:
-                    raise ValueError(f"สินค้า ID {item['id']} ไม่พบในระบบ")
-
-                qty = int(item['quantity'])
-
-                # ⚡ Check Active Flash Sale
-                active_fs = FlashSaleProduct.objects.filter(
-                    product=p,
-                    flash_sale__start_time__lte=now,
-                    flash_sale__end_time__gte=now,
-                    flash_sale__is_active=True
-                ).select_for_update().first()
-                
-                # Default Price
-                final_price = p.price
-                
-                # Logic: If Flash Sale available AND stock available logic
-                if active_fs:
-                    # Check flash sale limits
-                    if active_fs.sold_count < active_fs.quantity_limit:
-                         # Use Flash Sale Price
-                         final_price = active_fs.sale_price
-                         has_flash_sale_item = True
-                         
-                         # Check if enough flash sale quota for this order?
-                         # For simplicity: If qty > remaining flash sale stock, we might split or reject.
-                         # User requirement: "Prevent oversell".
-                         # Let's reject if FS stock not enough for full quantity or mixed.
-                         fs_remaining = active_fs.quantity_limit - active_fs.sold_count
-                         if qty > fs_remaining:
-                             raise ValueError(f"สินค้า '{p.title}' เหลือสิทธิ์ Flash Sale เพียง {fs_remaining} ชิ้น")
-                             
-                         active_fs.sold_count += qty
-                         active_fs.save()
-                    
-                # Check Main Product Stock
-                if p.stock < qty: 
-                    raise ValueError(f"สินค้า '{p.title}' สินค้าหมดหรือมีไม่พอ (เหลือ {p.stock})")
-                
-                # Deduct Main Stock
-                p.stock -= qty
-                p.save()
-                
-                item_total = final_price * qty
-                total_price += item_total
-                
-                order_items_to_create.append({
-                    "product": p,
-                    "quantity": qty,
-                    "price": final_price
-                })
+            # ✅ 2. Lock & Deduct Stock (engine: settings.CHECKOUT_STOCK_ENGINE)
+            order_items_to_create, total_price, has_flash_sale_item = InventoryService.deduct_for_order(cart_items, now)
 
-            # ✅ 3. Apply Coupon
-            item_subtotal_val = total_price # Rename for clarity
-            shipping_cost = 50 # Default Shipping Cost (Flat Rate)
-            
-            # Recalculate Total (Subtotal + Shipping)
-            grand_total = item_subtotal_val + shipping_cost
-            
-            discount_amount = 0
-            coupon = None
-            
-            if coupon_code:
-                # 🔒 Lock Coupon Row to prevent Race Condition
-                try:
-                     coupon_locked = Coupon.objects.select_for_update().get(code=coupon_code)
-                except Coupon.DoesNotExist:
-                     raise ValueError("รหัสคูปองไม่ถูกต้อง")
-
-                # ✅ Refactored Logic using CouponService
-                # Pass shipping_cost to validate if needed (future)
-                is_valid, msg, coupon = CouponService.validate_coupon(
-                    user=request.user, 
-                    coupon_code=coupon_code, 
-                    cart_total=item_subtotal_val, # Validate against Item Subtotal
-                    cart_items=cart_items
-                )
-                
-                if not is_valid:
-                    raise ValueError(msg)
+            order = _place_order(request, cart_items, order_items_to_create, total_price, has_flash_sale_item)
 
-                # ⚡ Flash Sale Stackability Check
-                if has_flash_sale_item and not coupon.is_stackable_with_flash_sale:
-                     raise ValueError("คูปองนี้ไม่สามารถใช้ร่วมกับสินค้า Flash Sale ได้")
+            response_body = {"message": "สั่งซื้อสำเร็จ", "order_id": order.id, "total": total_price}
+            if idem_record:
+                IdempotencyService.store(idem_record, order, 201, response_body)
 
-                # ✅ Calculate Discount (Pass Shipping Cost)
-                discount_amount = CouponService.calculate_discount(coupon, item_subtotal_val, shipping_cost)
-                
-                # Prevent negative total
-                # Max discount cannot exceed (Subtotal + Shipping) effectively
-                # But logic says: Free Shipping = 50. 
-                # Percent/Fixed = based on Subtotal usually.
-                # Let's ensure discount doesn't exceed Grand Total
-                discount_amount = min(discount_amount, grand_total)
-                
-                # Update Usage
-                coupon.used_count = F('used_count') + 1
-                coupon.save()
-                
-            grand_total -= discount_amount
-
-            # ✅ 4. Auto-Save User Profile (Persistence) - INSERTED BEFORE CREATE
-            user = request.user
-            has_update = False
-            
-            if customer_data.get('name'):
-                 parts = customer_data.get('name').strip().split(' ', 1)
-                 if not user.first_name and len(parts) > 0: 
-                     user.first_name = parts[0]
-                     has_update = True
-                 if not user.last_name and len(parts) > 1:
-                     user.last_name = parts[1]
-                     has_update = True
-
-            if customer_data.get('phone'):
-                user.phone = customer_data.get('phone')
-                has_update = True
-
-            if customer_data.get('address'):
-                user.address = customer_data.get('address')
-                has_update = True
-                
-            if customer_data.get('province'):
-                user.province = customer_data.get('province')
-                has_update = True
-                
-            if customer_data.get('zip_code'):
-                user.zipcode = customer_data.get('zip_code')
-                has_update = True
+        return Response(response_body, status=201)
+    except IntegrityError as e:
+        FlashSaleAdmissionService.finish(fs_tokens, committed=False)
+        if idem_key:
+            try:
+                stored = IdempotencyService.lookup(request.user, idem_key, idem_hash)
+            except ValueError as lookup_error:
+                return Response({"error": str(lookup_error)}, status=422)
+            if stored:
+                return _replay_checkout(stored)
+            return Response({"error": "คำสั่งซื้อนี้กำลังดำเนินการอยู่ กรุณารอสักครู่"}, status=409)
+        return Response({"error": str(e)}, status=400)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        FlashSaleAdmissionService.finish(fs_tokens, committed=False)
+        return Response({"error": str(e)}, status=400)
 
-            if customer_data.get('latitude'):
-                user.latitude = customer_data.get('latitude')
-                has_update = True
-                
-            if customer_data.get('longitude'):
-                user.longitude = customer_data.get('longitude')
-                has_update = True
-                
-            if has_update:
-                user.save()
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def reserve_checkout_api(request):
+    """
+    ⏳ Phase 1: hold stock + Flash Sale quota for the cart (STOCK_RESERVATION_MINUTES)
+    Payment/address can be collected afterwards without holding any row lock.
+    """
+    cart_items = request.data.get('items') or request.data.get('cart_items', [])
+    if not cart_items:
+        return Response({"error": "ไม่พบรายการสินค้า (Empty cart)"}, status=400)
 
-            # ✅ 5. Create Order
-            order = Order.objects.create(
+    fs_tokens = {}
+    if FlashSaleAdmissionService.is_enabled():
+        try:
+            fs_tokens = FlashSaleAdmissionService.acquire(cart_items)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
 
-                user=request.user,
-                customer_name=customer_data.get('name', request.user.first_name or request.user.username),
+    try:
+        with transaction.atomic():
+            transaction.on_commit(lambda: FlashSaleAdmissionService.finish(fs_tokens, committed=True))
+            reservations, total_price, expires_at = ReservationService.reserve(request.user, cart_items)
 
-                customer_tel=customer_data.get('phone', customer_data.get('tel', request.user.phone)), 
-                customer_email=customer_data.get('email', request.user.email),
-                shipping_address=customer_data.get('address', request.user.address), 
-                shipping_province=customer_data.get('province'), 
-                # Auto-Save all missing profile info
-                payment_method=request.data.get('paymentMethod', 'Transfer'),
-                
-                item_subtotal=item_subtotal_val,
-                shipping_cost=shipping_cost,
-                total_price=grand_total,
-                
-                discount_amount=discount_amount, # ✅ Save Discount
-                coupon=coupon, # ✅ Save Coupon
-                status='Pending'
-            )
-            
-            # ✅ 5. Create Order Items
-            for item_data in order_items_to_create:
-                OrderItem.objects.create(
-                    order=order, 
-                    product=item_data['product'], 
-                    quantity=item_data['quantity'], 
-                    price_at_purchase=item_data['price'] 
-                )
+        return Response({
+            "message": "จองสินค้าสำเร็จ",
+            "reservation_ids": [r.id for r in reservations],
+            "expires_at": expires_at,
+            "total": total_price
+        }, status=201)
+    except Exception as e:
+        FlashSaleAdmissionService.finish(fs_tokens, committed=False)
+        return Response({"error": str(e)}, status=400)
 
-            # ✅ 6. Update User Role (New User -> Customer)
-            if request.user.role == 'new_user':
-                request.user.role = 'customer'
-                request.user.save()
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def confirm_checkout_api(request):
+    """
+    ✅ Phase 2: turn reservations into an Order (no inventory row locks)
+    Body: reservation_ids, customer, couponCode, paymentMethod
+    """
+    reservation_ids = request.data.get('reservation_ids', [])
+    customer_data = request.data.get('customer', {})
+
+    validation_payload = {
+        "items": reservation_ids,
+        "name": customer_data.get('name'),
+        "tel": customer_data.get('phone') or customer_data.get('tel'),
+        "address": customer_data.get('address'),
+        "province": customer_data.get('province')
+    }
+    try:
+        validate_order_data(validation_payload)
+    except InlineValidationError as e:
+        return Response(e.detail, status=422)
+
+    try:
+        with transaction.atomic():
+            order_items_to_create, total_price, has_flash_sale_item = ReservationService.confirm(request.user, reservation_ids)
+            # Coupon rules read the cart in the same shape create_order receives it
+            cart_items = [{"id": line['product'].id, "quantity": line['quantity']} for line in order_items_to_create]
+
+            order = _place_order(request, cart_items, order_items_to_create, total_price, has_flash_sale_item)
 
         return Response({"message": "สั่งซื้อสำเร็จ", "order_id": order.id, "total": total_price}, status=201)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
         return Response({"error": str(e)}, status=400)
 
 @api_view(['GET'])
@@ -1826,7 +1824,13 @@ def bulk_update_orders_api(request):
     status = request.data.get('status')
     
     if order_ids and status:
-        Order.objects.filter(id__in=order_ids).update(status=status)
+        with transaction.atomic():
+            orders = Order.objects.filter(id__in=order_ids)
+            coupon_ids = set(orders.exclude(coupon=None).values_list('coupon_id', flat=True))
+            orders.update(status=status)
+            # ✅ .update() skips signals: recompute the coupon rollup of the touched coupons
+            if coupon_ids:
+                CouponStatsService.rebuild(coupon_ids)
         return Response({"message": "Updated"})
     return Response(status=400)
 
@@ -2269,10 +2273,42 @@ def validate_coupon_api(request):
             total_amount = float(request.data.get('total_amount', 0))
         except (ValueError, TypeError):
             total_amount = 0.0
-        # We might need cart items for product-specific validation (future)
         cart_items = request.data.get('items', []) 
 
-        # 1. Validate via Service
+        # 🧹 Unknown code (typo / guessing) -> reject before pricing the cart or any query
+        if not CouponCodeFilter.might_exist(code):
+            return Response({"valid": False, "error": "ไม่พบรหัสคูปองนี้"}, status=200)
+
+        # ✅ Cart with product ids -> price server-side in one pass (same rules as checkout)
+        if cart_items and all(isinstance(i, dict) and i.get('id') for i in cart_items):
+            try:
+                breakdown = PriceCalculator.price_cart(request.user, cart_items, code)
+            except ValueError as e:
+                return Response({"valid": False, "error": str(e)}, status=200)
+            if not breakdown['coupon']:
+                return Response({"valid": False, "error": breakdown['coupon_error']}, status=200)
+
+            coupon = breakdown['coupon']
+            return Response(dict(
+                _coupon_preview_payload(coupon, breakdown['discount_amount']),
+                subtotal=breakdown['subtotal'],
+                shipping_cost=breakdown['shipping_cost'],
+                total=breakdown['total'],
+                lines=[
+                    {
+                        "product_id": line['product'].id,
+                        "quantity": line['quantity'],
+                        "base_price": line['base_price'],
+                        "unit_price": line['price'],
+                        "source_type": line['source_type'],
+                        "flash_sale_product_id": line['flash_sale_product'].id if line['flash_sale_product'] else None,
+                        "line_total": line['line_total']
+                    }
+                    for line in breakdown['lines']
+                ]
+            ))
+
+        # 1. Validate via Service (client-side total only)
         is_valid, message, coupon = CouponService.validate_coupon(
             user=request.user, 
             coupon_code=code, 
@@ -2282,37 +2318,69 @@ def validate_coupon_api(request):
         
         if not is_valid:
             return Response({"valid": False, "error": message}, status=200)
-        
-        # 2. Check Stackability (Backend Gatekeeper)
-        # If items contain flash sale and coupon is NOT stackable -> Reject?
-        # Or frontend handles it? Let's safeguard here.
-        # Note: frontend sends total_amount, but maybe not flags.
-        # But checking stackability requires knowing if cart has flash sale items.
-        # Frontend DOES send 'items', but usually without 'is_flash_sale' flag unless we trust frontend.
-        # For now, rely on CouponService calculation or just return valid and let create_order enforce strict rules.
-        # Better: If we want to support Stackable in UI, we should return the flag.
             
-        # 3. Calculate Discount via Service (Ensures Max Cap logic)
-        shipping_cost = 50 # Consistent with create_order
-        discount = CouponService.calculate_discount(coupon, total_amount, shipping_cost=shipping_cost)
+        # 2. Calculate Discount via Service (Ensures Max Cap logic)
+        discount = CouponService.calculate_discount(coupon, total_amount, shipping_cost=PriceCalculator.SHIPPING_COST)
         
-        return Response({
-            "valid": True,
-            "discount_amount": discount,
-            "code": coupon.code,
-            "coupon_id": coupon.id, # Added coupon_id
-            "type": coupon.discount_type,
-            "value": coupon.discount_value,
-            "min_spend": coupon.min_spend,
-            "max_discount_amount": coupon.max_discount_amount,
-            "end_date": coupon.end_date,
-            "is_stackable_with_flash_sale": coupon.is_stackable_with_flash_sale # ✅ Send Flag to UI
-        })
+        return Response(_coupon_preview_payload(coupon, discount))
     except Exception as e:
         print("🔥 CRITICAL ERROR IN VALIDATE COUPON API:")
         print(traceback.format_exc())
         return Response({"error": f"Internal Server Error: {str(e)}"}, status=500)
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def best_coupon_api(request):
+    """
+    🏆 Best coupon for a cart in one call (auto-apply + wallet coupons)
+    Body: items [{id, quantity}]
+    """
+    cart_items = request.data.get('items', [])
+    if not cart_items:
+        return Response({"error": "ไม่พบรายการสินค้า (Empty cart)"}, status=400)
+
+    try:
+        result = CouponService.best_coupons(request.user, cart_items)
+    except (ValueError, KeyError, TypeError) as e:
+        return Response({"error": str(e)}, status=400)
+
+    pricing = result['pricing']
+    best = result['best']
+    return Response({
+        "subtotal": pricing['subtotal'],
+        "shipping_cost": pricing['shipping_cost'],
+        "has_flash_sale_item": pricing['has_flash_sale_item'],
+        "best": dict(
+            _coupon_preview_payload(best['coupon'], best['discount_amount']),
+            total=pricing['subtotal'] + pricing['shipping_cost'] - best['discount_amount']
+        ) if best else None,
+        "candidates": [
+            {
+                "coupon_id": c['coupon'].id,
+                "code": c['coupon'].code,
+                "auto_apply": c['coupon'].auto_apply,
+                "valid": c['valid'],
+                "message": c['message'],
+                "discount_amount": c['discount_amount']
+            }
+            for c in result['candidates']
+        ]
+    })
+
+def _coupon_preview_payload(coupon, discount):
+    return {
+        "valid": True,
+        "discount_amount": discount,
+        "code": coupon.code,
+        "coupon_id": coupon.id, # Added coupon_id
+        "type": coupon.discount_type,
+        "value": coupon.discount_value,
+        "min_spend": coupon.min_spend,
+        "max_discount_amount": coupon.max_discount_amount,
+        "end_date": coupon.end_date,
+        "is_stackable_with_flash_sale": coupon.is_stackable_with_flash_sale # ✅ Send Flag to UI
+    }
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_public_coupons(request):
@@ -2320,36 +2388,18 @@ def get_public_coupons(request):
     Get all active coupons marked as 'public' for users to choose from.
     """
     try:
-        # Simplify: Get ALL active coupons first
-        # ✅ Filter out expired coupons (Expired = End Date < Now)
-        now = timezone.now()
-        coupons = Coupon.objects.filter(active=True, end_date__gte=now)
-        
-        data = []
-        for c in coupons:
-            # Basic validation only
-            if c.usage_limit > 0 and c.used_count >= c.usage_limit:
-                 continue
-            
-            try:
-                data.append({
-                    "id": c.id,
-                    "code": c.code,
-                    "discount_type": c.discount_type,
-                    "discount_value": c.discount_value,
-                    "min_spend": c.min_spend,
-                    "end_date": c.end_date,
-                    "start_date": c.start_date, # Added for frontend check
-                    "allowed_roles": c.allowed_roles, 
-                    "conditions": c.conditions, # ✅ FIXED: Include conditions (e.g. new_user: true)
-                    # "description": getattr(c, 'description', None) or ... # Safer
-                    "description": f"ส่วนลด {c.discount_value} {'%' if c.discount_type == 'percent' else 'บาท'}"
-                })
-            except Exception as e:
-                print(f"Error processing {c.code}: {e}")
-                continue
+        # ⚡ Precomputed payload (rebuilt only after a coupon/wallet write)
+        etag, data = PublicCouponCatalog.get()
 
-        return Response(data)
+        # ✅ Client already has this version -> 304 without a body
+        client_etags = [e.removeprefix('W/') for e in parse_etags(request.headers.get('If-None-Match', ''))]
+        if etag in client_etags:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(data)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         logger.error(f"Error fetching public coupons: {str(e)}")
         return Response([], status=200)
@@ -2358,22 +2408,83 @@ def get_public_coupons(request):
 @permission_classes([AllowAny])
 def get_active_flash_sales_api(request):
     try:
-        now = timezone.now()
-        active_flash_sales = FlashSale.objects.filter(
-            # start_time__lte=now, # ✅ Allow showing upcoming/recent Flash Sales
-            end_time__gte=now,
-            is_active=True
-        ).order_by('-id') # ✅ Show NEWEST created Flash Sale first (instead of soonest ending)
-        
-        # Log count
-        logger.info(f"Active Flash Sales Count: {active_flash_sales.count()}")
-        
-        serializer = FlashSaleSerializer(active_flash_sales, many=True)
-        return Response(serializer.data)
+        # ⚡ Prebuilt payload (upcoming + live sales, newest first); only
+        # sold_count / stock are read per request
+        return HttpResponse(ActiveFlashSaleFeed.render(), content_type='application/json')
     except Exception as e:
         logger.error(f"Error fetching active flash sales: {str(e)}\n{traceback.format_exc()}")
         return Response({"error": str(e)}, status=500)
 
+@require_GET
+def flash_sale_stream_api(request):
+    """
+    📡 Server-sent events: live sold_count / reserved_stock of running Flash Sales
+    A `snapshot` event with every live row, then `counts` events carrying only
+    the rows that changed (coalesced to FLASH_SALE_STREAM_MAX_FPS per process).
+    Plain Django view: DRF content negotiation would 406 on Accept: text/event-stream.
+    Every open stream holds a worker thread, so this needs an async worker
+    (gunicorn -k gevent, or ASGI) to serve more than FLASH_SALE_STREAM_MAX_CLIENTS
+    watchers per process; past the cap it answers 503.
+    """
+    body = FlashSaleStream.open()
+    if body is None:
+        response = JsonResponse({"error": "มีผู้ติดตาม Flash Sale สดเต็มแล้ว กรุณาลองใหม่ภายหลัง"}, status=503)
+        response['Retry-After'] = '30'
+        return response
+
+    response = StreamingHttpResponse(body, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # Don't let nginx buffer the frames
+    return response
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def coupon_code_filter_stats_api(request):
+    """
+    🧹 Coupon code prefilter counters (lookups rejected without a DB query)
+    """
+    if request.user.role not in ['admin', 'super_admin']:
+        return Response(status=403)
+    return Response(CouponCodeFilter.snapshot())
+
+def _priority_ties(promo_type, promo_id):
+    """Overlapping promotions with the same priority that do not block the save (returned as warnings)."""
+    return [c for c in PromotionConflictService.validate(promo_type, promo_id) if c['winner'] is None]
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def promotion_conflicts_api(request):
+    """
+    🗓️ Overlapping promotions on the calendar and which one wins by priority
+    Query: ?start=2026-01-01&end=2026-12-31&promo_type=flash_sale (all optional)
+    """
+    if request.user.role not in ['admin', 'super_admin']:
+        return Response(status=403)
+
+    bounds = {}
+    for key in ('start', 'end'):
+        raw = request.query_params.get(key)
+        if not raw:
+            continue
+        try:
+            value = parse_datetime(raw)
+            if value is None and parse_date(raw):
+                value = datetime.combine(parse_date(raw), datetime.min.time())
+        except ValueError:
+            value = None
+        if value is None:
+            return Response({"error": f"รูปแบบวันที่ไม่ถูกต้อง ({key})"}, status=400)
+        bounds[key] = timezone.make_aware(value) if timezone.is_naive(value) else value
+
+    conflicts = PromotionConflictService.detect(
+        bounds.get('start'), bounds.get('end'), request.query_params.get('promo_type') or None
+    )
+    return Response({
+        "count": len(conflicts),
+        "unresolved": sum(1 for c in conflicts if c['winner'] is None),
+        "conflicts": conflicts,
+    })
+
 # --- Admin Coupon Management ---
 @api_view(['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
 @permission_classes([IsAuthenticated])
@@ -2435,8 +2546,8 @@ def admin_coupon_api(request, coupon_id=None):
             if limit_per_user <= 0:
                  return Response({"error": "จำนวนสิทธิ์ต่อคน (Limit Per User) ต้องมากกว่า 0"}, status=400)
 
-            s.save()
-            return Response(s.data)
+            coupon = s.save()
+            return Response({**s.data, "conflicts": _priority_ties('coupon', coupon.id)})
         return Response(s.errors, status=400)
 
     elif request.method in ['PUT', 'PATCH']:
@@ -2481,8 +2592,8 @@ def admin_coupon_api(request, coupon_id=None):
                 if limit_per_user <= 0:
                      return Response({"error": "จำนวนสิทธิ์ต่อคน (Limit Per User) ต้องมากกว่า 0"}, status=400)
 
-                s.save()
-                return Response(s.data)
+                coupon = s.save()
+                return Response({**s.data, "conflicts": _priority_ties('coupon', coupon.id)})
             return Response(s.errors, status=400)
         except Coupon.DoesNotExist:
             return Response({"error": "Coupon not found"}, status=404)
@@ -2594,8 +2705,12 @@ def admin_flash_sale_api(request, fs_id=None):
                         quantity_limit=p_item.get('quantity_limit', p_item.get('limit', 10)),
                         limit_per_user=p_item.get('limit_per_user', 1)
                     )
+
+                # 🗓️ Same products + time + priority as another active sale -> no winner (ValueError -> 400)
+                PromotionConflictService.sync_flash_sale(fs.id) # Once for all products written above
+                conflicts = _priority_ties('flash_sale', fs.id)
                     
-            return Response({"message": "Saved successfully"})
+            return Response({"message": "Saved successfully", "conflicts": conflicts})
         except Exception as e:
             return Response({"error": str(e)}, status=400)
     
@@ -2665,8 +2780,12 @@ def admin_flash_sale_api(request, fs_id=None):
                         quantity_limit=p_item.get('quantity_limit', p_item.get('limit', 10)),
                         limit_per_user=p_item.get('limit_per_user', 1)
                     )
+
+                # 🗓️ Same products + time + priority as another active sale -> no winner (ValueError -> 400)
+                PromotionConflictService.sync_flash_sale(fs.id) # Once for all products written above
+                conflicts = _priority_ties('flash_sale', fs.id)
                     
-            return Response({"message": "Updated successfully"})
+            return Response({"message": "Updated successfully", "conflicts": conflicts})
         except Exception as e:
             return Response({"error": str(e)}, status=400)
             
@@ -2724,13 +2843,15 @@ def admin_campaign_api(request, campaign_id=None):
             # ดึง 1 Campaign เฉพาะ
             try:
                 campaign = FlashSaleCampaign.objects.get(id=campaign_id)
-                return Response(FlashSaleCampaignSerializer(campaign).data)
+                return Response(FlashSaleCampaignSerializer(campaign, context={'fields': request.query_params.get('fields')}).data)
             except FlashSaleCampaign.DoesNotExist:
                 return Response({"error": "Campaign not found"}, status=404)
         else:
             # ดึงทั้งหมด (เรียงจากวันที่ล่าสุดและ priority สูงสุดก่อน)
+            # ?fields=summary -> sales without products (timeline), ?fields=id,name,... -> only those fields
             campaigns = FlashSaleCampaign.objects.all().order_by('-campaign_start', '-priority')
-            return Response(FlashSaleCampaignSerializer(campaigns, many=True).data)
+            serializer = FlashSaleCampaignSerializer(campaigns, many=True, context={'fields': request.query_params.get('fields')})
+            return Response(serializer.data)
     
     # ==========================================
     # ➕ POST - สร้าง Campaign ใหม่
@@ -3508,30 +3629,13 @@ def collect_coupon_api(request, coupon_id):
              return Response({'message': 'Admin และ Seller ไม่สามารถเก็บคูปองได้ครับ (สำหรับลูกค้าเท่านั้น)'}, status=status.HTTP_403_FORBIDDEN)
 
         coupon = Coupon.objects.get(pk=coupon_id)
-        
-        # 1. เช็คว่าเคยเก็บไปแล้วหรือยัง (ตาม limit_per_user)
-        collected_count = UserCoupon.objects.filter(user=request.user, coupon=coupon).count()
-        if collected_count >= coupon.limit_per_user:
-             return Response({'message': 'คุณเก็บคูปองนี้ครบจำนวนสิทธิ์แล้ว'}, status=status.HTTP_400_BAD_REQUEST)
-            
-        # 2. เช็คว่าคูปองหมดอายุหรือยัง
-        now = timezone.now()
-        if not coupon.active or not (coupon.start_date <= now <= coupon.end_date):
-             return Response({'message': 'คูปองหมดอายุหรือยังไม่เปิดให้เก็บ'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # 3. เช็คสิทธิ์รวม (Total Supply)
-        # เช็คจำนวนคนที่เก็บไปแล้ว
-        total_collected = UserCoupon.objects.filter(coupon=coupon).count()
-        limit = max(coupon.total_supply, coupon.usage_limit)
-        if total_collected >= limit:
-             return Response({'message': 'คูปองหมดแล้ว!'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # 4. สร้าง UserCoupon
-        UserCoupon.objects.create(
-            user=request.user, 
-            coupon=coupon,
-            status='active'
-        )
+
+        # ✅ 1-4. Per-user limit (unique wallet row), expiry and total supply
+        # are enforced by CouponService.claim with one guarded UPDATE
+        try:
+            CouponService.claim(request.user, coupon)
+        except ValueError as e:
+            return Response({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         return Response({'message': 'เก็บคูปองสำเร็จ!'}, status=status.HTTP_200_OK)
 
@@ -74,6 +74,66 @@ DATABASES = {
     }
 }
 
+# ✅ Checkout Stock Engine
+# 'batched'  = lock all product/flash-sale rows in one ordered query + set-based updates (default)
+# 'row_lock' = legacy per-line SELECT ... FOR UPDATE
+# 'conditional' = no row locks, guarded UPDATE ... WHERE stock >= n (high-contention sales)
+CHECKOUT_STOCK_ENGINE = os.environ.get('CHECKOUT_STOCK_ENGINE', 'batched')
+
+# ✅ Cache (LocMem by default; set CACHE_BACKEND/CACHE_LOCATION e.g. Redis to share across workers)
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'shop-default'),
+    }
+}
+# Per-process caches (LocMem/Dummy) never see other workers' version bumps: in-process
+# prefilters and indexes then fall back to the database instead of trusting them
+CACHE_IS_SHARED = not CACHES['default']['BACKEND'].endswith(('.LocMemCache', '.DummyCache'))
+
+# ⚡ Flash Sale Admission (quota tokens in cache before the checkout transaction)
+FLASH_SALE_ADMISSION_ENABLED = os.environ.get('FLASH_SALE_ADMISSION_ENABLED', 'False') == 'True'
+FLASH_SALE_ADMISSION_RECONCILE_SECONDS = 5
+
+# ⏳ Two-phase checkout: how long /api/checkout/reserve/ holds stock before cleanup_reservations / run_scheduler returns it
+STOCK_RESERVATION_MINUTES = int(os.environ.get('STOCK_RESERVATION_MINUTES', '15'))
+RESERVATION_SWEEP_BATCH_SIZE = 500
+
+# 🔁 Checkout Idempotency-Key: how long a stored checkout response can be replayed
+CHECKOUT_IDEMPOTENCY_TTL_HOURS = int(os.environ.get('CHECKOUT_IDEMPOTENCY_TTL_HOURS', '24'))
+
+# 📮 Order outbox: events applied per transaction by `manage.py run_order_events`
+ORDER_EVENTS_BATCH_SIZE = 200
+
+# 📊 Raw PromoUsageLog retention (limits read PromoUsageCounter; see prune_promo_usage_logs)
+PROMO_USAGE_LOG_RETENTION_DAYS = int(os.environ.get('PROMO_USAGE_LOG_RETENTION_DAYS', '180'))
+
+# 🎟️ Public coupon list payload: rebuilt on every coupon/wallet write; this TTL is only a safety net
+# for per-process caches (LocMemCache) that do not see other processes' invalidations
+PUBLIC_COUPONS_CACHE_SECONDS = int(os.environ.get('PUBLIC_COUPONS_CACHE_SECONDS', '300'))
+
+# 🧹 Coupon code Bloom filter: rebuilt at least this often even without a version bump (e.g. an evicted version key)
+COUPON_CODE_FILTER_MAX_AGE = int(os.environ.get('COUPON_CODE_FILTER_MAX_AGE', '60'))
+
+# 🗂️ Flash Sale interval index: max seconds between rebuilds (bounds how stale displayed sold counts are)
+PROMOTION_INDEX_MAX_AGE = int(os.environ.get('PROMOTION_INDEX_MAX_AGE', '30'))
+# Same, with a per-process cache (CACHE_IS_SHARED=False): bounds how late other workers' sale writes show up
+PROMOTION_INDEX_LOCAL_MAX_AGE = float(os.environ.get('PROMOTION_INDEX_LOCAL_MAX_AGE', '2'))
+
+# 📡 Flash Sale SSE stream (/api/flash-sales/stream/): frames per second per process, watcher buffer, keep-alive
+FLASH_SALE_STREAM_MAX_FPS = float(os.environ.get('FLASH_SALE_STREAM_MAX_FPS', '2'))
+FLASH_SALE_STREAM_RESYNC_SECONDS = 5
+FLASH_SALE_STREAM_BUFFER = 32
+FLASH_SALE_STREAM_KEEPALIVE_SECONDS = 15
+FLASH_SALE_STREAM_RETRY_MS = 3000
+# Open streams per process. Each one parks its worker while connected: serve the stream from an async
+# worker (gunicorn -k gevent --worker-connections 2000, or ASGI). Under runserver / sync workers set it to a
+# handful; refused tabs (503) fall back to polling /api/flash-sales/active/
+FLASH_SALE_STREAM_MAX_CLIENTS = int(os.environ.get('FLASH_SALE_STREAM_MAX_CLIENTS', '1000'))
+
+# 🛍️ Prebuilt /api/flash-sales/active/ payload: max age (bounds how stale product titles/prices/tags in it can be)
+FLASH_SALE_FEED_CACHE_SECONDS = int(os.environ.get('FLASH_SALE_FEED_CACHE_SECONDS', '60'))
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     { 'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator', },
@@ -2,10 +2,12 @@ import React, { useState, useEffect } from 'react';
 import { Zap, ChevronRight, Flame } from 'lucide-react';
 import { Link } from 'react-router-dom';
 import { API_BASE_URL } from '../config';
+import { useFlashSaleCounts, withLiveCount } from '../utils/flashSaleStream';
 
 const FlashSaleSection = ({ flashSale }) => {
     const [status, setStatus] = useState('active'); // 'active' | 'upcoming' | 'ended'
     const [timeLeft, setTimeLeft] = useState({ hours: 0, minutes: 0, seconds: 0, days: 0 });
+    const liveCounts = useFlashSaleCounts(); // 📡 Live sold counts (SSE) instead of re-polling
 
     useEffect(() => {
         if (!flashSale || !flashSale.end_time) return;
@@ -60,7 +62,7 @@ const FlashSaleSection = ({ flashSale }) => {
     // ✅ Custom: Hide if expired on frontend
     if (new Date(flashSale.end_time) < new Date()) return null;
 
-    const products = flashSale.products || [];
+    const products = (flashSale.products || []).map(item => withLiveCount(item, item.id, liveCounts));
 
     return (
         <section className="bg-white py-4 mb-4 shadow-sm">
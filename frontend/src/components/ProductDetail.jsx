@@ -12,6 +12,7 @@ import { useWishlist } from '../contexts/WishlistContext';
 import Swal from 'sweetalert2';
 import { formatPrice, getImageUrl } from '../utils/formatUtils';
 import ProductBadge from './ProductBadge';
+import { useFlashSaleCounts } from '../utils/flashSaleStream';
 
 // 🎠 Swiper - สำหรับทำ Gallery รูปสินค้า
 import { Swiper, SwiperSlide } from 'swiper/react';
@@ -62,6 +63,7 @@ function ProductDetail() {
   const location = useLocation(); // ✅ Hook for State
   const appliedCoupon = location.state?.appliedCoupon; // 🎟️ คูปองที่เลือกมาจากหน้ารวม
   const [product, setProduct] = useState(null);
+  const liveCounts = useFlashSaleCounts(); // 📡 Live Flash Sale sold counts (SSE)
   const [loading, setLoading] = useState(true);
   const [quantity, setQuantity] = useState(1); 
   const [relatedProducts, setRelatedProducts] = useState([]);
@@ -627,13 +629,13 @@ function ProductDetail() {
                                  {/* Progress Bar */}
                                  <div className="relative z-10">
                                      <div className="flex justify-between text-xs font-bold uppercase tracking-wider mb-2 text-white/80">
-                                         <span>Sold: {product.flash_sale.sold_count}</span>
+                                         <span>Sold: {liveCounts[product.flash_sale.flash_sale_product_id]?.sold_count ?? product.flash_sale.sold_count}</span>
                                          <span>Limited Stock</span>
                                      </div>
                                      <div className="w-full bg-black/20 rounded-full h-2 overflow-hidden backdrop-blur-sm border border-white/10">
                                          <div 
                                              className="h-full bg-white rounded-full shadow-[0_0_10px_rgba(255,255,255,0.5)]" 
-                                             style={{ width: `${Math.min((product.flash_sale.sold_count / product.flash_sale.quantity_limit) * 100, 100)}%` }}
+                                             style={{ width: `${Math.min(((liveCounts[product.flash_sale.flash_sale_product_id]?.sold_count ?? product.flash_sale.sold_count) / product.flash_sale.quantity_limit) * 100, 100)}%` }}
                                          ></div>
                                      </div>
                                  </div>
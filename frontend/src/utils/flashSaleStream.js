@@ -0,0 +1,98 @@
+import { useEffect, useState } from 'react';
+import { API_BASE_URL } from '../config';
+
+// 📡 Live Flash Sale counters (SSE /api/flash-sales/stream/)
+// One EventSource per tab, shared by every component that shows sold counts.
+// Frames carry absolute values: { flash_sale_product_id, sold_count, reserved_stock }
+// If the server refuses the stream (503 at its cap), counts are polled from the active feed instead.
+const counts = {};
+const listeners = new Set();
+let source = null;
+let reconnectTimer = null;
+let pollTimer = null;
+const RECONNECT_MS = 30000; // Server at its stream cap (503): EventSource gives up, so retry slowly
+const POLL_MS = 10000; // Meanwhile read counts from the cached /api/flash-sales/active/ feed
+
+const applyItems = (items, replace) => {
+    if (replace) {
+        Object.keys(counts).forEach(key => delete counts[key]);
+    }
+    items.forEach(item => { counts[item.flash_sale_product_id] = item; });
+    listeners.forEach(listener => listener({ ...counts }));
+};
+
+const applyFrame = (event) => {
+    applyItems(JSON.parse(event.data).items, event.type === 'snapshot');
+};
+
+const poll = async () => {
+    try {
+        const res = await fetch(`${API_BASE_URL}/api/flash-sales/active/`);
+        if (res.ok) {
+            const sales = await res.json();
+            applyItems(sales.flatMap(sale => (sale.products || []).map(item => ({
+                flash_sale_product_id: item.id,
+                sold_count: item.sold_count,
+                reserved_stock: 0,
+            }))), true);
+        }
+    } catch (err) {
+        console.error('Flash Sale counts poll failed', err);
+    }
+};
+
+const stopPolling = () => {
+    clearInterval(pollTimer);
+    pollTimer = null;
+};
+
+const connect = () => {
+    reconnectTimer = null;
+    source = new EventSource(`${API_BASE_URL}/api/flash-sales/stream/`);
+    source.addEventListener('snapshot', applyFrame);
+    source.addEventListener('counts', applyFrame);
+    source.onopen = stopPolling;
+    source.onerror = () => {
+        // Network errors reconnect on their own; a non-200 answer closes the stream for good
+        if (source && source.readyState === EventSource.CLOSED) {
+            source = null;
+            reconnectTimer = setTimeout(connect, RECONNECT_MS);
+            if (!pollTimer) {
+                poll();
+                pollTimer = setInterval(poll, POLL_MS);
+            }
+        }
+    };
+};
+
+const subscribe = (listener) => {
+    listeners.add(listener);
+    if (!source && !reconnectTimer) {
+        connect();
+    }
+    return () => {
+        listeners.delete(listener);
+        if (listeners.size === 0) {
+            clearTimeout(reconnectTimer);
+            reconnectTimer = null;
+            stopPolling();
+            if (source) {
+                source.close();
+                source = null;
+            }
+        }
+    };
+};
+
+// ✅ { [flash_sale_product_id]: { sold_count, reserved_stock } }, updated live
+export const useFlashSaleCounts = () => {
+    const [live, setLive] = useState(() => ({ ...counts }));
+    useEffect(() => subscribe(setLive), []);
+    return live;
+};
+
+// ✅ Overlay live sold_count on an item that has it (keyed by its Flash Sale product id)
+export const withLiveCount = (item, flashSaleProductId, live) => {
+    const current = item && live[flashSaleProductId];
+    return current ? { ...item, sold_count: current.sold_count } : item;
+};